@@ -22,3 +22,6 @@ This script deletes all events in finished games that are older than AGE days.
 									game__last_phase_change__lt=threshold)
 		print "%s events will be deleted" % len(old_events)
 		old_events.delete()
+		models.EventSeason.objects.filter(game__phase__exact=models.PHINACTIVE,
+									game__slots__exact=0,
+									game__last_phase_change__lt=threshold).delete()
@@ -0,0 +1,17 @@
+from django.core.management.base import NoArgsCommand
+
+from condottieri_events import models
+
+class Command(NoArgsCommand):
+	"""
+This script saves the payload of the events that were logged before events had
+a payload, so that they can be rendered without reading their child events.
+	"""
+	help = 'This command saves the payload of the events that do not have one.'
+
+	def handle_noargs(self, **options):
+		events = models.BaseEvent.objects.filter(payload='')
+		print "%s events will be updated" % events.count()
+		for event in events.iterator():
+			payload = event.get_concrete().make_payload()
+			models.BaseEvent.objects.filter(id=event.id).update(payload=payload)
@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import Count
+
+from condottieri_events import models
+from machiavelli.utils import bulk_insert
+
+class Command(NoArgsCommand):
+	"""
+This script builds again the season index of the events of all the games, from
+the events that are in the database.
+	"""
+	help = 'This command builds again the season index of the events.'
+
+	def handle_noargs(self, **options):
+		models.EventSeason.objects.all().delete()
+		seasons = models.BaseEvent.objects.values_list('game', 'year', 'season',
+									'phase').annotate(events=Count('id')).order_by()
+		rows = [tuple(s) for s in seasons]
+		bulk_insert(models.EventSeason, ('game', 'year', 'season', 'phase', 'events'), rows)
+		print "%s phases indexed" % len(rows)
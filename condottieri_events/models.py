@@ -18,15 +18,31 @@
 
 """ This application manages the log of events during a Condottieri game.
 
+While a phase is being processed, the events of the game are kept in a buffer
+and saved together when the phase ends, with a bulk insert for each event
+class. If the processing of the phase fails,
+the buffer is discarded.
+
+Each event also keeps in its ``payload`` the fields of its child event and its
+css classes, so that a log can be rendered reading only the base events. The
+areas and countries are taken from a dictionary that is read once per process
+and language.
 """
 
 ## django
-from django.db import models
+from django.db import models, connection
+from django.db.models import Max, F, Count
+from django.core.cache import cache
+from django.utils import simplejson
+from django.utils.translation import get_language
 from django.utils.translation import ugettext_lazy as _
 
 ## machiavelli
 from machiavelli.models import *
 from machiavelli.signals import *
+from machiavelli.utils import bulk_insert
+from machiavelli.logging import get_turns_since
+import machiavelli.scenarios as scenarios
 
 if "jogging" in settings.INSTALLED_APPS:
 	from jogging import logging
@@ -43,10 +59,58 @@ BaseEvent is the parent class for all kind of game events.
 	season = models.PositiveIntegerField(choices=SEASONS)
 	phase = models.PositiveIntegerField(choices=GAME_PHASES)
 	classname = models.CharField(max_length=32, editable=False)
+	## JSON with the fields of the child event and the css classes
+	payload = models.TextField(blank=True, editable=False)
 	
 	def get_concrete(self):
-		""" Gets the name of the child class of this BaseEvent """
-		return self.__getattribute__(self.classname.lower())
+		""" Gets the child event. If the event has a payload, the child is
+		built from it, without reading the child table. """
+		if not self.__class__ is BaseEvent:
+			return self
+		if not self.payload:
+			return self.__getattribute__(self.classname.lower())
+		if getattr(self, '_concrete', None) is None:
+			self._concrete = self.build_concrete()
+		return self._concrete
+
+	def make_payload(self):
+		""" Returns the payload of a child event. """
+		fields = {}
+		for f in self.__class__._meta.local_fields:
+			if not f.primary_key:
+				fields[f.attname] = getattr(self, f.attname)
+		return simplejson.dumps({'fields': fields,
+								'event_class': self.event_class(),
+								'country_class': self.country_class()})
+
+	def get_payload_data(self):
+		if getattr(self, '_payload_data', None) is None:
+			self._payload_data = simplejson.loads(self.payload)
+		return self._payload_data
+
+	def build_concrete(self):
+		""" Returns the child event described by the payload, with its areas
+		and countries taken from ``get_board_objects``. """
+		data = self.get_payload_data()
+		event_class = models.get_model('condottieri_events', self.classname)
+		concrete = event_class(id=self.id, baseevent_ptr_id=self.id,
+								game_id=self.game_id, year=self.year,
+								season=self.season, phase=self.phase,
+								classname=self.classname, payload=self.payload)
+		areas, countries = get_board_objects()
+		for f in event_class._meta.local_fields:
+			if f.primary_key or not f.attname in data['fields']:
+				continue
+			value = data['fields'][f.attname]
+			setattr(concrete, f.attname, value)
+			if value is None or not isinstance(f, models.ForeignKey):
+				continue
+			## fill the cache of the foreign key, so that it is not read
+			if f.rel.to is Area:
+				setattr(concrete, f.get_cache_name(), areas[value])
+			elif f.rel.to is Country:
+				setattr(concrete, f.get_cache_name(), countries[value])
+		return concrete
 
 	def unit_string(self, type, area):
 		""" Returns a string like **the garrison in Naples** """
@@ -63,10 +127,14 @@ BaseEvent is the parent class for all kind of game events.
 
 	def event_class(self):
 		""" Returns a css class name depending on the type of event """
+		if self.payload:
+			return self.get_payload_data()['event_class']
 		return self.get_concrete().event_class()
 
 	def country_class(self):
 		""" Returns a css class name if the event is related to a country """
+		if self.payload:
+			return self.get_payload_data()['country_class']
 		try:
 			country = self.get_concrete().country.css_class
 		except:
@@ -89,14 +157,145 @@ BaseEvent is the parent class for all kind of game events.
 		abstract = False
 		ordering = ['-year', '-season', '-id']
 
+class EventSeason(models.Model):
+	""" An entry in the index of the phases of a game that have events, with
+	the number of events. It is updated whenever events are saved, so that
+	the log can be paginated without reading the events. """
+	game = models.ForeignKey(Game)
+	year = models.PositiveIntegerField()
+	season = models.PositiveIntegerField(choices=SEASONS)
+	phase = models.PositiveIntegerField(choices=GAME_PHASES)
+	events = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		unique_together = (('game', 'year', 'season', 'phase'),)
+		ordering = ['-year', '-season', '-phase']
+
+	def __unicode__(self):
+		return "%s %s %s: %s events" % (self.year, self.season, self.phase, self.events)
+
+def index_events(game, events):
+	""" Adds the events to the season index of the game. """
+	counts = {}
+	for e in events:
+		key = (e.year, e.season, e.phase)
+		counts[key] = counts.get(key, 0) + 1
+	for (year, season, phase), count in counts.items():
+		updated = EventSeason.objects.filter(game=game, year=year, season=season,
+								phase=phase).update(events=F('events') + count)
+		if updated == 0:
+			EventSeason.objects.create(game=game, year=year, season=season,
+								phase=phase, events=count)
+
+def get_event_seasons(game, exclude=None):
+	""" Returns a list with the (year, season) of the seasons of the game that
+	have events, the newest first. ``exclude`` is a (year, season, phase)
+	whose events are not counted. """
+	seasons = []
+	for year, season, phase in EventSeason.objects.filter(game=game,
+							events__gt=0).values_list('year', 'season', 'phase'):
+		if (year, season, phase) == exclude:
+			continue
+		if len(seasons) == 0 or seasons[-1] != (year, season):
+			seasons.append((year, season))
+	return seasons
+
+## language -> (version, areas by id, countries by id)
+_board_objects = {}
+
+def get_board_objects():
+	""" Returns two dictionaries with all the Areas and Countries by id. The
+	names are translated when the objects are read, so they are kept for each
+	language, and read again when the scenarios change. """
+	version = cache.get(scenarios.VERSION_KEY)
+	language = get_language()
+	objects = _board_objects.get(language)
+	if objects is None or objects[0] != version:
+		objects = (version,
+				dict([(a.id, a) for a in Area.objects.all()]),
+				dict([(c.id, c) for c in Country.objects.all()]))
+		_board_objects[language] = objects
+	return objects[1], objects[2]
+
+## game id -> events waiting to be saved
+_buffers = {}
+
 def log_event(event_class, game, **kwargs):
-	""" Creates a new BaseEvent and its child event. """
+	""" Creates a new BaseEvent and its child event. If the game is being
+	processed, the event is saved when the phase ends. """
 	try:
 		event = event_class(game=game, year=game.year, season=game.season, phase=game.phase, **kwargs)
-		event.save()
-	except:
+		event.payload = event.make_payload()
+		buffer = _buffers.get(game.id)
+		if buffer is None:
+			event.save()
+			index_events(game, [event,])
+		else:
+			buffer.append(event)
+	except Exception, e:
 		if logging:
-			logging.info("Error in log_event")
+			logging.info("Error in log_event: %s" % e)
+
+def save_events(game, events):
+	""" Saves the events, inserting the base events one by one to know their
+	ids, and then the child events with a bulk insert for each event class.
+	It must be called in the transaction of the phase, so that the base
+	events are never saved without their child events. """
+	if len(events) == 0:
+		return
+	qn = connection.ops.quote_name
+	table = BaseEvent._meta.db_table
+	sql = "INSERT INTO %s (%s, %s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % \
+		((qn(table),) + tuple([qn(BaseEvent._meta.get_field(f).column)
+		for f in ('game', 'year', 'season', 'phase', 'classname', 'payload')]))
+	cursor = connection.cursor()
+	## event class -> (id, event)
+	classes = {}
+	for e in events:
+		cursor.execute(sql, (e.game_id, e.year, e.season, e.phase, e.classname, e.payload))
+		id = connection.ops.last_insert_id(cursor, table, BaseEvent._meta.pk.column)
+		classes.setdefault(e.__class__, []).append((id, e))
+	for event_class, rows in classes.items():
+		fields = [f for f in event_class._meta.local_fields if not f is event_class._meta.pk]
+		bulk_insert(event_class, [event_class._meta.pk.name] + [f.name for f in fields],
+				[(id,) + tuple([getattr(e, f.attname) for f in fields]) for id, e in rows])
+	index_events(game, events)
+
+def open_buffer(sender, **kwargs):
+	_buffers[sender.id] = []
+
+def close_buffer(sender, **kwargs):
+	events = _buffers.pop(sender.id, [])
+	if kwargs['processed']:
+		save_events(sender, events)
+
+phase_started.connect(open_buffer)
+phase_finished.connect(close_buffer)
+
+def add_last_event(sender, snapshot, **kwargs):
+	""" Adds to a snapshot of the game the id of its last event. """
+	last = BaseEvent.objects.filter(game=sender).aggregate(Max('id'))['id__max']
+	snapshot['last_event'] = last or 0
+
+def delete_undone_events(sender, snapshot, **kwargs):
+	""" Deletes the events logged after the snapshot of the game was made,
+	and builds again the season index of the game. The snapshots without the
+	id of the last event delete all the events since its phase. """
+	events = BaseEvent.objects.filter(game=sender)
+	if 'last_event' in snapshot:
+		events = events.filter(id__gt=snapshot['last_event'])
+	else:
+		year, season, phase = snapshot['turn']
+		events = events.filter(get_turns_since(year, season, phase))
+	events.delete()
+	EventSeason.objects.filter(game=sender).delete()
+	seasons = BaseEvent.objects.filter(game=sender).values_list('year', 'season',
+								'phase').annotate(events=Count('id')).order_by()
+	bulk_insert(EventSeason, ('game', 'year', 'season', 'phase', 'events'),
+				[(sender.id,) + tuple(s) for s in seasons])
+
+snapshot_made.connect(add_last_event)
+game_restored.connect(delete_undone_events)
 
 class NewUnitEvent(BaseEvent):
 	""" Event triggered when a new unit is placed in the map. """
@@ -317,14 +516,15 @@ class ControlEvent(BaseEvent):
 						'area': self.area.name
 						}
 
-def log_control(sender, **kwargs):
-	assert isinstance(sender, GameArea), "sender must be a GameArea"
-	log_event(ControlEvent, sender.player.game,
+def log_controls(sender, **kwargs):
+	assert isinstance(sender, Game), "sender must be a Game"
+	for area in kwargs['areas']:
+		log_event(ControlEvent, sender,
 					classname="ControlEvent",
-					country=sender.player.country,
-					area=sender.board_area)
+					country=area.player.country,
+					area=area.board_area)
 
-area_controlled.connect(log_control)
+areas_controlled.connect(log_controls)
 
 class MovementEvent(BaseEvent):
 	""" Event triggered when a unit moves to a different province. """
@@ -682,22 +882,38 @@ class IncomeEvent(BaseEvent):
 	""" Event triggered when a country receives income """
 	country = models.ForeignKey(Country)
 	ducats = models.PositiveIntegerField()
+	## parts of the income, if they are known
+	control = models.PositiveIntegerField(null=True, blank=True)
+	occupation = models.PositiveIntegerField(null=True, blank=True)
+	garrisons = models.PositiveIntegerField(null=True, blank=True)
+	variable = models.PositiveIntegerField(null=True, blank=True)
 
 	def event_class(self):
 		return "income-event"
 
 	def __unicode__(self):
-		return _("%(country)s raises %(ducats)s ducats.") % {
-						'country': self.country,
-						'ducats': self.ducats,
-						}
+		data = {
+			'country': self.country,
+			'ducats': self.ducats,
+			'control': self.control,
+			'occupation': self.occupation,
+			'garrisons': self.garrisons,
+			'variable': self.variable,
+		}
+		if self.control is None:
+			return _("%(country)s raises %(ducats)s ducats.") % data
+		return _("%(country)s raises %(ducats)s ducats: %(control)s from controlled areas, %(occupation)s from occupied areas, %(garrisons)s from garrisons and %(variable)s of variable income.") % data
 
 def log_income(sender, **kwargs):
 	assert isinstance(sender, Player), "sender must be a Player"
 	log_event(IncomeEvent, sender.game,
 					classname="IncomeEvent",
 					country=sender.country,
-					ducats=kwargs['ducats'])
+					ducats=kwargs['ducats'],
+					control=kwargs.get('control'),
+					occupation=kwargs.get('occupation'),
+					garrisons=kwargs.get('garrisons'),
+					variable=kwargs.get('variable'))
 
 income_raised.connect(log_income)
 
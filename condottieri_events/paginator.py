@@ -46,11 +46,19 @@ class EmptyPage(InvalidPage):
 	pass
 
 class SeasonPaginator(object):
-	def __init__(self, object_list):
+	""" Paginates the events by season. ``seasons`` is the list of the
+	(year, season) that have events, the newest first, as returned by
+	``condottieri_events.models.get_event_seasons``. If it is not given, it is
+	read from the events. """
+	def __init__(self, object_list, seasons=None):
 		self.object_list = object_list
-		self._newest_year = self._oldest_year = None
-		self._newest_season = None
-		self._oldest_season = 1 ## oldest season is always spring
+		if seasons is None:
+			seasons = []
+			for date in object_list.values_list('year', 'season'):
+				if len(seasons) == 0 or seasons[-1] != date:
+					seasons.append(date)
+		self.seasons = list(seasons)
+		self._positions = dict([(date, i) for i, date in enumerate(self.seasons)])
 
 	def validate_date(self, year, season):
 		""" Validates the combination of season and year. """
@@ -73,50 +81,48 @@ class SeasonPaginator(object):
 
 	def page(self, year=None, season=None):
 		"Returns a Page object for the given year and season."
+		if len(self.seasons) == 0:
+			raise EmptyPage('No events.')
 		if year is None or season is None:
 			year = self.newest_year
 			season = self.newest_season
 		else:
 			year, season = self.validate_date(year, season)
-		object_list = self.object_list.filter(year=year, season=season)
-		if object_list.count() <= 0:
+		if not (year, season) in self._positions:
 			raise EmptyPage('No events for this date.')
+		object_list = self.object_list.filter(year=year, season=season)
 		return Page(object_list, year, season, self)
 
+	def get_position(self, year, season):
+		""" Returns the position of the season in the list of seasons. """
+		return self._positions[(year, season)]
+
 	def _get_newest_year(self):
-		""" Returns the most recent year in the events queryset """
-		if self._newest_year is None:
-			try:
-				self._newest_year = self.object_list[0].year
-			except IndexError:
-				pass
-		return self._newest_year
+		""" Returns the most recent year with events """
+		if len(self.seasons) > 0:
+			return self.seasons[0][0]
+		return None
 	newest_year = property(_get_newest_year)
 
 	def _get_oldest_year(self):
-		""" Returns the oldest year in the events queryset """
-		if self._oldest_year is None:
-			try:
-				self._oldest_year = self.object_list.reverse()[0].year
-			except IndexError:
-				pass
-		return self._oldest_year
+		""" Returns the oldest year with events """
+		if len(self.seasons) > 0:
+			return self.seasons[-1][0]
+		return None
 	oldest_year = property(_get_oldest_year)
 
 	def _get_newest_season(self):
-		""" Returns the most recent season in the events queryset """
-		if self._newest_season is None:
-			try:
-				self._newest_season = self.object_list[0].season
-			except IndexError:
-				## there are no seasons yet
-				pass
-		return self._newest_season
+		""" Returns the most recent season with events """
+		if len(self.seasons) > 0:
+			return self.seasons[0][1]
+		return None
 	newest_season = property(_get_newest_season)
 
 	def _get_oldest_season(self):
-		""" Returns the oldest season in the events queryset """
-		return self._oldest_season
+		""" Returns the oldest season with events """
+		if len(self.seasons) > 0:
+			return self.seasons[-1][1]
+		return None
 	oldest_season = property(_get_oldest_season)
 
 class Page(object):
@@ -125,6 +131,7 @@ class Page(object):
 		self.year = year
 		self.season = season
 		self.paginator = paginator
+		self.position = paginator.get_position(year, season)
 		if season is not None:
 			self.season_name = SEASONS[season]
 		else:
@@ -134,35 +141,20 @@ class Page(object):
 		return '<Page for %s %s>' % (self.year, self.season)
 
 	def has_next(self):
-		if self.year > self.paginator.oldest_year:
-			return True
-		if self.year == self.paginator.oldest_year and self.season > self.paginator.oldest_season:
-			return True
-		return False
+		return self.position < len(self.paginator.seasons) - 1
 
 	def has_previous(self):
-		if self.year < self.paginator.newest_year:
-			return True
-		if self.year == self.paginator.newest_year and self.season < self.paginator.newest_season:
-			return True
-		return False
+		return self.position > 0
 
 	def has_other_pages(self):
 		return self.has_previous() or self.has_next()
 
 	def next_date(self):
-		""" Returns a string with GET parameters """
-		if self.season in (3, 2):
-			params = (self.year, self.season - 1)
-		elif self.season == 1:
-			params = (self.year - 1, 3)
-		return "year=%s&season=%s" % params
+		""" Returns a string with GET parameters of the previous season with
+		events """
+		return "year=%s&season=%s" % self.paginator.seasons[self.position + 1]
 	
 	def previous_date(self):
-		""" Returns a string with GET parameters """
-		if self.season in (2, 1):
-			params = (self.year, self.season + 1)
-		elif self.season == 3:
-			params = (self.year + 1, 1)
-		return "year=%s&season=%s" % params
-
+		""" Returns a string with GET parameters of the next season with
+		events """
+		return "year=%s&season=%s" % self.paginator.seasons[self.position - 1]
@@ -0,0 +1,896 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the in-memory adjudicator used to process the orders
+of a game.
+
+A ``Board`` loads the game areas, units, orders and rebellions of a game with
+a constant number of queries and keeps them as plain objects. The borders are
+taken from the adjacency index in ``machiavelli.graph``. The
+``Adjudicator`` resolves the turn on the ``Board``, following exactly the same
+steps as the methods of ``Game``, and finally ``Board.save`` writes the
+results back to the database in a single transaction.
+"""
+
+from django.utils.translation import ugettext as _
+
+import machiavelli.exceptions as exceptions
+import machiavelli.graph as graph
+from machiavelli.utils import atomic
+
+class SupportTable(object):
+	""" The total power of the units supporting each unit, by the kind of
+	order that they support.
+
+	The table is built in a single pass over the support orders, and the
+	strength of every unit can be read from it without new queries.
+	"""
+
+	def __init__(self):
+		self.supports = {}
+
+	def key(self, unit_id, code=None, destination_id=None, type=None):
+		## a unit with no order, or with H, S, C or B orders, is holding
+		if code == '=':
+			return (unit_id, '=', type)
+		elif code == '-':
+			return (unit_id, '-', destination_id)
+		return (unit_id, 'H', None)
+
+	def add(self, subunit_id, subcode, subdestination_id, subtype, power):
+		""" Adds the power of a unit supporting a suborder. """
+		if not subcode in ('H', '-', '='):
+			return
+		key = self.key(subunit_id, subcode, subdestination_id, subtype)
+		self.supports[key] = self.supports.get(key, 0) + power
+
+	def remove(self, subunit_id, subcode, subdestination_id, subtype, power):
+		""" Removes the power of a unit whose support order is deleted. """
+		self.add(subunit_id, subcode, subdestination_id, subtype, -power)
+
+	def get_support(self, unit_id, code=None, destination_id=None, type=None):
+		""" Returns the power of the units supporting a unit, given its
+		order. """
+		return self.supports.get(self.key(unit_id, code, destination_id, type), 0)
+
+class AreaState(object):
+	""" A GameArea, as seen by the adjudicator. """
+
+	def __init__(self, id, board_area_id, code, name, is_sea, standoff):
+		self.id = id
+		self.board_area_id = board_area_id
+		self.code = code
+		self.name = name
+		self.is_sea = is_sea
+		self.standoff = standoff
+
+	def __unicode__(self):
+		return self.name
+
+class UnitState(object):
+	""" A Unit, as seen by the adjudicator. """
+
+	def __init__(self, board, id, type, area, player_id, besieging, must_retreat, power):
+		self.board = board
+		self.id = id
+		self.type = type
+		self.area = area
+		self.player_id = player_id
+		self.besieging = besieging
+		self.must_retreat = must_retreat
+		self.power = power
+		## values stored in the database, used to find the units that change
+		self.initial = self.values()
+
+	def values(self):
+		return (self.type, self.area.id, self.must_retreat, self.besieging)
+
+	def __unicode__(self):
+		return _("%(type)s in %(area)s") % {'type': self.board.unit_types[self.type],
+											'area': self.area}
+
+class OrderState(object):
+	""" An Order, as seen by the adjudicator. """
+
+	def __init__(self, id, unit, code, destination, type, subunit, subcode,
+				subdestination, subtype):
+		self.id = id
+		self.unit = unit
+		self.code = code
+		self.destination = destination
+		self.type = type
+		self.subunit = subunit
+		self.subcode = subcode
+		self.subdestination = subdestination
+		self.subtype = subtype
+
+	def format_suborder(self):
+		""" Same as ``Order.format_suborder``. """
+		if not self.subunit:
+			return ''
+		f = "%s %s" % (self.subunit.type, self.subunit.area.code)
+		f += " %s" % self.subcode
+		if self.subcode == None and self.subdestination != None:
+			f += "- %s" % self.subdestination.code
+		elif self.subcode == '-':
+			f += " %s" % self.subdestination.code
+		elif self.subcode == '=':
+			f += " %s" % self.subtype
+		return f
+
+	def format(self):
+		""" Same as ``Order.format``. """
+		f = "%s %s" % (self.unit.type, self.unit.area.code)
+		f += " %s" % self.code
+		if self.code == '-':
+			f += " %s" % self.destination.code
+		elif self.code == '=':
+			f += " %s" % self.type
+		elif self.code == 'S' or self.code == 'C':
+			f += " %s" % self.format_suborder()
+		return f
+
+	def __unicode__(self):
+		return self.format()
+
+class RebellionState(object):
+	""" A Rebellion, as seen by the adjudicator. """
+
+	def __init__(self, id, area, player_id, garrisoned):
+		self.id = id
+		self.area = area
+		self.player_id = player_id
+		self.garrisoned = garrisoned
+
+class Board(object):
+	""" The state of a game during the processing of the orders.
+
+	The methods of this class mirror the methods of the models that change the
+	state of the game (``Unit.invade_area``, ``Unit.convert``,
+	``GameArea.mark_as_standoff``...). The changes are only made in memory, and
+	the signals are recorded in ``events`` to be sent when the board is saved.
+	"""
+
+	def __init__(self, game):
+		self.game = game
+		self.finances = False
+		self.unit_types = {}
+		self.graph = graph.get_graph()
+		## game areas by id, and by the id of their board areas
+		self.areas = {}
+		self.by_board_area = {}
+		self.units = {}
+		## unit id -> order
+		self.orders = {}
+		## area id -> rebellion
+		self.rebellions = {}
+		self.assassinated = set()
+		self.supports = SupportTable()
+		## order id -> convoy path, computed when needed
+		self.convoy_paths = None
+		self.events = []
+		self.deleted_orders = []
+		self.deleted_units = []
+		self.deleted_rebellions = []
+		self.standoffs = []
+
+	@classmethod
+	def load(cls, game):
+		""" Returns a new Board with the current state of the game. """
+		from machiavelli.models import GameArea, Unit, Order, Rebellion, UNIT_TYPES
+
+		board = cls(game)
+		board.finances = game.configuration.finances
+		board.unit_types = dict(UNIT_TYPES)
+		for ga in GameArea.objects.filter(game=game).select_related('board_area'):
+			area = AreaState(ga.id, ga.board_area_id, ga.board_area.code,
+							unicode(ga.board_area), ga.board_area.is_sea,
+							ga.standoff)
+			board.areas[area.id] = area
+			board.by_board_area[area.board_area_id] = area
+		units = Unit.objects.filter(player__game=game).values_list('id', 'type',
+						'area', 'player', 'besieging', 'must_retreat', 'power')
+		for id, type, area, player, besieging, must_retreat, power in units:
+			board.units[id] = UnitState(board, id, type, board.areas[area], player,
+										besieging, must_retreat, power)
+		board.assassinated = set(game.player_set.filter(assassinated=True).values_list('id', flat=True))
+		orders = Order.objects.filter(unit__player__game=game).order_by('id').values_list('id',
+						'unit', 'code', 'destination', 'type', 'subunit', 'subcode',
+						'subdestination', 'subtype')
+		for row in orders:
+			order = OrderState(row[0], board.units[row[1]], row[2],
+							board.areas.get(row[3]), row[4],
+							board.units.get(row[5]), row[6],
+							board.areas.get(row[7]), row[8])
+			if order.unit.id in board.orders:
+				raise exceptions.WrongOrderCount(u"%s has more than one order" % order.unit)
+			board.orders[order.unit.id] = order
+			if order.code == 'S':
+				board.supports.add(row[5], row[6], row[7], row[8], order.unit.power)
+		rebellions = Rebellion.objects.filter(area__game=game).values_list('id', 'area',
+						'player', 'garrisoned')
+		for id, area, player, garrisoned in rebellions:
+			board.rebellions[area] = RebellionState(id, board.areas[area], player, garrisoned)
+		return board
+
+	##----------------------
+	## queries
+	##----------------------
+
+	def get_units(self, area=None, types=None):
+		""" Returns a list of the units, ordered by id, optionally in an area
+		and of the given types. """
+		result = []
+		for u in self.units.values():
+			if area and u.area != area:
+				continue
+			if types and not u.type in types:
+				continue
+			result.append(u)
+		result.sort(key=lambda u: u.id)
+		return result
+
+	def get_orders(self, code=None):
+		""" Returns a list of the orders, ordered by id. """
+		result = []
+		for o in self.orders.values():
+			if code and o.code != code:
+				continue
+			result.append(o)
+		result.sort(key=lambda o: o.id)
+		return result
+
+	def get_order(self, unit):
+		return self.orders.get(unit.id)
+
+	def get_attacked_area(self, unit):
+		""" Same as ``Unit.get_attacked_area``, but returns None if there is
+		no attacked area. """
+		order = self.get_order(unit)
+		if order:
+			if order.code == '-':
+				return order.destination
+			elif order.code == '=':
+				return unit.area
+		return None
+
+	def get_adjacent_areas(self, area):
+		""" Returns a list of the game areas adjacent to ``area``. """
+		result = []
+		for b in self.graph.get_borders(area.board_area_id):
+			if b in self.by_board_area:
+				result.append(self.by_board_area[b])
+		return result
+
+	def is_adjacent(self, area, other, fleet=False):
+		""" Same as ``Area.is_adjacent``. """
+		return self.graph.is_adjacent(area.board_area_id, other.board_area_id, fleet)
+
+	def get_convoy_paths(self):
+		""" Returns a dictionary with the convoy path of every advance order
+		that has convoy orders. All the paths are computed in one pass, and
+		kept until a convoy order is deleted. """
+		if self.convoy_paths is None:
+			## (unit id, destination id) -> board area ids of convoying seas
+			lines = {}
+			for o in self.get_orders(code='C'):
+				if o.unit.area.is_sea and o.subunit and o.subdestination:
+					key = (o.subunit.id, o.subdestination.id)
+					lines.setdefault(key, set()).add(o.unit.area.board_area_id)
+			self.convoy_paths = {}
+			for o in self.get_orders(code='-'):
+				convoy_areas = lines.get((o.unit.id, o.destination.id))
+				if not convoy_areas:
+					continue
+				path = self.graph.find_convoy_path(o.unit.area.board_area_id,
+												o.destination.board_area_id,
+												convoy_areas)
+				self.convoy_paths[o.id] = [self.by_board_area[b] for b in path]
+		return self.convoy_paths
+
+	def get_convoy_path(self, order):
+		""" Same as ``Order.find_convoy_line``. """
+		return self.get_convoy_paths().get(order.id, [])
+
+	def province_is_empty(self, area):
+		return len(self.get_units(area=area, types=('A', 'F'))) == 0
+
+	def has_rebellion(self, area, player_id, same=True):
+		""" Same as ``GameArea.has_rebellion``. """
+		reb = self.rebellions.get(area.id)
+		if not reb:
+			return False
+		if same and reb.player_id != player_id:
+			return False
+		if not same and reb.player_id == player_id:
+			return False
+		return reb
+
+	def get_strength(self, unit):
+		""" Same as ``UnitManager.get_with_strength``. """
+		order = self.get_order(unit)
+		if not order or order.code in ('', 'H', 'S', 'C', 'B'):
+			support = self.supports.get_support(unit.id)
+			holding = True
+		else:
+			if order.destination:
+				destination_id = order.destination.id
+			else:
+				destination_id = None
+			support = self.supports.get_support(unit.id, order.code,
+												destination_id, order.type)
+			holding = False
+		if self.finances and holding:
+			if self.has_rebellion(unit.area, unit.player_id, same=True):
+				support -= 1
+		return unit.power + support
+
+	##----------------------
+	## changes
+	##----------------------
+
+	def record(self, signal, unit=None, area=None, **kwargs):
+		""" Stores a signal to be sent when the board is saved. The sender is
+		stored as it is now. """
+		if unit:
+			sender = (unit.id, unit.type, unit.area.id, unit.player_id,
+					unit.must_retreat)
+		else:
+			sender = area.id
+		self.events.append((signal, sender, kwargs))
+
+	def delete_order(self, unit):
+		order = self.orders.pop(unit.id, None)
+		if order:
+			self.deleted_orders.append(order.id)
+			if order.code == 'C':
+				self.convoy_paths = None
+			elif order.code == 'S':
+				if order.subdestination:
+					subdestination_id = order.subdestination.id
+				else:
+					subdestination_id = None
+				self.supports.remove(order.subunit.id, order.subcode,
+									subdestination_id, order.subtype,
+									order.unit.power)
+		return True
+
+	def delete_unit(self, unit):
+		""" Deletes the unit, its order and the orders affecting it, as the
+		database will do. """
+		self.record('unit_disbanded', unit=unit)
+		self.delete_order(unit)
+		for o in self.get_orders():
+			if o.subunit == unit:
+				self.delete_order(o.unit)
+		del self.units[unit.id]
+		self.deleted_units.append(unit.id)
+
+	def delete_rebellion(self, reb):
+		del self.rebellions[reb.area.id]
+		self.deleted_rebellions.append(reb.id)
+
+	def mark_as_standoff(self, area):
+		self.record('standoff_happened', area=area)
+		area.standoff = True
+		self.standoffs.append(area.id)
+
+	def invade_area(self, unit, area):
+		self.record('unit_moved', unit=unit, destination=area.id)
+		unit.area = area
+		unit.must_retreat = ''
+		self.check_rebellion(unit)
+
+	def convert(self, unit, new_type):
+		self.record('unit_converted', unit=unit, before=unit.type, after=new_type)
+		unit.type = new_type
+		unit.must_retreat = ''
+		if new_type != 'G':
+			self.check_rebellion(unit)
+
+	def check_rebellion(self, unit):
+		## if there is a rebellion against other player, put it down
+		reb = self.has_rebellion(unit.area, unit.player_id, same=False)
+		if reb:
+			self.delete_rebellion(reb)
+
+	@atomic
+	def save(self):
+		""" Sends the recorded signals and writes the changes to the database.
+		"""
+		from machiavelli.models import GameArea, Player, Unit, Order, Rebellion
+		from machiavelli.models import signals
+
+		areas = {}
+		for ga in GameArea.objects.filter(game=self.game).select_related('board_area'):
+			ga.game = self.game
+			areas[ga.id] = ga
+		players = {}
+		for p in Player.objects.filter(game=self.game).select_related('country'):
+			p.game = self.game
+			players[p.id] = p
+		if signals:
+			for signal, sender, kwargs in self.events:
+				if isinstance(sender, tuple):
+					id, type, area, player, must_retreat = sender
+					sender = Unit(id=id, type=type, must_retreat=must_retreat)
+					sender.area = areas[area]
+					sender.player = players[player]
+				else:
+					sender = areas[sender]
+				if 'destination' in kwargs:
+					kwargs['destination'] = areas[kwargs['destination']]
+				getattr(signals, signal).send(sender=sender, **kwargs)
+		## group the units by their new values, to update them together
+		changes = {}
+		for u in self.units.values():
+			values = u.values()
+			if values != u.initial:
+				changes.setdefault(values, []).append(u.id)
+		for (type, area, must_retreat, besieging), ids in changes.items():
+			Unit.objects.filter(id__in=ids).update(type=type, area=areas[area],
+								must_retreat=must_retreat, besieging=besieging)
+		if len(self.standoffs) > 0:
+			GameArea.objects.filter(id__in=self.standoffs).update(standoff=True)
+		if len(self.deleted_rebellions) > 0:
+			Rebellion.objects.filter(id__in=self.deleted_rebellions).delete()
+		if len(self.deleted_orders) > 0:
+			Order.objects.filter(id__in=self.deleted_orders).delete()
+		if len(self.deleted_units) > 0:
+			self.game.delete_in_batch(Unit.objects.filter(id__in=self.deleted_units))
+		else:
+			self.game.bump_cache_version()
+
+class Adjudicator(object):
+	""" Resolves the orders in a ``Board``.
+
+	Each step returns the same log as the ``Game`` method with the same name.
+	"""
+
+	def __init__(self, board):
+		self.board = board
+
+	def get_conflict_areas(self):
+		conflict_areas = []
+		for o in self.board.get_orders():
+			if o.type == 'G':
+				continue
+			if o.code == '-':
+				if self.board.is_adjacent(o.unit.area, o.destination, fleet=(o.unit.type=='F')) or \
+					self.board.get_convoy_path(o):
+						area = o.destination
+				else:
+					continue
+			elif o.code == '=':
+				## unit trying to convert into A or F
+				area = o.unit.area
+			else:
+				continue
+			conflict_areas.append(area)
+		return conflict_areas
+
+	def resolve_auto_garrisons(self):
+		info = u"Step 1: Garrisoning units.\n"
+		board = self.board
+		for g in board.get_units():
+			order = board.get_order(g)
+			if not order or order.code != '=' or order.type != 'G':
+				continue
+			info += u"%s tries to convert into garrison.\n" % g
+			if len(board.get_units(area=g.area, types=('G',))) != 1:
+				info += u"Success!\n"
+				board.convert(g, 'G')
+				board.delete_order(g)
+			else:
+				info += u"Fail: there is a garrison in the city.\n"
+		return info
+
+	def filter_supports(self):
+		info = u"Step 2: Cancel supports from units under attack.\n"
+		board = self.board
+		conflict_areas = self.get_conflict_areas()
+		for s in board.get_orders(code='S'):
+			info += u"Checking order %s.\n" % s
+			if s.unit.type != 'G' and s.unit.area in conflict_areas:
+				attacks = []
+				for a in board.get_orders():
+					if a.unit.player_id == s.unit.player_id:
+						continue
+					if (a.code == '-' and a.destination == s.unit.area) or \
+						(a.code == '=' and a.unit.area == s.unit.area and a.unit.type == 'G'):
+						attacks.append(a)
+				if len(attacks) > 0:
+					info += u"Supporting unit is being attacked.\n"
+					for a in attacks:
+						if (s.subcode == '-' and s.subdestination == a.unit.area) or \
+						(s.subcode == '=' and s.subtype in ['A','F'] and s.subunit.area == a.unit.area):
+							info += u"Support is not broken.\n"
+							continue
+						else:
+							info += u"Attack from %s breaks support.\n" % a.unit
+							board.record('support_broken', unit=s.unit)
+							board.delete_order(s.unit)
+							break
+		return info
+
+	def filter_convoys(self):
+		info = u"Step 3: Cancel convoys by fleets that will be dislodged.\n"
+		board = self.board
+		## find units attacking fleets
+		sea_attackers = []
+		for s in board.get_units():
+			order = board.get_order(s)
+			if not order:
+				continue
+			if (order.code == '-' and order.destination.is_sea) or \
+				(order.code == '=' and s.area.code == 'VEN' and s.type == 'G'):
+				sea_attackers.append(s)
+		for s in sea_attackers:
+			order = board.get_order(s)
+			## find the defender
+			if order.code == '-':
+				area = order.destination
+			else:
+				area = s.area
+			defenders = []
+			for d in board.get_units(area=area, types=('F',)):
+				d_order = board.get_order(d)
+				if d_order and d_order.code == 'C':
+					defenders.append(d)
+			if len(defenders) != 1:
+				## no attacked convoying fleet is found
+				continue
+			defender = defenders[0]
+			info += u"Convoying %s is being attacked by %s.\n" % (defender, s)
+			a_strength = board.get_strength(s)
+			d_strength = board.get_strength(defender)
+			if a_strength > d_strength:
+				if board.get_order(defender):
+					info += u"%s can't convoy.\n" % defender
+					board.delete_order(defender)
+		return info
+
+	def filter_unreachable_attacks(self):
+		info = u"Step 4: Cancel attacks to unreachable areas.\n"
+		board = self.board
+		for o in board.get_orders(code='-'):
+			is_fleet = (o.unit.type == 'F')
+			if not board.is_adjacent(o.unit.area, o.destination, is_fleet):
+				if is_fleet:
+					info += u"Impossible attack: %s.\n" % o
+					board.delete_order(o.unit)
+				else:
+					path = board.get_convoy_path(o)
+					if not path:
+						info += u"Impossible attack: %s.\n" % o
+						board.delete_order(o.unit)
+					else:
+						info += u"%s is convoyed through %s.\n" % (o.unit,
+										u", ".join([a.code for a in path[1:-1]]))
+		return info
+
+	def get_rivals(self, order):
+		""" Same as ``Order.get_rivals``. """
+		board = self.board
+		rivals = []
+		for u in board.get_units():
+			if u == order.unit:
+				continue
+			u_order = board.get_order(u)
+			if not u_order:
+				continue
+			if order.code == '-':
+				if u_order.destination == order.destination or \
+					(u.type == 'G' and u.area == order.destination and u_order.code == '='):
+					rivals.append(u)
+			elif order.code == '=':
+				if u_order.destination == order.unit.area:
+					rivals.append(u)
+		return rivals
+
+	def get_defender(self, order):
+		""" Same as ``Order.get_defender``, but returns None if there is no
+		defender. """
+		board = self.board
+		defenders = []
+		if order.code == '-':
+			for u in board.get_units(area=order.destination):
+				u_order = board.get_order(u)
+				if u_order and u_order.destination == order.unit.area:
+					defenders.append(u)
+				elif u.type in ('A', 'F') and \
+					(not u_order or u_order.code in ('B', 'H', 'S', 'C')):
+					defenders.append(u)
+		elif order.code == '=':
+			for u in board.get_units(area=order.unit.area, types=('A', 'F')):
+				u_order = board.get_order(u)
+				if not u_order or u_order.code in ('B', 'H', 'S', 'C', '='):
+					defenders.append(u)
+		if len(defenders) > 1:
+			raise exceptions.WrongUnitCount
+		elif len(defenders) == 1:
+			return defenders[0]
+		return None
+
+	def resolve_conflicts(self):
+		info = u"Step 5: Process conflicts.\n"
+		board = self.board
+		## units sorted (reverse) by their strength, as in
+		## UnitManager.list_with_strength
+		units = board.get_units()
+		strengths = {}
+		## must_retreat is not updated in the list of units, so the units
+		## that hold can put down a rebellion even if they are dislodged
+		must_retreat = {}
+		for u in units:
+			strengths[u.id] = board.get_strength(u)
+			must_retreat[u.id] = u.must_retreat
+		units.sort(key=lambda u: strengths[u.id], reverse=True)
+		conditioned_invasions = []
+		conditioned_origins = []
+		holding = []
+		## iterate all the units
+		for u in units:
+			## discard all the units with H, S, B, C or no orders
+			## they will not move
+			u_order = board.get_order(u)
+			if not u_order:
+				info += u"%s has no orders.\n" % u
+				continue
+			else:
+				info += u"%s was ordered: %s.\n" % (u, u_order)
+				if board.finances and u_order.code == 'H':
+					## the unit counts for removing a rebellion
+					holding.append(u)
+				if u_order.code in ['H', 'S', 'B', 'C']:
+					continue
+			s = strengths[u.id]
+			info += u"Total strength = %s.\n" % s
+			## rivals and defender are the units trying to enter into or stay
+			## in the same area as 'u'
+			rivals = self.get_rivals(u_order)
+			defender = self.get_defender(u_order)
+			info += u"Unit has %s rivals.\n" % len(rivals)
+			conflict_area = board.get_attacked_area(u)
+			if conflict_area.standoff:
+				info += u"Trying to enter a standoff area.\n"
+				continue
+			else:
+				standoff = False
+			## if there is a rival with the same strength as 'u', there is a
+			## standoff.
+			## if not, check for defenders
+			for r in rivals:
+				strength = board.get_strength(r)
+				info += u"Rival %s has strength %s.\n" % (r, strength)
+				if strength >= s:
+					info += u"Rival wins.\n"
+					standoff = True
+				else:
+					## the rival is defeated and loses its orders
+					info += u"Deleting order of %s.\n" % r
+					board.delete_order(r)
+			## if there is a standoff, delete the order and all rivals' orders
+			if standoff:
+				board.mark_as_standoff(conflict_area)
+				info += u"Standoff in %s.\n" % conflict_area
+				for r in rivals:
+					board.delete_order(r)
+				board.delete_order(u)
+				continue
+			## if there is no standoff, rivals allow the unit to enter the area
+			## then check what the defenders think
+			if defender:
+				## a 'friend enemy' is always as strong as the invading unit
+				if defender.player_id == u.player_id:
+					strength = s
+					info += u"Defender is a friend.\n"
+				else:
+					strength = board.get_strength(defender)
+				info += u"Defender %s has strength %s.\n" % (defender, strength)
+				## if attacker is not as strong as defender
+				if strength >= s:
+					## if the defender is trying to exchange areas with
+					## the attacker, there is a standoff in the defender's
+					## area
+					if board.get_attacked_area(defender) == u.area:
+						board.mark_as_standoff(defender.area)
+						info += u"Trying to exchange areas.\n"
+						info += u"Standoff in %s.\n" % defender.area
+					else:
+						## the invasion is conditioned to the defender leaving
+						info += u"%s's movement is conditioned.\n" % u
+						inv = [u, defender.area, '']
+						if u_order.code == '-':
+							info += u"%s might get empty.\n" % u.area
+							conditioned_origins.append(u.area)
+						elif u_order.code == '=':
+							inv[2] = u_order.type
+						conditioned_invasions.append(inv)
+				## if the defender is weaker, the area is invaded and the
+				## defender must retreat
+				else:
+					defender.must_retreat = u.area.code
+					if u_order.code == '-':
+						board.invade_area(u, defender.area)
+						info += u"Invading %s.\n" % defender.area
+					elif u_order.code == '=':
+						info += u"Converting into %s.\n" % u_order.type
+						board.convert(u, u_order.type)
+					board.delete_order(defender)
+			## no defender means either that the area is empty *OR*
+			## that there is a unit trying to leave the area
+			else:
+				info += u"There is no defender.\n"
+				leaving = board.get_units(area=conflict_area, types=('A', 'F'))
+				if len(leaving) > 1:
+					raise exceptions.WrongUnitCount
+				elif len(leaving) == 0:
+					## if the province is empty, invade it
+					info += u"Province is empty.\n"
+					if u_order.code == '-':
+						info += u"Invading %s.\n" % conflict_area
+						board.invade_area(u, conflict_area)
+					elif u_order.code == '=':
+						info += u"Converting into %s.\n" % u_order.type
+						board.convert(u, u_order.type)
+				else:
+					unit_leaving = leaving[0]
+					## if the area is not empty, and the unit in province
+					## is not a friend, and the attacker has supports
+					## it invades the area, and the unit in the province
+					## must retreat (if it invades another area, it mustnt).
+					if unit_leaving.player_id != u.player_id and s > 1:
+						info += u"There is a unit in %s, but attacker is supported.\n" % conflict_area
+						unit_leaving.must_retreat = u.area.code
+						if u_order.code == '-':
+							board.invade_area(u, unit_leaving.area)
+							info += u"Invading %s.\n" % unit_leaving.area
+						elif u_order.code == '=':
+							info += u"Converting into %s.\n" % u_order.type
+							board.convert(u, u_order.type)
+					## if the area is not empty, the invasion is conditioned
+					else:
+						info += u"Area is not empty and attacker isn't supported, or there is a friend\n"
+						info += u"%s movement is conditioned.\n" % u
+						inv = [u, conflict_area, '']
+						if u_order.code == '-':
+							info += u"%s might get empty.\n" % u.area
+							conditioned_origins.append(u.area)
+						elif u_order.code == '=':
+							inv[2] = u_order.type
+						conditioned_invasions.append(inv)
+		## in a first iteration, we solve the conditioned invasions directed
+		## to now empty areas
+		try_empty = True
+		while try_empty:
+			info += u"Looking for possible, conditioned invasions.\n"
+			try_empty = False
+			for ci in conditioned_invasions:
+				unit, area, conversion = ci
+				if board.province_is_empty(area):
+					info += u"Found empty area in %s.\n" % area
+					if unit.area in conditioned_origins:
+						conditioned_origins.remove(unit.area)
+					if conversion == '':
+						board.invade_area(unit, area)
+					else:
+						board.convert(unit, conversion)
+					conditioned_invasions.remove(ci)
+					try_empty = True
+					break
+		## in a second iteration, we cancel the conditioned invasions that
+		## cannot be made
+		try_impossible = True
+		while try_impossible:
+			info += u"Looking for impossible, conditioned.\n"
+			try_impossible = False
+			for ci in conditioned_invasions:
+				unit, area, conversion = ci
+				if not area in conditioned_origins:
+					info += u"Found impossible invasion in %s.\n" % area
+					board.mark_as_standoff(area)
+					conditioned_invasions.remove(ci)
+					if unit.area in conditioned_origins:
+						conditioned_origins.remove(unit.area)
+					try_impossible = True
+					break
+		## at this point, if there are any conditioned invasions, they form
+		## closed circuits, so all of them should be carried out
+		info += u"Resolving closed circuits.\n"
+		for unit, area, conversion in conditioned_invasions:
+			if conversion == '':
+				info += u"%s invades %s.\n" % (unit, area)
+				board.invade_area(unit, area)
+			else:
+				info += u"%s converts into %s.\n" % (unit, conversion)
+				board.convert(unit, conversion)
+		## units in 'holding' that don't need to retreat, can put rebellions down
+		for h in holding:
+			if must_retreat[h.id] != '':
+				continue
+			reb = board.has_rebellion(h.area, h.player_id, same=True)
+			if reb:
+				info += u"Rebellion in %s is put down.\n" % h.area
+				board.delete_rebellion(reb)
+		info += u"End of conflicts processing"
+		return info
+
+	def resolve_sieges(self):
+		info = u"Step 6: Process sieges.\n"
+		board = self.board
+		## get units that are besieging but do not besiege a second time
+		besiegers = []
+		for b in board.get_units():
+			order = board.get_order(b)
+			if order and order.code == 'B':
+				besiegers.append(b)
+			elif b.besieging:
+				info += u"Siege of %s is discontinued.\n" % b
+				b.besieging = False
+		for b in besiegers:
+			info += u"%s besieges " % b
+			mode = ''
+			if b.player_id in board.assassinated:
+				info += u"\n%s belongs to an assassinated player.\n" % b
+				continue
+			garrisons = board.get_units(area=b.area, types=('G',))
+			if len(garrisons) == 1:
+				mode = 'garrison'
+				defender = garrisons[0]
+			else:
+				reb = board.has_rebellion(b.area, b.player_id, same=True)
+				if reb and reb.garrisoned:
+					mode = 'rebellion'
+					info += u"a rebellion "
+				else:
+					info += u"Besieging an empty city. Ignoring.\n"
+					b.besieging = False
+					continue
+			if b.besieging:
+				info += u"for second time.\n"
+				b.besieging = False
+				info += u"Siege is successful. "
+				if mode == 'garrison':
+					info += u"Garrison disbanded.\n"
+					board.record('unit_surrendered', unit=defender)
+					board.delete_unit(defender)
+				elif mode == 'rebellion':
+					info += u"Rebellion is put down.\n"
+					board.delete_rebellion(reb)
+			else:
+				info += u"for first time.\n"
+				b.besieging = True
+				board.record('siege_started', unit=b)
+				if mode == 'garrison' and defender.player_id in board.assassinated:
+					info += u"Player is assassinated. Garrison surrenders\n"
+					board.record('unit_surrendered', unit=defender)
+					board.delete_unit(defender)
+					b.besieging = False
+			board.delete_order(b)
+		return info
+
+	def announce_retreats(self):
+		info = u"Step 7: Retreats\n"
+		board = self.board
+		for u in board.get_units():
+			if u.must_retreat != '':
+				info += u"%s must retreat.\n" % u
+				board.record('forced_to_retreat', unit=u)
+		return info
+
@@ -1,4 +1,10 @@
+from datetime import datetime, timedelta
+
 from django.contrib import admin
+from django.conf.urls.defaults import patterns, url
+from django.db.models import Sum, Avg, Max
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 
 from machiavelli.models import *
 from machiavelli.graphics import make_scenario_map
@@ -135,6 +141,44 @@ class TurnLogAdmin(admin.ModelAdmin):
 	list_display = ('game', 'timestamp')
 	list_filter = ('game',)
 
+class StepTimingAdmin(admin.ModelAdmin):
+	list_display = ('game', 'year', 'season', 'phase', 'step', 'seconds', 'queries', 'rows', 'timestamp')
+	list_filter = ('step', 'game')
+	date_hierarchy = 'timestamp'
+	ordering = ['-seconds']
+
+	def get_urls(self):
+		urls = super(StepTimingAdmin, self).get_urls()
+		my_urls = patterns('',
+			url(r'^slowest/$', self.admin_site.admin_view(self.slowest),
+				name='machiavelli_steptiming_slowest'),
+		)
+		return my_urls + urls
+
+	def slowest(self, request):
+		""" Shows the games that have needed more time to be processed, and
+		the cost of each step, in the last days. """
+		try:
+			days = int(request.GET.get('days', 7))
+		except ValueError:
+			days = 7
+		timings = StepTiming.objects.filter(timestamp__gte=datetime.now() - timedelta(days))
+		games = timings.values('game', 'game__slug').annotate(seconds=Sum('seconds'),
+						queries=Sum('queries')).order_by('-seconds')[:20]
+		steps = timings.values('step').annotate(average=Avg('seconds'),
+						maximum=Max('seconds'), queries=Avg('queries'),
+						rows=Avg('rows')).order_by('-average')
+		context = {'title': "Slowest games and steps",
+					'days': days,
+					'games': games,
+					'steps': steps, }
+		return render_to_response('admin/machiavelli/steptiming/slowest.html',
+							context,
+							context_instance=RequestContext(request))
+
+class RenderJobAdmin(admin.ModelAdmin):
+	list_display = ('game', 'requested', 'worker', 'started')
+
 class ExpenseAdmin(admin.ModelAdmin):
 	list_display = ('__unicode__', 'player', 'ducats', 'type', 'unit', 'area', 'confirmed')
 	list_filter = ('player', 'type',)
@@ -172,6 +216,8 @@ admin.site.register(Score, ScoreAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(RetreatOrder, RetreatOrderAdmin)
 admin.site.register(TurnLog, TurnLogAdmin)
+admin.site.register(StepTiming, StepTimingAdmin)
+admin.site.register(RenderJob, RenderJobAdmin)
 admin.site.register(Expense, ExpenseAdmin)
 admin.site.register(Rebellion, RebellionAdmin)
 admin.site.register(Loan, LoanAdmin)
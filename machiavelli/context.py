@@ -0,0 +1,127 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module builds the context that is shared by all the pages of a game.
+
+The data that only depends on the game (the enabled rules, whether a player
+has been excommunicated by the pope, and the last phase with events) is kept
+in the cache with the version of the game, so it is discarded whenever the
+game changes. The status of the player is computed by the methods of
+``Player``, with the data of the game and the karma of the user already read.
+
+``get_game_context`` runs at most ``QUERY_BUDGET`` queries, and only one when
+the data of the game is in the cache. The log and the whispers are querysets
+that are read when the template is rendered.
+"""
+
+from django.core.cache import cache
+from django.utils.translation import get_language
+
+import machiavelli.forms as forms
+
+## maximum number of queries run by get_game_context
+QUERY_BUDGET = 5
+
+def get_game_status(game):
+	""" Returns a dictionary with the data of the game that is shared by all
+	the players. """
+	from machiavelli.models import Player
+	from condottieri_events.models import EventSeason
+
+	## the names of the rules are translated
+	key = game.get_cache_key("status_%s" % get_language())
+	status = cache.get(key)
+	if status is None:
+		config = game.configuration
+		status = {
+			'rules': config.get_enabled_rules(),
+			'finances': config.finances,
+			'excommunication': config.excommunication,
+			'gossip': config.gossip,
+			'pope_excommunicated': Player.objects.filter(game=game,
+										pope_excommunicated=True).exists(),
+			'last_log': None,
+		}
+		## the events of the current season and phase are not shown
+		for turn in EventSeason.objects.filter(game=game, events__gt=0).values_list('year',
+										'season', 'phase'):
+			if turn[1:] != (game.season, game.phase):
+				status['last_log'] = turn
+				break
+		cache.set(key, status)
+	return status
+
+def get_player_status(game, player, status):
+	""" Returns a dictionary with the flags that describe what the player can
+	do now, from the methods of ``Player`` and the data in ``status``. """
+	from machiavelli.models import PHORDERS
+	from condottieri_profiles.models import CondottieriProfile
+
+	## the game is shared, so that the player does not read it again
+	player.game = game
+	flags = {
+		'can_excommunicate': player.can_excommunicate(status['excommunication'],
+											status['pope_excommunicated']),
+		'can_forgive': player.can_forgive(status['excommunication']),
+	}
+	if game.slots == 0 or game.phase == PHORDERS:
+		## the karma is not used in fast games
+		karma = None
+		if not game.fast:
+			karma = CondottieriProfile.objects.filter(user__id=player.user_id).values_list('karma',
+											flat=True)[0]
+		if game.slots == 0:
+			flags['time_exceeded'] = player.time_exceeded(karma)
+		if game.phase == PHORDERS:
+			if player.done and not player.in_last_seconds(karma):
+				flags['undoable'] = True
+	return flags
+
+def get_game_context(request, game, player):
+	""" Returns the context for the templates of the game pages. """
+	status = get_game_status(game)
+	context = {
+		'user': request.user,
+		'game': game,
+		'map' : game.get_map_url(),
+		'player': player,
+		'show_users': game.visible,
+		}
+	if game.slots > 0:
+		context['player_list'] = game.player_set.filter(user__isnull=False)
+	else:
+		context['player_list'] = game.player_list_ordered_by_cities()
+	if player:
+		context['done'] = player.done
+		if status['finances']:
+			context['ducats'] = player.ducats
+		context.update(get_player_status(game, player, status))
+	if status['last_log'] is None:
+		context['log'] = game.baseevent_set.none()
+	else:
+		year, season, phase = status['last_log']
+		context['log'] = game.baseevent_set.filter(year__exact=year,
+								season__exact=season,
+								phase__exact=phase)
+	if len(status['rules']) > 0:
+		context['rules'] = status['rules']
+	if status['gossip']:
+		context['whispers'] = game.whisper_set.all()[:10]
+		if player:
+			context['whisper_form'] = forms.WhisperForm(request.user, game)
+	return context
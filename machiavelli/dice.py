@@ -16,18 +16,72 @@
 ##
 ## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
 
-from random import random, randint
+""" This module defines the dice used in the games.
+
+Each game rolls its own ``Dice``, seeded with the seed of the game and the
+phase being processed, so that processing the same phase again gives the
+same results, and games processed in parallel do not share a random
+generator. The steps of ``Game`` that roll dice use ``Game.get_dice`` when
+they are not given one. The module functions use ``shared_dice``, which is
+not seeded.
+"""
+
+import random as _random
+from hashlib import md5
 from math import pow
 
+class Dice(object):
+	""" A stream of dice rolls. If ``record`` is True, each roll is kept in
+	``rolls`` as a (reason, result) tuple. """
+
+	def __init__(self, seed=None, record=False):
+		self.seed = seed
+		if seed is None:
+			self.random = _random.Random()
+		else:
+			## the hash of a string depends on the platform, so it is not
+			## used as the seed
+			self.random = _random.Random(long(md5(str(seed)).hexdigest(), 16))
+		self.record = record
+		self.rolls = []
+
+	def _record(self, reason, result):
+		if self.record:
+			self.rolls.append((reason, result))
+		return result
+
+	def roll_1d6(self, reason=''):
+		return self._record(reason, self.random.randint(1, 6))
+
+	def roll_2d6(self, reason=''):
+		return self._record(reason, self.random.randint(1, 6) + self.random.randint(1, 6))
+
+	def check_one_six(self, dice=1, reason=''):
+		""" Rolls ``dice`` dice and returns True if at least one of them is a
+		six. """
+		assert isinstance(dice, int)
+		assert dice > 0
+		prob = 1. - pow(5./6., dice)
+		rand = self.random.random()
+		return self._record(reason, rand <= prob)
+
+	def choice(self, seq, reason=''):
+		return self._record(reason, self.random.choice(seq))
+
+	def format_rolls(self):
+		""" Returns the recorded rolls as text, one per line. """
+		lines = []
+		for reason, result in self.rolls:
+			lines.append(u"%s: %s" % (reason, result))
+		return u"\n".join(lines)
+
+shared_dice = Dice()
+
 def roll_1d6():
-	return randint(1, 6)
+	return shared_dice.roll_1d6()
 
 def roll_2d6():
-	return randint(1, 6) + randint(1, 6)
+	return shared_dice.roll_2d6()
 
 def check_one_six(dice=1):
-	assert isinstance(dice, int)
-	assert dice > 0
-	prob = 1. - pow(5./6., dice)
-	rand = random()
-	return rand <= prob
+	return shared_dice.check_one_six(dice)
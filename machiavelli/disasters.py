@@ -67,38 +67,39 @@ STORM_TABLE = [
 [''     , ''     , ''     , ''     , ''     , ''     , ''     , 'LA'   , ''     , ''     , ''     ],
 ]
 
-def get_year():
+def get_year(rng=dice.shared_dice, reason=''):
 	""" Returns an int (1-6) that will be used to determine if the year is *good*, *bad* or *very bad*, regarding natural disasters.
 	"""
 
-	return dice.roll_1d6()
+	return rng.roll_1d6("%s year" % reason)
 
-def get_row(year):
+def get_row(year, rng=dice.shared_dice, reason=''):
 	""" If the year roll is 2, 3 or 6, returns a row index (0-10).
 	"""
 
 	if year in [2, 3, 6]:
-		return dice.roll_2d6() - 2
+		return rng.roll_2d6("%s row" % reason) - 2
 	else:
 		return False
 
-def get_column(year):
+def get_column(year, rng=dice.shared_dice, reason=''):
 	""" If the year roll is 4, 5, or 6, returns a column index (0-10).
 	"""
 
 	if year in [4, 5, 6]:
-		return dice.roll_2d6() - 2
+		return rng.roll_2d6("%s column" % reason) - 2
 	else:
 		return False
 
-def get_provinces(table):
+def get_provinces(table, rng=dice.shared_dice, reason=''):
 	""" Returns a list of province codes that will be affected by a natural
-	disaster in the current season.
+	disaster in the current season. The dice are rolled with ``rng``, a
+	``machiavelli.dice.Dice``.
 	"""
 
-	year = get_year()
-	row = get_row(year)
-	column = get_column(year)
+	year = get_year(rng, reason)
+	row = get_row(year, rng, reason)
+	column = get_column(year, rng, reason)
 	provinces = []
 	if row:	
 		for p in table[row]:
@@ -108,15 +109,15 @@ def get_provinces(table):
 			provinces.append(r[column])
 	return provinces
 
-def get_plague():
+def get_plague(rng=dice.shared_dice):
 	""" A proxy function to call ``get_provinces`` with ``PLAGUE_TABLE``. """
-	return get_provinces(PLAGUE_TABLE)
+	return get_provinces(PLAGUE_TABLE, rng, "Plague")
 
-def get_famine():
+def get_famine(rng=dice.shared_dice):
 	""" A proxy function to call ``get_provinces`` with ``FAMINE_TABLE``. """
-	return get_provinces(FAMINE_TABLE)
+	return get_provinces(FAMINE_TABLE, rng, "Famine")
 
-def get_storms():
+def get_storms(rng=dice.shared_dice):
 	""" A proxy function to call ``get_provinces`` with ``STORM_TABLE``. """
-	return get_provinces(STORM_TABLE)
+	return get_provinces(STORM_TABLE, rng, "Storms")
 
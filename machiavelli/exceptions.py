@@ -28,3 +28,10 @@ class WrongUnitCount(Error):
 
 	pass
 
+
+class WrongOrderCount(Error):
+	""" Raised when a unit has more than one order while the orders are being
+	processed. """
+
+	pass
+
@@ -5,9 +5,11 @@ from django.utils.safestring import mark_safe
 from django.db.models import Q
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.utils.translation import ugettext_lazy as _
+from django.utils import simplejson
 from django.conf import settings
 
 from machiavelli.models import *
+import machiavelli.orders as orders
 
 CITIES_TO_WIN = (
 	(15, _('Normal game (15 cities)')),
@@ -104,8 +106,14 @@ def make_order_form(player):
 		units_qs = Unit.objects.filter(Q(player=player) | Q(id__in=bought_ids))
 	else:
 		units_qs = player.unit_set.select_related().all()
-	all_units = player.game.get_all_units()
-	all_areas = player.game.get_all_gameareas()
+	all_units = Unit.objects.filter(player__game=player.game)
+	all_areas = GameArea.objects.filter(game=player.game)
+	## the choices are cached, the querysets are only used to validate
+	unit_choices = [('', u"---------"),] + player.game.get_all_units()
+	area_choices = [('', u"---------"),] + player.game.get_all_gameareas()
+	## orders that the units can be given, also used by order_form.js
+	legal_json = orders.get_legal_orders(player.game)
+	legal = simplejson.loads(legal_json)
 	
 	class OrderForm(forms.ModelForm):
 		unit = forms.ModelChoiceField(queryset=units_qs, label=_("Unit"))
@@ -120,6 +128,10 @@ def make_order_form(player):
 		def __init__(self, player, **kwargs):
 			super(OrderForm, self).__init__(**kwargs)
 			self.instance.player = player
+			self.legal_orders = legal_json
+			self.fields['destination'].choices = area_choices
+			self.fields['subunit'].choices = unit_choices
+			self.fields['subdestination'].choices = area_choices
 		
 		class Meta:
 			model = Order
@@ -174,6 +186,9 @@ def make_order_form(player):
 						raise forms.ValidationError(_("You must select a unit type for the supported unit"))
 					if subtype == subunit.type:
 						raise forms.ValidationError(_("A unit must convert into a different type"))
+			if unit and not orders.check_order(legal, unit, code, destination, type,
+											subunit, subcode, subdestination):
+				raise forms.ValidationError(_("This order is not possible"))
 
 			## set to None the fields that are not needed
 			if code in ['H', '-', '=', 'B']:
@@ -0,0 +1,141 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps an in-memory index of the borders between areas.
+
+The board does not change during a game, so the borders are read from the
+database only once per process. The index is invalidated when an ``Area`` is
+saved or deleted, or when its borders change. The version of the index is also
+stored in the cache, so that the other processes rebuild it too. Each process
+reads that version at most once every ``CHECK_INTERVAL`` seconds, so that the
+adjacency checks do not need a round-trip to the cache.
+"""
+
+import time
+
+from django.core.cache import cache
+
+## pairs of areas that are adjacent, but their coasts are not
+ONLY_ARMIES = [
+	('AVI', 'PRO'),
+	('PISA', 'SIE'),
+	('CAP', 'AQU'),
+	('NAP', 'AQU'),
+	('SAL', 'AQU'),
+	('SAL', 'BARI'),
+	('HER', 'ALB'),
+	('BOL', 'MOD'),
+	('BOL', 'LUC'),
+	('CAR', 'CRO'),
+]
+
+VERSION_KEY = "adjacency-graph-version"
+## seconds between two checks of the version in the cache
+CHECK_INTERVAL = 10
+
+class AdjacencyGraph(object):
+	""" The borders between areas, with separate sets for armies and fleets.
+	All the areas are referenced by their id. """
+
+	def __init__(self, codes, borders, version=None):
+		""" ``codes`` maps the id of each area to its code, and ``borders`` is
+		a list of pairs of ids of adjacent areas. """
+		self.version = version
+		self.codes = codes
+		self.ids = {}
+		self.army = {}
+		self.fleet = {}
+		for id, code in codes.items():
+			self.ids[code] = id
+			self.army[id] = set()
+			self.fleet[id] = set()
+		for a, b in borders:
+			self.army[a].add(b)
+			self.army[b].add(a)
+			if (codes[a], codes[b]) in ONLY_ARMIES or (codes[b], codes[a]) in ONLY_ARMIES:
+				continue
+			self.fleet[a].add(b)
+			self.fleet[b].add(a)
+
+	def get_borders(self, area_id, fleet=False):
+		""" Returns the set of ids of the areas adjacent to an area. """
+		if fleet:
+			return self.fleet.get(area_id, set())
+		return self.army.get(area_id, set())
+
+	def is_adjacent(self, area_id, other_id, fleet=False):
+		""" Two areas can be adjacent through land, but not through a coast. """
+		return other_id in self.get_borders(area_id, fleet)
+
+	def find_convoy_path(self, origin, destination, convoy_areas):
+		""" Returns the list of ids of the areas in the shortest line from
+		``origin`` to ``destination`` that only goes through the areas in
+		``convoy_areas``, or an empty list if there is no such line. """
+		parents = {origin: None}
+		origins = [origin,]
+		while len(origins) > 0:
+			new_origins = []
+			for o in origins:
+				for b in self.get_borders(o):
+					if b == destination:
+						path = [b,]
+						while o is not None:
+							path.append(o)
+							o = parents[o]
+						path.reverse()
+						return path
+					if b in convoy_areas and not b in parents:
+						parents[b] = o
+						new_origins.append(b)
+			origins = new_origins
+		return []
+
+_graph = None
+## when the version of the graph was last checked
+_checked = 0
+
+def build_graph(version=None):
+	""" Reads all the areas and their borders with two queries. """
+	from machiavelli.models import Area
+
+	codes = dict(Area.objects.values_list('id', 'code'))
+	borders = Area.borders.through.objects.values_list('from_area', 'to_area')
+	return AdjacencyGraph(codes, borders, version)
+
+def get_graph():
+	""" Returns the adjacency graph of this process, building it if it does not
+	exist or if it has been invalidated in other process. """
+	global _graph, _checked
+	now = time.time()
+	if _graph is None or now - _checked > CHECK_INTERVAL:
+		version = cache.get(VERSION_KEY)
+		_checked = now
+		if _graph is None or _graph.version != version:
+			_graph = build_graph(version)
+	return _graph
+
+def invalidate_graph(sender=None, **kwargs):
+	""" Discards the adjacency graph. It is connected to the signals sent when
+	an ``Area`` or its borders change. """
+	global _graph
+	_graph = None
+	try:
+		cache.incr(VERSION_KEY)
+	except ValueError:
+		cache.set(VERSION_KEY, 1)
+
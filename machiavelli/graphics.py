@@ -16,12 +16,23 @@
 ##
 ## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
 
-""" This module defines functions to generate the map. """
+""" This module defines functions to generate the map.
+
+The decoded token images, the coordinates of the tokens and the static layer
+of each scenario (base map, disabled areas and city incomes) are kept in
+process-level caches, so that each new map only needs to paint the dynamic
+layer of the game. As in ``machiavelli.graph``, a version is stored in the
+cache, so that the other processes, like the ``render_maps`` workers, empty
+their caches too.
+"""
 
 import Image
 import os
 
 from django.conf import settings
+from django.core.cache import cache
+
+import machiavelli.scenarios as scenarios
 
 BASEDIR=os.path.join(settings.PROJECT_ROOT, 'machiavelli/media/machiavelli/tokens')
 BASEMAP='base-map.png'
@@ -30,160 +41,235 @@ if settings.DEBUG:
 else:
 	MAPSDIR = os.path.join(settings.MEDIA_ROOT, 'maps')
 
+## filename -> decoded Image
+_tokens = {}
+## board area id -> dictionary with the coordinates of each kind of token
+_coordinates = {}
+## scenario id -> Image with the static layer of the scenario
+_static_layers = {}
+
+VERSION_KEY = "map-layers-version"
+## version of the caches of this process
+_version = None
+
+def _empty_caches():
+	_tokens.clear()
+	_coordinates.clear()
+	_static_layers.clear()
+
+def clear_cache(sender=None, **kwargs):
+	""" Empties the caches of the module. It is connected to the signals
+	sent when the tokens or the scenarios change. """
+	_empty_caches()
+	try:
+		cache.incr(VERSION_KEY)
+	except ValueError:
+		cache.set(VERSION_KEY, 1)
+
+def check_version():
+	""" Empties the caches of the module if they have been invalidated in
+	other process. """
+	global _version
+	version = cache.get(VERSION_KEY)
+	if version != _version:
+		_empty_caches()
+		_version = version
+
+def get_token(filename):
+	""" Returns the decoded image of a token. The image is shared, so it must
+	not be modified. """
+	if not filename in _tokens:
+		token = Image.open(os.path.join(BASEDIR, filename))
+		token.load()
+		_tokens[filename] = token
+	return _tokens[filename]
+
+def get_coordinates():
+	""" Returns a dictionary with the coordinates of the control, garrison and
+	army/fleet tokens of each board area. """
+	from machiavelli.models import ControlToken, GToken, AFToken
+
+	if len(_coordinates) == 0:
+		for kind, model in (('control', ControlToken), ('g', GToken), ('af', AFToken)):
+			for area, x, y in model.objects.values_list('area', 'x', 'y'):
+				_coordinates.setdefault(area, {})[kind] = (x, y)
+	return _coordinates
+
+def get_static_layer(scenario):
+	""" Returns a copy of the base map with the disabled areas and the special
+	city incomes of the scenario. The version of the caches is checked here,
+	once for each map. """
+	check_version()
+	if not scenario.id in _static_layers:
+		template = scenarios.get_template(scenario.id)
+		coords = get_coordinates()
+		layer = Image.open(os.path.join(BASEDIR, BASEMAP))
+		layer.load()
+		## if there are disabled areas, mark them
+		marker = get_token("disabled.png")
+		for a in template.disabled_ids:
+			layer.paste(marker, coords[a]['af'], marker)
+		## mark special city incomes
+		marker = get_token("chest.png")
+		for c in template.majors:
+			x, y = coords[c]['g']
+			layer.paste(marker, (x + 48, y), marker)
+		_static_layers[scenario.id] = layer
+	return _static_layers[scenario.id].copy()
+
 def make_map(game):
-	""" Opens the base map and add flags, control markers, unit tokens and other tokens. Then saves
-	the map with an appropriate name in the maps directory.
+	""" Takes the static layer of the scenario and adds flags, control markers,
+	unit tokens and other tokens. Then saves the map with an appropriate name
+	in the maps directory.
 	"""
-	base_map = Image.open(os.path.join(BASEDIR, BASEMAP))
-	if game.configuration.special_units:
-		loyal_army = Image.open("%s/loyal-army.png" % BASEDIR)
-		loyal_fleet = Image.open("%s/loyal-fleet.png" % BASEDIR)
-		loyal_garrison = Image.open("%s/loyal-garrison.png" % BASEDIR)
-		elite_army = Image.open("%s/elite-army.png" % BASEDIR)
-		elite_fleet = Image.open("%s/elite-fleet.png" % BASEDIR)
-		elite_garrison = Image.open("%s/elite-garrison.png" % BASEDIR)
-	## if there are disabled areas, mark them
-	marker = Image.open("%s/disabled.png" % BASEDIR)
-	for a in game.get_disabled_areas():
-		base_map.paste(marker, (a.aftoken.x, a.aftoken.y), marker)
-	## mark special city incomes
-	marker = Image.open("%s/chest.png" % BASEDIR)
-	for i in game.scenario.cityincome_set.all():
-		base_map.paste(marker, (i.city.gtoken.x + 48, i.city.gtoken.y), marker)
-	##
-	garrisons = []
-	for player in game.player_set.filter(user__isnull=False):
+	from machiavelli.models import Unit
+
+	base_map = get_static_layer(game.scenario)
+	coords = get_coordinates()
+	homes = scenarios.get_template(game.scenario_id).home_country
+	config = game.configuration
+	## read the dynamic layer
+	players = game.player_set.values_list('id', 'user', 'country', 'country__css_class')
+	controls = {}
+	famine = []
+	storm = []
+	for area, player, is_famine, is_storm in game.gamearea_set.values_list('board_area',
+										'player', 'famine', 'storm'):
+		if player:
+			controls.setdefault(player, []).append(area)
+		if is_famine:
+			famine.append(area)
+		if is_storm:
+			storm.append(area)
+	units = {}
+	for unit in Unit.objects.filter(player__game=game).values_list('player', 'type',
+								'area__board_area', 'besieging', 'power', 'loyalty'):
+		units.setdefault(unit[0], []).append(unit[1:])
+	for id, user, country, css_class in players:
+		if not user:
+			continue
 		## paste control markers
-		controls = player.gamearea_set.all()
-		marker = Image.open("%s/control-%s.png" % (BASEDIR, player.country.css_class))
-		for area in controls:
-			base_map.paste(marker, (area.board_area.controltoken.x, area.board_area.controltoken.y), marker)
+		marker = get_token("control-%s.png" % css_class)
+		for area in controls.get(id, []):
+			base_map.paste(marker, coords[area]['control'], marker)
 		## paste flags
-		home = player.home_country()
-		flag = Image.open("%s/flag-%s.png" % (BASEDIR, player.country.css_class))
-		for game_area in home:
-			area = game_area.board_area
-			base_map.paste(flag, (area.controltoken.x, area.controltoken.y - 15), flag)
+		flag = get_token("flag-%s.png" % css_class)
+		for area in homes.get(country, []):
+			x, y = coords[area]['control']
+			base_map.paste(flag, (x, y - 15), flag)
 		## paste As and Fs (not garrisons because of sieges)
-		units = player.unit_set.all()
-		army = Image.open("%s/A-%s.png" % (BASEDIR, player.country.css_class))
-		fleet = Image.open("%s/F-%s.png" % (BASEDIR, player.country.css_class))
-		for unit in units:
-			if unit.besieging:
-				coords = (unit.area.board_area.gtoken.x, unit.area.board_area.gtoken.y)
-			else:
-				coords = (unit.area.board_area.aftoken.x, unit.area.board_area.aftoken.y)
-			if unit.type == 'A':
-				base_map.paste(army, coords, army)
-				if unit.power > 1:
-					base_map.paste(elite_army, coords, elite_army)
-				if unit.loyalty > 1:
-					base_map.paste(loyal_army, coords, loyal_army)
-			elif unit.type == 'F':
-				base_map.paste(fleet, coords, fleet)
-				if unit.power > 1:
-					base_map.paste(elite_fleet, coords, elite_fleet)
-				if unit.loyalty > 1:
-					base_map.paste(loyal_fleet, coords, loyal_fleet)
+		for type, area, besieging, power, loyalty in units.get(id, []):
+			if type == 'G':
+				continue
+			if besieging:
+				xy = coords[area]['g']
 			else:
-				pass
+				xy = coords[area]['af']
+			token = get_token("%s-%s.png" % (type, css_class))
+			base_map.paste(token, xy, token)
+			if power > 1:
+				elite = get_token("elite-%s.png" % (type == 'A' and 'army' or 'fleet'))
+				base_map.paste(elite, xy, elite)
+			if loyalty > 1:
+				loyal = get_token("loyal-%s.png" % (type == 'A' and 'army' or 'fleet'))
+				base_map.paste(loyal, xy, loyal)
 	## paste garrisons
-	for player in game.player_set.all():
-		if player.user:
-			garrison = Image.open("%s/G-%s.png" % (BASEDIR, player.country.css_class))
+	for id, user, country, css_class in players:
+		if user:
+			garrison = get_token("G-%s.png" % css_class)
 		else:
 			## autonomous
-			garrison = Image.open("%s/G-autonomous.png" % BASEDIR)
-		for unit in player.unit_set.filter(type__exact='G'):
-			coords = (unit.area.board_area.gtoken.x, unit.area.board_area.gtoken.y)
-			base_map.paste(garrison, coords, garrison)
-			if unit.power > 1:
-				base_map.paste(elite_garrison, coords, elite_garrison)
-			if unit.loyalty > 1:
-				base_map.paste(loyal_garrison, coords, loyal_garrison)
+			garrison = get_token("G-autonomous.png")
+		for type, area, besieging, power, loyalty in units.get(id, []):
+			if type != 'G':
+				continue
+			xy = coords[area]['g']
+			base_map.paste(garrison, xy, garrison)
+			if power > 1:
+				elite = get_token("elite-garrison.png")
+				base_map.paste(elite, xy, elite)
+			if loyalty > 1:
+				loyal = get_token("loyal-garrison.png")
+				base_map.paste(loyal, xy, loyal)
 	## paste famine markers
-	if game.configuration.famine:
-		famine = Image.open("%s/famine-marker.png" % BASEDIR)
-		for a in game.gamearea_set.filter(famine=True):
-			coords = (a.board_area.aftoken.x + 16, a.board_area.aftoken.y + 16)
-			base_map.paste(famine, coords, famine)
+	if config.famine:
+		marker = get_token("famine-marker.png")
+		for area in famine:
+			x, y = coords[area]['af']
+			base_map.paste(marker, (x + 16, y + 16), marker)
 	## paste storm markers
-	if game.configuration.storms:
-		storm = Image.open("%s/storm-marker.png" % BASEDIR)
-		for a in game.gamearea_set.filter(storm=True):
-			coords = (a.board_area.aftoken.x + 16, a.board_area.aftoken.y + 16)
-			base_map.paste(storm, coords, storm)
+	if config.storms:
+		marker = get_token("storm-marker.png")
+		for area in storm:
+			x, y = coords[area]['af']
+			base_map.paste(marker, (x + 16, y + 16), marker)
 	## paste rebellion markers
-	if game.configuration.finances:
-		rebellion_marker = Image.open("%s/rebellion-marker.png" % BASEDIR)
-		for r in game.get_rebellions():
-			if r.garrisoned:
-				coords = (r.area.board_area.gtoken.x, r.area.board_area.gtoken.y)
+	if config.finances:
+		marker = get_token("rebellion-marker.png")
+		for area, garrisoned in game.get_rebellions().values_list('area__board_area',
+																'garrisoned'):
+			if garrisoned:
+				xy = coords[area]['g']
 			else:
-				coords = (r.area.board_area.aftoken.x, r.area.board_area.aftoken.y)
-			base_map.paste(rebellion_marker, coords, rebellion_marker)
+				xy = coords[area]['af']
+			base_map.paste(marker, xy, marker)
 	## save the map
 	result = base_map #.resize((1250, 1780), Image.ANTIALIAS)
 	filename = os.path.join(MAPSDIR, "map-%s.jpg" % game.pk)
 	result.save(filename)
-	make_thumb(filename, 187, 267, "thumbnails")
+	make_thumb(filename, 187, 267, "thumbnails", result)
 	return True
 
 def make_scenario_map(s):
 	""" Makes the initial map for an scenario.
 	"""
-	base_map = Image.open(os.path.join(BASEDIR, BASEMAP))
-	## if there are disabled areas, mark them
-	marker = Image.open("%s/disabled.png" % BASEDIR)
-	for d in  s.disabledarea_set.all():
-		base_map.paste(marker, (d.area.aftoken.x, d.area.aftoken.y), marker)
-	## mark special city incomes
-	marker = Image.open("%s/chest.png" % BASEDIR)
-	for i in s.cityincome_set.all():
-		base_map.paste(marker, (i.city.gtoken.x + 48, i.city.gtoken.y), marker)
+	## the scenario may have changed, so the static layer is made again
+	if s.id in _static_layers:
+		del _static_layers[s.id]
+	base_map = get_static_layer(s)
+	template = scenarios.get_template(s.id)
+	coords = get_coordinates()
 	##
-	for c in s.get_countries():
+	for country, static_name in template.countries.items():
 		## paste control markers and flags
-		controls = s.home_set.filter(country=c, is_home=True)
-		marker = Image.open("%s/control-%s.png" % (BASEDIR, c.static_name))
-		flag = Image.open("%s/flag-%s.png" % (BASEDIR, c.static_name))
-		for h in controls:
-			base_map.paste(marker, (h.area.controltoken.x, h.area.controltoken.y), marker)
-			base_map.paste(flag, (h.area.controltoken.x, h.area.controltoken.y - 15), flag)
-		## paste units
-		army = Image.open("%s/A-%s.png" % (BASEDIR, c.static_name))
-		fleet = Image.open("%s/F-%s.png" % (BASEDIR, c.static_name))
-		garrison = Image.open("%s/G-%s.png" % (BASEDIR, c.static_name))
-		for setup in c.setup_set.filter(scenario=s):
-			if setup.unit_type == 'G':
-				coords = (setup.area.gtoken.x, setup.area.gtoken.y)
-				base_map.paste(garrison, coords, garrison)
-			elif setup.unit_type == 'A':
-				coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-				base_map.paste(army, coords, army)
-			elif setup.unit_type == 'F':
-				coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-				base_map.paste(fleet, coords, fleet)
-			else:
-				pass
-	## paste autonomous garrisons
-	garrison = Image.open("%s/G-autonomous.png" % BASEDIR)
-	for g in s.setup_set.filter(country__isnull=True, unit_type='G'):
-		coords = (g.area.gtoken.x, g.area.gtoken.y)
-		base_map.paste(garrison, coords, garrison)
+		marker = get_token("control-%s.png" % static_name)
+		flag = get_token("flag-%s.png" % static_name)
+		for area in template.home_country.get(country, ()):
+			x, y = coords[area]['control']
+			base_map.paste(marker, (x, y), marker)
+			base_map.paste(flag, (x, y - 15), flag)
+	## paste units
+	for country, area, unit_type in template.setups:
+		if country is None:
+			if unit_type != 'G':
+				continue
+			static_name = "autonomous"
+		elif country in template.countries:
+			static_name = template.countries[country]
+		else:
+			continue
+		token = get_token("%s-%s.png" % (unit_type, static_name))
+		if unit_type == 'G':
+			base_map.paste(token, coords[area]['g'], token)
+		elif unit_type in ('A', 'F'):
+			base_map.paste(token, coords[area]['af'], token)
 	## save the map
 	result = base_map #.resize((1250, 1780), Image.ANTIALIAS)
 	filename = os.path.join(MAPSDIR, "scenario-%s.jpg" % s.pk)
 	result.save(filename)
-	make_thumb(filename, 187, 267, "thumbnails")
-	make_thumb(filename, 625, 890, "625x890")
+	make_thumb(filename, 187, 267, "thumbnails", result)
+	make_thumb(filename, 625, 890, "625x890", result)
 	return True
 
-def make_thumb(fd, w, h, dirname):
-	""" Make a thumbnail of the map image """
+def make_thumb(fd, w, h, dirname, image=None):
+	""" Make a thumbnail of the map image. If the image is given, it is not
+	read again from the file. """
 	size = w, h
 	filename = os.path.split(fd)[1]
 	outfile = os.path.join(MAPSDIR, dirname, filename)
-	im = Image.open(fd)
+	if image:
+		im = image.copy()
+	else:
+		im = Image.open(fd)
 	im.thumbnail(size, Image.ANTIALIAS)
 	im.save(outfile, "JPEG")
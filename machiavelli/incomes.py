@@ -0,0 +1,138 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module calculates the income of all the players in a game at once.
+
+The areas, units and rebellions of the game are read with a constant number of
+queries, and the income of each player is computed in memory, following the
+same rules as the income methods of ``Player``. The ducats are then added with
+one update for each different amount of income.
+"""
+
+from django.db.models import F
+
+import machiavelli.finances as finances
+import machiavelli.scenarios as scenarios
+
+class Income(object):
+	""" The income of a player in a turn, by its source. """
+
+	def __init__(self, player):
+		self.player = player
+		self.control = 0
+		self.occupation = 0
+		self.garrisons = 0
+		self.variable = 0
+
+	def total(self):
+		return self.control + self.occupation + self.garrisons + self.variable
+
+	def __unicode__(self):
+		return u"control %s, occupation %s, garrisons %s, variable %s" % (
+			self.control, self.occupation, self.garrisons, self.variable)
+
+def get_incomes(game, die):
+	""" Returns a list with the ``Income`` of each player that is playing the
+	game, given the column of the variable income. """
+	from machiavelli.models import GameArea, Unit, Rebellion
+
+	## ids of the major cities that generate variable income
+	majors = scenarios.get_template(game.scenario_id).majors
+	## game area id -> (player, famine, board area id, code, control, garrison)
+	areas = {}
+	for row in GameArea.objects.filter(game=game).values_list('id', 'player',
+				'famine', 'board_area', 'board_area__code',
+				'board_area__control_income', 'board_area__garrison_income'):
+		areas[row[0]] = row[1:]
+	units = Unit.objects.filter(player__game=game).values_list('player', 'type',
+				'area', 'besieging')
+	## board areas where a garrison is under siege
+	sieges = set()
+	for player, type, area, besieging in units:
+		if besieging:
+			sieges.add(areas[area][2])
+	## player id -> ids of the game areas in rebellion
+	rebellions = {}
+	for player, area in Rebellion.objects.filter(player__game=game).values_list('player', 'area'):
+		rebellions.setdefault(player, set()).add(area)
+	all_players = list(game.player_set.select_related('country'))
+
+	incomes = []
+	for p in all_players:
+		if p.user_id is None or p.eliminated:
+			continue
+		p.game = game
+		income = Income(p)
+		rebellion_ids = rebellions.get(p.id, set())
+		## control income of the controlled areas, without famine or rebellion
+		for id, (player, famine, board_area, code, control, garrison) in areas.items():
+			if player != p.id or famine or id in rebellion_ids:
+				continue
+			income.control += control
+			if board_area in majors:
+				income.control += finances.get_ducats(code, die)
+		## occupation and garrisons income
+		garrisons = set()
+		for player, type, area, besieging in units:
+			if player != p.id:
+				continue
+			owner, famine, board_area = areas[area][:3]
+			if type == 'G':
+				if owner != p.id or famine or area in rebellion_ids:
+					garrisons.add(area)
+			elif owner != p.id and not famine:
+				income.occupation += 1
+		for area in garrisons:
+			board_area, code, control, garrison = areas[area][2:]
+			if board_area in sieges:
+				continue
+			income.garrisons += garrison
+			if board_area in majors:
+				income.garrisons += finances.get_ducats(code, die)
+		## variable income, including the one of the conquered countries
+		income.variable = finances.get_ducats(p.static_name, die, p.double_income)
+		if game.configuration.conquering:
+			for c in all_players:
+				if c.conqueror_id == p.id:
+					income.variable += finances.get_ducats(c.static_name, die, c.double_income)
+		incomes.append(income)
+	return incomes
+
+def add_incomes(incomes):
+	""" Adds the incomes to the treasuries of the players, with one update for
+	each different amount, and sends the ``income_raised`` signals with the
+	parts of each income. """
+	from machiavelli.models import Player, signals
+
+	by_amount = {}
+	for income in incomes:
+		d = income.total()
+		if d > 0:
+			by_amount.setdefault(d, []).append(income.player.id)
+	for d, ids in by_amount.items():
+		Player.objects.filter(id__in=ids).update(ducats=F('ducats') + d)
+	for income in incomes:
+		d = income.total()
+		if d > 0:
+			income.player.ducats += d
+			if signals:
+				signals.income_raised.send(sender=income.player, ducats=d,
+										control=income.control,
+										occupation=income.occupation,
+										garrisons=income.garrisons,
+										variable=income.variable)
@@ -18,42 +18,185 @@
 
 """ This module defines functions to log some info about the game flow.
 
-At the moment, only a XML snapshot of each turn status is saved. It's useful
-if an error happens and we have to restore a previous turn.
+At the moment, only a snapshot of the status of the game is saved before and
+after each phase is processed. It's useful if an error happens and we have to
+restore a previous turn, and to replay the turns when the adjudication changes.
+
+The snapshots of a game are appended to a file, one JSON object per line. Each
+snapshot has the units, orders, retreats, rebellions, loans, expenses and
+assassination attempts of the game, and the status of its players and areas.
+Another file keeps an index with the position of each snapshot in the first
+one, so that any of them can be read without parsing the others.
 """
 
 import os
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import simplejson
+
+import machiavelli.signals as signals
 
 SNAPSHOTS_DIR = os.path.join(settings.PROJECT_ROOT, 'machiavelli/media/machiavelli/maps/snapshots')
 
-def save_snapshot(game):
-	""" Saves a XML snapshot of the current status of ``game``. """
+## objects that are deleted and inserted again when a snapshot is restored,
+## with the lookup to filter them by game and the fields that are saved
+SNAPSHOT_TABLES = (
+	('units', 'Unit', 'player__game', ('id', 'type', 'area', 'player',
+		'besieging', 'must_retreat', 'placed', 'paid', 'cost', 'power', 'loyalty')),
+	('orders', 'Order', 'unit__player__game', ('id', 'unit', 'code',
+		'destination', 'type', 'suborder', 'subunit', 'subcode', 'subdestination',
+		'subtype', 'confirmed', 'player')),
+	('retreats', 'RetreatOrder', 'unit__player__game', ('id', 'unit', 'area')),
+	('rebellions', 'Rebellion', 'area__game', ('id', 'area', 'player', 'garrisoned')),
+	('loans', 'Loan', 'player__game', ('id', 'player', 'debt', 'season', 'year')),
+	('expenses', 'Expense', 'player__game', ('id', 'player', 'ducats', 'type',
+		'area', 'unit', 'confirmed')),
+	('assassinations', 'Assassination', 'killer__game', ('id', 'killer', 'target',
+		'ducats')),
+)
+
+## objects that are only updated when a snapshot is restored
+SNAPSHOT_UPDATES = (
+	('players', 'Player', 'game', ('id', 'country', 'static_name',
+		'double_income', 'may_excommunicate', 'done', 'eliminated', 'conqueror',
+		'excommunicated', 'assassinated', 'defaulted', 'ducats',
+		'is_excommunicated', 'pope_excommunicated', 'has_sentenced')),
+	('areas', 'GameArea', 'game', ('id', 'board_area', 'player', 'standoff',
+		'famine', 'storm')),
+)
+
+def get_snapshot_paths(game_id):
+	""" Returns the paths of the snapshots file and the index of a game. """
+	path = os.path.join(SNAPSHOTS_DIR, "%s.jsonl" % game_id)
+	return path, "%s.index" % path
+
+def make_snapshot(game):
+	""" Returns a dictionary with the current status of ``game``, reading each
+	table with a single query. """
+	from machiavelli import models
 
-	filename = "%s.snap" % game.id
+	snapshot = {
+		'game': game.id,
+		'scenario': game.scenario_id,
+		'year': game.year,
+		'season': game.season,
+		'phase': game.phase,
+		'dice_seed': game.dice_seed,
+	}
+	config = models.Configuration.objects.filter(game=game).values()[0]
+	del config['id'], config['game_id']
+	snapshot['configuration'] = config
+	autonomous = game.player_set.filter(user__isnull=True)
+	snapshot['autonomous'] = list(autonomous.values_list('id', flat=True))
+	for key, model, lookup, fields in SNAPSHOT_UPDATES + SNAPSHOT_TABLES:
+		objects = getattr(models, model).objects.filter(**{lookup: game})
+		snapshot[key] = [list(row) for row in objects.order_by('id').values_list(*fields)]
+	signals.snapshot_made.send(sender=game, snapshot=snapshot)
+	return snapshot
+
+def save_snapshot(game, turn=None, after=False):
+	""" Appends a snapshot of the current status of ``game`` to its file, and
+	its position to the index. ``turn`` is the (year, season, phase) tuple of
+	the processed phase, if the snapshot is taken ``after`` processing it. """
+
+	if turn is None:
+		turn = (game.year, game.season, game.phase)
+	snapshot = make_snapshot(game)
+	snapshot['turn'] = list(turn)
+	snapshot['after'] = after
+	path, index_path = get_snapshot_paths(game.id)
+	line = simplejson.dumps(snapshot, separators=(',', ':'))
 	try:
-		path = os.path.join(SNAPSHOTS_DIR, filename)
-		fd = open(path, mode='a')
+		fd = open(path, mode='ab')
+		fd.seek(0, os.SEEK_END)
+		offset = fd.tell()
+		fd.write(line)
+		fd.write("\n")
+		fd.close()
+		index = open(index_path, mode='a')
+		index.write("%s %s %s %s %s\n" % (turn + (int(after), offset)))
+		index.close()
 	except IOError, v:
 		print v
-		return
-	else:
-		fd.write("\n")
-		fd.write("<turn year=\"%s\" season=\"%s\">\n" % (game.year, game.season))
+
+def get_snapshot_index(game_id):
+	""" Returns a list of (year, season, phase, after, offset) tuples, one for
+	each snapshot of a game. """
+	path, index_path = get_snapshot_paths(game_id)
+	index = []
+	try:
+		fd = open(index_path)
+	except IOError:
+		return index
+	for line in fd:
+		index.append(tuple([int(v) for v in line.split()]))
+	fd.close()
+	return index
+
+def load_snapshot(game_id, year, season, phase, after=False):
+	""" Returns the last snapshot of a game saved before (or after) the given
+	phase was processed, or None if there is no such snapshot. """
+	offset = None
+	for y, s, p, a, o in get_snapshot_index(game_id):
+		if (y, s, p, a) == (year, season, phase, int(after)):
+			offset = o
+	if offset is None:
+		return None
+	path, index_path = get_snapshot_paths(game_id)
+	fd = open(path, mode='rb')
+	fd.seek(offset)
+	line = fd.readline()
+	fd.close()
+	return simplejson.loads(line)
+
+def read_snapshots(path):
+	""" Returns an iterator over all the snapshots in a file. """
+	fd = open(path, mode='rb')
+	for line in fd:
+		yield simplejson.loads(line)
+	fd.close()
+
+def get_turns_since(year, season, phase):
+	""" Returns a ``Q`` object that selects the objects with a year, season
+	and phase that are not older than the given ones. """
+	return Q(year__gt=year) | Q(year=year, season__gt=season) | \
+		Q(year=year, season=season, phase__gte=phase)
+
+def restore_snapshot(game, snapshot, replay=False):
+	""" Replaces the status of ``game`` with the one in the snapshot. If
+	``replay`` is True, the phase must be played again: the players are not
+	done, their orders and expenses are not confirmed, and the logs of the
+	phases processed after the snapshot are deleted. """
+	from machiavelli import models
+	from machiavelli.utils import bulk_insert
+
+	assert snapshot['game'] == game.id, "The snapshot belongs to other game"
+	for key, model, lookup, fields in reversed(SNAPSHOT_TABLES):
+		game.delete_in_batch(getattr(models, model).objects.filter(**{lookup: game}))
+	for key, model, lookup, fields in SNAPSHOT_UPDATES:
+		## group the objects by their values, to update them together
+		changes = {}
+		for row in snapshot[key]:
+			changes.setdefault(tuple(row[1:]), []).append(row[0])
+		for values, ids in changes.items():
+			getattr(models, model).objects.filter(id__in=ids).update(**dict(zip(fields[1:], values)))
+	for key, model, lookup, fields in SNAPSHOT_TABLES:
+		bulk_insert(getattr(models, model), fields, [tuple(row) for row in snapshot[key]])
+	game.dice_seed = snapshot['dice_seed']
+	game.year = snapshot['year']
+	game.season = snapshot['season']
+	game.phase = snapshot['phase']
+	game.save()
+	game.bump_cache_version()
+	if replay:
+		models.Order.objects.filter(player__game=game).update(confirmed=False)
+		models.Expense.objects.filter(player__game=game).update(confirmed=False)
 		for player in game.player_set.all():
-			if player.country:
-				fd.write("<player country=\"%s\">\n" % (player.country))
-			else:
-				fd.write("<player>\n")
-			for unit in player.unit_set.all():
-				fd.write("<unit ")
-				fd.write("id=\"%(id)s\" type=\"%(type)s\" area=\"%(area)s\" besieging=\"%(bes)s\" />" %
-							{ 'id': unit.id,
-							  'type': unit.type,
-							  'area': unit.area.board_area.code,
-							  'bes': unit.besieging })
-				fd.write("\n")
-			fd.write("</player>\n")
-		fd.write("</turn>\n")
-		fd.close()
+			player.new_phase()
+		turns = get_turns_since(game.year, game.season, game.phase)
+		models.TurnLog.objects.filter(turns, game=game).delete()
+		models.StepTiming.objects.filter(turns, game=game).delete()
+		signals.game_restored.send(sender=game, snapshot=snapshot)
+restore_snapshot = transaction.commit_on_success(restore_snapshot)
@@ -0,0 +1,75 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+import machiavelli.models as models
+
+def start_game(scenario, n, dice_seed=0):
+	""" Creates a game of the scenario with temporary users, and returns the
+	seconds and the number of queries that the last player needed to join
+	the game and start it. If ``dice_seed`` is 0, the game gets a random
+	seed. """
+	users = []
+	for i in range(scenario.get_slots()):
+		users.append(User.objects.create(username="benchmark-%s-%s" % (n, i)))
+	game = models.Game(slug="benchmark-%s" % n, scenario=scenario,
+						created_by=users[0], time_limit=models.TIME_LIMITS[0][0],
+						dice_seed=dice_seed)
+	game.slots = scenario.get_slots() - 1
+	game.save()
+	models.Player.objects.create(user=users[0], game=game)
+	for u in users[1:-1]:
+		models.Player.objects.create(user=u, game=game)
+		game.player_joined()
+	queries = len(connection.queries)
+	start = time.time()
+	models.Player.objects.create(user=users[-1], game=game)
+	game.player_joined()
+	seconds = time.time() - start
+	queries = len(connection.queries) - queries
+	assert game.phase == models.PHORDERS, "The game has not started"
+	return seconds, queries
+
+class Command(NoArgsCommand):
+	"""
+This script measures the time needed to start a game. A game of the given
+scenario is created and joined by temporary users, and everything is rolled
+back at the end, so nothing is left in the database. The number of queries is
+only counted when DEBUG is True.
+	"""
+	help = 'This command measures how long it takes to start a game.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--scenario', dest='scenario', default='struggle-i',
+			help='Name of the scenario of the game.'),
+		make_option('--repeat', type='int', dest='repeat', default=5,
+			help='Number of games that will be started.'),
+	)
+
+	def handle_noargs(self, **options):
+		try:
+			scenario = models.Scenario.objects.get(name=options['scenario'])
+		except ObjectDoesNotExist:
+			raise CommandError("Scenario %s does not exist" % options['scenario'])
+		print "Starting %s games of %s" % (options['repeat'], scenario.title)
+		total = 0
+		transaction.enter_transaction_management()
+		transaction.managed(True)
+		try:
+			for n in range(options['repeat']):
+				seconds, queries = start_game(scenario, n)
+				transaction.rollback()
+				total += seconds
+				if settings.DEBUG:
+					print "Game %s started in %.3f seconds, with %s queries" % (n, seconds, queries)
+				else:
+					print "Game %s started in %.3f seconds" % (n, seconds)
+		finally:
+			transaction.rollback()
+			transaction.leave_transaction_management()
+		if options['repeat'] > 0:
+			print "Average: %.3f seconds" % (total / options['repeat'])
@@ -0,0 +1,32 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.conf import settings
+from django.db.models import Q
+
+from machiavelli import models
+from machiavelli.management.commands.check_turns import check_games
+
+class Command(NoArgsCommand):
+	"""
+This script only checks the active games whose deadline has passed. The
+deadline is set to the current time when all the players of a game are done,
+so those games are also checked. Games without a deadline are checked once,
+and get one.
+	"""
+	help = 'This script checks the active games whose deadline has passed or whose \
+	players are all done.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--processes', type='int', dest='processes', default=1,
+			help='Number of processes that check the games in parallel.'),
+	)
+
+	def handle_noargs(self, **options):
+		if settings.MAINTENANCE_MODE:
+			print "App is in maintenance mode. Exiting."
+			return
+		due_games = models.Schedule.objects.exclude(game__phase=models.PHINACTIVE).filter(
+							Q(next_deadline__lte=datetime.now()) |
+							Q(next_deadline__isnull=True)).values_list('game', flat=True)
+		check_games(due_games, options['processes'])
@@ -1,4 +1,7 @@
 from datetime import datetime, timedelta
+from optparse import make_option
+import time
+import traceback
 
 from django.core.management.base import NoArgsCommand, CommandError
 from django.conf import settings
@@ -7,26 +10,80 @@ from jogging import logging
 
 from machiavelli import models
 
+def check_game(game_id):
+	""" Checks if the phase of a game must change, holding the lock of the
+	game. Returns a tuple with the game id, the result, the time spent and the
+	error, if any. """
+	start = time.time()
+	error = ''
+	try:
+		game = models.Game.objects.get(id=game_id)
+	except models.Game.DoesNotExist:
+		return (game_id, 'deleted', 0, error)
+	if not game.lock():
+		return (game_id, 'locked', time.time() - start, error)
+	try:
+		try:
+			if game.check_finished_phase() == False:
+				result = 'waiting'
+			else:
+				result = 'changed'
+		except Exception:
+			result = 'error'
+			error = traceback.format_exc()
+	finally:
+		game.unlock()
+	return (game_id, result, time.time() - start, error)
+
+def check_games(game_ids, processes=1):
+	""" Checks a list of games, in parallel if ``processes`` is greater than
+	one, and prints a summary. Returns the list of results of ``check_game``.
+	"""
+	start = time.time()
+	if processes > 1:
+		import multiprocessing
+		from django.db import connection
+		## the processes must not share the connection to the database
+		connection.close()
+		pool = multiprocessing.Pool(processes)
+		results = pool.map(check_game, list(game_ids))
+		pool.close()
+		pool.join()
+	else:
+		results = map(check_game, game_ids)
+	## summary
+	failed = 0
+	for game_id, result, seconds, error in results:
+		print "Game %s: %s (%.2f s)" % (game_id, result, seconds)
+		if result == 'error':
+			failed += 1
+			print "Error while checking if phase is finished in game %s\n\n" % game_id
+			print error
+	print "%s games checked in %.2f s, %s errors" % (len(results), time.time() - start, failed)
+	return results
+
 class Command(NoArgsCommand):
 	"""
 This script checks in every active game if the current turn must change. This happens either
 when all the players have finished OR the time limit is exceeded
+
+With --processes, the games are checked in parallel by a pool of processes.
+Each game is locked while it is checked, so that two instances of the script
+can never change the same phase twice.
 	"""
 	help = 'This script checks in every active game if the current turn must change. \
 	This happens either when all the players have finished OR the time limit is exceeded.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--processes', type='int', dest='processes', default=1,
+			help='Number of processes that check the games in parallel.'),
+	)
 
 	def handle_noargs(self, **options):
 		if settings.MAINTENANCE_MODE:
 			print "App is in maintenance mode. Exiting."
 			return
-		active_games = models.Game.objects.exclude(phase=0)
-		for game in active_games:
-			try:
-				game.check_finished_phase()
-			except Exception, e:
-				print "Error while checking if phase is finished in game %s\n\n" % game.pk
-				print e
-				continue
+		active_games = models.Game.objects.exclude(phase=0).values_list('id', flat=True)
+		check_games(active_games, options['processes'])
 		## check for fast games that have not yet started and are older than
 		## one hour
 		fast_games = models.Game.objects.filter(slots__gt=0, fast=True)
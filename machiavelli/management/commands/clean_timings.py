@@ -0,0 +1,21 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from machiavelli import models
+
+AGE=30*24*60*60
+
+class Command(NoArgsCommand):
+	"""
+This script deletes all the step timings that are older than AGE days.
+	"""
+	help = 'This command deletes all the step timings that are older than AGE days.'
+
+	def handle_noargs(self, **options):
+		age = timedelta(0, AGE)
+		threshold = datetime.now() - age
+		print "Deleting step timings that were added before %s" % threshold
+		old_timings = models.StepTiming.objects.filter(timestamp__lt=threshold)
+		print "%s step timings will be deleted" % old_timings.count()
+		old_timings.delete()
@@ -0,0 +1,52 @@
+import os
+import socket
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.conf import settings
+
+import machiavelli.models as models
+from machiavelli.graphics import make_map
+
+class Command(NoArgsCommand):
+	"""
+This script draws the maps of the games that have a RenderJob. Several
+workers can be run at the same time, each job is drawn only by one of them.
+Games whose map is outdated but have no job get a new one.
+	"""
+	help = 'This command draws the maps of the games that have changed.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--loop', action='store_true', dest='loop', default=False,
+			help='Keep waiting for new jobs instead of exiting.'),
+		make_option('--sleep', type='int', dest='sleep', default=5,
+			help='Seconds to wait when there are no jobs, with --loop.'),
+	)
+
+	def handle_noargs(self, **options):
+		if settings.MAINTENANCE_MODE:
+			print "App is in maintenance mode. Exiting."
+			return
+		worker = "%s-%s" % (socket.gethostname(), os.getpid())
+		new_jobs = models.RenderJob.objects.enqueue_outdated()
+		if new_jobs > 0:
+			print "%s outdated maps queued" % new_jobs
+		drawn = 0
+		while True:
+			job = models.RenderJob.objects.claim(worker)
+			if job is None:
+				if not options['loop']:
+					break
+				time.sleep(options['sleep'])
+				models.RenderJob.objects.enqueue_outdated()
+				continue
+			try:
+				make_map(job.game)
+			except Exception, e:
+				## the job will be taken again after the timeout
+				print "Error while drawing the map of game %s\n\n" % job.game_id
+				print e
+				continue
+			models.RenderJob.objects.finish(job)
+			drawn += 1
+		print "%s maps drawn" % drawn
@@ -0,0 +1,129 @@
+import glob
+import os
+import time
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.contrib.auth.models import User
+
+import machiavelli.models as models
+from machiavelli.logging import SNAPSHOTS_DIR, SNAPSHOT_TABLES, SNAPSHOT_UPDATES, \
+	make_snapshot, read_snapshots, restore_snapshot
+
+def get_scratch_game(snapshot):
+	""" Returns the game of the snapshot in the scratch database, creating it,
+	its players and its areas if they do not exist. """
+	user, created = User.objects.get_or_create(username="replay")
+	try:
+		game = models.Game.objects.get(id=snapshot['game'])
+	except ObjectDoesNotExist:
+		game = models.Game(id=snapshot['game'], slug="replay-%s" % snapshot['game'],
+						scenario_id=snapshot['scenario'], created_by=user,
+						time_limit=models.TIME_LIMITS[0][0])
+		game.save()
+	models.Configuration.objects.filter(game=game).update(**snapshot['configuration'])
+	players = set(game.player_set.values_list('id', flat=True))
+	for row in snapshot['players']:
+		if not row[0] in players:
+			if row[0] in snapshot['autonomous']:
+				player_user = None
+			else:
+				player_user, created = User.objects.get_or_create(username="replay-%s" % row[0])
+			models.Player(id=row[0], game=game, user=player_user).save()
+	areas = set(game.gamearea_set.values_list('id', flat=True))
+	for row in snapshot['areas']:
+		if not row[0] in areas:
+			models.GameArea(id=row[0], game=game, board_area_id=row[1]).save()
+	return game
+
+def compare_snapshots(result, expected):
+	""" Returns a list of the differences between two snapshots. The objects
+	that are created while processing a phase get different ids, so they are
+	compared without them. """
+	diffs = []
+	for key in ('year', 'season', 'phase'):
+		if result[key] != expected[key]:
+			diffs.append("%s is %s, expected %s" % (key, result[key], expected[key]))
+	for key, model, lookup, fields in SNAPSHOT_UPDATES:
+		rows = dict([(row[0], row) for row in result[key]])
+		for row in expected[key]:
+			if rows.get(row[0]) != row:
+				diffs.append("%s %s is %s, expected %s" % (model, row[0], rows.get(row[0]), row))
+	for key, model, lookup, fields in SNAPSHOT_TABLES:
+		rows = sorted([row[1:] for row in result[key]])
+		expected_rows = sorted([row[1:] for row in expected[key]])
+		for row in rows:
+			if row in expected_rows:
+				expected_rows.remove(row)
+			else:
+				diffs.append("unexpected %s %s" % (model, row))
+		for row in expected_rows:
+			diffs.append("missing %s %s" % (model, row))
+	return diffs
+
+class Command(NoArgsCommand):
+	"""
+This script replays the phases recorded in the snapshots of the games, and
+compares the results with the snapshots taken after processing them. For each
+phase, the game is restored in a scratch database with the status before the
+phase, and the phase is processed again with the same dice.
+
+The database must be a SQLite database that can be thrown away, so the command
+must be run with a settings module for it (--settings). The tables are
+created, and the fixtures of the board are loaded, if they do not exist.
+	"""
+	help = 'This command replays the recorded phases of the games, in a scratch database.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--dir', dest='dir', default=SNAPSHOTS_DIR,
+			help='Directory with the snapshots.'),
+		make_option('--game', dest='games', action='append', type='int', default=[],
+			help='Id of a game to replay. By default, all the games are replayed.'),
+	)
+
+	def handle_noargs(self, **options):
+		if not settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+			raise CommandError("The phases must be replayed in a scratch SQLite database")
+		call_command('syncdb', interactive=False, verbosity=0)
+		if not models.Area.objects.exists():
+			call_command('loaddata', 'areas', 'countries', 'scenarios', 'tokens', verbosity=0)
+		## the maps are only queued, they must not be drawn
+		models.ASYNC_MAPS = True
+		if options['games']:
+			paths = [os.path.join(options['dir'], "%s.jsonl" % g) for g in options['games']]
+		else:
+			paths = sorted(glob.glob(os.path.join(options['dir'], "*.jsonl")))
+		replayed = 0
+		failed = 0
+		seconds = 0
+		for path in paths:
+			before = None
+			for snapshot in read_snapshots(path):
+				if not snapshot['after']:
+					before = snapshot
+					continue
+				if before is None or before['turn'] != snapshot['turn']:
+					continue
+				game = get_scratch_game(before)
+				restore_snapshot(game, before)
+				game = models.Game.objects.get(id=game.id)
+				start = time.time()
+				game.all_players_done(game.get_dice())
+				seconds += time.time() - start
+				diffs = compare_snapshots(make_snapshot(game), snapshot)
+				replayed += 1
+				turn = "Game %s, %s %s %s" % ((game.id,) + tuple(before['turn']))
+				if len(diffs) > 0:
+					failed += 1
+					print "%s: %s differences" % (turn, len(diffs))
+					for d in diffs:
+						print "\t%s" % d
+				else:
+					print "%s: ok" % turn
+				before = None
+		print "%s phases replayed, %s with differences" % (replayed, failed)
+		if replayed > 0:
+			print "%.3f seconds processing phases, %.3f seconds per phase" % (seconds,
+																seconds / replayed)
@@ -0,0 +1,59 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+
+import machiavelli.models as models
+from machiavelli.logging import get_snapshot_index, load_snapshot, restore_snapshot
+from machiavelli.orders import update_legal_orders
+
+class Command(NoArgsCommand):
+	"""
+This script restores a game to the status that it had before a phase was
+processed. Without --year, --season and --phase, it lists the snapshots of
+the game. The players must confirm their actions again, and the deadline of
+the game is reset, so that they have the full time to play the phase again.
+The logs and events of the phases that are undone are deleted. The dice of
+the phase give the same results when it is processed again.
+	"""
+	help = 'This command restores a game from one of its snapshots.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--game', type='int', dest='game',
+			help='Id of the game.'),
+		make_option('--year', type='int', dest='year',
+			help='Year of the snapshot.'),
+		make_option('--season', type='int', dest='season',
+			help='Season of the snapshot (1, 2 or 3).'),
+		make_option('--phase', type='int', dest='phase',
+			help='Phase of the snapshot.'),
+	)
+
+	def handle_noargs(self, **options):
+		if options['game'] is None:
+			raise CommandError("A game must be given with --game")
+		try:
+			game = models.Game.objects.get(id=options['game'])
+		except ObjectDoesNotExist:
+			raise CommandError("Game %s does not exist" % options['game'])
+		turn = (options['year'], options['season'], options['phase'])
+		if None in turn:
+			for year, season, phase, after, offset in get_snapshot_index(game.id):
+				if not after:
+					print "%s %s %s" % (year, season, phase)
+			return
+		snapshot = load_snapshot(game.id, *turn)
+		if snapshot is None:
+			raise CommandError("There is no snapshot of game %s in %s %s %s" % ((game.id,) + turn))
+		if not game.lock():
+			raise CommandError("Game %s is being processed" % game.id)
+		try:
+			game.last_phase_change = datetime.now()
+			restore_snapshot(game, snapshot, replay=True)
+			game.update_deadline()
+			if game.phase == models.PHORDERS:
+				update_legal_orders(game)
+			game.make_map()
+		finally:
+			game.unlock()
+		print "Game %s restored to %s %s %s" % ((game.id,) + turn)
@@ -0,0 +1,217 @@
+import resource
+import time
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.db import connection, reset_queries
+
+import machiavelli.models as models
+import machiavelli.graph as graph
+from machiavelli.dice import Dice
+from machiavelli.management.commands.benchmark_start import start_game
+
+## methods of Game whose time is measured
+STEPS = ('adjust_units', 'check_loans', 'process_expenses', 'process_assassinations',
+		'process_orders', 'process_retreats', 'update_controls', 'check_conquerings',
+		'assign_incomes', 'make_map')
+
+PHASE_NAMES = {
+	models.PHREINFORCE: 'reinforcements',
+	models.PHORDERS: 'orders',
+	models.PHRETREATS: 'retreats',
+}
+
+def timed(name, method, timings):
+	def wrapper(*args, **kwargs):
+		start = time.time()
+		try:
+			return method(*args, **kwargs)
+		finally:
+			seconds, calls = timings.get(name, (0, 0))
+			timings[name] = (seconds + time.time() - start, calls + 1)
+	return wrapper
+
+def time_steps(timings):
+	""" Replaces the methods of Game in STEPS with wrappers that add the
+	seconds that they take to ``timings``. """
+	for name in STEPS:
+		setattr(models.Game, name, timed(name, getattr(models.Game, name), timings))
+
+def get_memory():
+	""" Returns the maximum resident memory of the process, in kilobytes. """
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def make_orders(game, rng):
+	""" Gives a random order to each unit of the players, choosing among the
+	holds, advances, sieges, conversions and supports that are possible. """
+	areas = dict([(a.board_area_id, a) for a in game.gamearea_set.select_related('board_area')])
+	units = list(models.Unit.objects.filter(player__game=game, placed=True,
+						player__user__isnull=False,
+						player__eliminated=False).select_related('area__board_area',
+						'player'))
+	units_by_area = {}
+	for u in units:
+		units_by_area.setdefault(u.area.board_area_id, []).append(u)
+	adjacency = graph.get_graph()
+	for unit in units:
+		candidates = [models.Order(unit=unit, code='H'),
+					models.Order(unit=unit, code='B')]
+		for t in ('A', 'F', 'G'):
+			if t != unit.type:
+				candidates.append(models.Order(unit=unit, code='=', type=t))
+		for b in adjacency.get_borders(unit.area.board_area_id):
+			if not b in areas:
+				continue
+			candidates.append(models.Order(unit=unit, code='-', destination=areas[b]))
+			for other in units_by_area.get(b, []):
+				candidates.append(models.Order(unit=unit, code='S', subunit=other,
+											subcode='H'))
+		order = rng.choice([o for o in candidates if o.is_possible()])
+		order.player = unit.player
+		order.confirmed = True
+		order.save()
+
+def make_reinforcements(game, rng):
+	""" Places or disbands the units of the players. With finances, the
+	players pay for as many units as they can and buy new ones with the
+	remaining ducats. """
+	for player in game.player_set.filter(user__isnull=False, eliminated=False):
+		if game.configuration.finances:
+			units = list(player.unit_set.filter(placed=True))
+			rng.random.shuffle(units)
+			for unit in units:
+				if unit.cost <= player.ducats:
+					unit.paid = True
+					unit.save()
+					player.ducats -= unit.cost
+			areas = list(player.get_areas_for_new_units(finances=True))
+			to_place = min(player.ducats / 3, len(areas))
+		else:
+			to_place = player.units_to_place()
+			areas = list(player.get_areas_for_new_units())
+			if to_place < 0:
+				units = list(player.unit_set.all())
+				for i in range(-to_place):
+					unit = rng.choice(units)
+					units.remove(unit)
+					unit.paid = False
+					unit.save()
+		for i in range(to_place):
+			area = rng.choice(areas)
+			areas.remove(area)
+			types = area.possible_reinforcements()
+			if len(types) == 0:
+				continue
+			unit = models.Unit(type=rng.choice(types),
+							area=area, player=player, placed=False)
+			unit.save()
+			if game.configuration.finances:
+				player.ducats -= unit.cost
+		player.save()
+
+def make_retreats(game, rng):
+	""" Retreats the units that must retreat to a random area, or disbands
+	them. """
+	units = models.Unit.objects.filter(player__game=game,
+						player__user__isnull=False).exclude(must_retreat__exact='')
+	for unit in units:
+		area = rng.choice(list(unit.get_possible_retreats()) + [None,])
+		models.RetreatOrder(unit=unit, area=area).save()
+
+BOTS = {
+	models.PHREINFORCE: make_reinforcements,
+	models.PHORDERS: make_orders,
+	models.PHRETREATS: make_retreats,
+}
+
+class Command(NoArgsCommand):
+	"""
+This script plays games with bots that give random orders, and processes the
+phases with the same methods that process the real games. For each kind of
+phase, it reports the number of phases, the seconds and the number of queries
+needed to process them, and the seconds taken by each step. The number of
+queries is only counted when DEBUG is True.
+
+The bots do not spend ducats in expenses and never convoy units. The games are
+created in the database, so it must be a SQLite database that can be thrown
+away, and the command must be run with a settings module for it (--settings).
+The tables are created, and the fixtures of the board are loaded, if they do
+not exist.
+	"""
+	help = 'This command plays and processes games with random orders.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--scenario', dest='scenario', default='struggle-i',
+			help='Name of the scenario of the games.'),
+		make_option('--games', type='int', dest='games', default=1,
+			help='Number of games that will be played.'),
+		make_option('--seasons', type='int', dest='seasons', default=100,
+			help='Maximum number of seasons of each game.'),
+		make_option('--seed', type='int', dest='seed',
+			help='Seed of the countries, the orders and the dice, to repeat a simulation.'),
+		make_option('--no-maps', action='store_false', dest='maps', default=True,
+			help='Only queue the maps, instead of drawing them.'),
+	)
+
+	def handle_noargs(self, **options):
+		if not settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+			raise CommandError("The games must be simulated in a scratch SQLite database")
+		call_command('syncdb', interactive=False, verbosity=0)
+		if not models.Area.objects.exists():
+			call_command('loaddata', 'areas', 'countries', 'scenarios', 'tokens', verbosity=0)
+		try:
+			scenario = models.Scenario.objects.get(name=options['scenario'])
+		except ObjectDoesNotExist:
+			raise CommandError("Scenario %s does not exist" % options['scenario'])
+		models.ASYNC_MAPS = not options['maps']
+		timings = {}
+		time_steps(timings)
+		## kind of phase -> (phases, seconds, queries)
+		phases = {}
+		rng = Dice(options['seed'])
+		label = int(time.time())
+		for n in range(options['games']):
+			## the seed of the game also shuffles the countries
+			if options['seed'] is None:
+				dice_seed = 0
+			else:
+				dice_seed = options['seed'] + n + 1
+			start_game(scenario, "%s-%s" % (label, n), dice_seed)
+			game = models.Game.objects.get(slug="benchmark-%s-%s" % (label, n))
+			print "Game %s: %s" % (n, scenario.title)
+			seasons = 0
+			while game.phase != models.PHINACTIVE and seasons < options['seasons']:
+				BOTS[game.phase](game, rng)
+				phase = game.phase
+				season = game.season
+				reset_queries()
+				start = time.time()
+				game.all_players_done(game.get_dice())
+				seconds = time.time() - start
+				queries = len(connection.queries)
+				game.clear_phase_cache()
+				for p in game.player_set.all():
+					p.new_phase()
+				count, total, total_queries = phases.get(phase, (0, 0, 0))
+				phases[phase] = (count + 1, total + seconds, total_queries + queries)
+				game = models.Game.objects.get(id=game.id)
+				if game.season != season:
+					seasons += 1
+			print "\t%s seasons played, %s %s, %s KB of memory" % (seasons, game.year,
+								game.get_season_display(), get_memory())
+		reset_queries()
+		print "Phase\t\tCount\tSeconds\tQueries"
+		for phase, (count, seconds, queries) in sorted(phases.items()):
+			if settings.DEBUG:
+				queries = "%.1f" % (float(queries) / count)
+			else:
+				queries = "-"
+			print "%-15s\t%s\t%.3f\t%s" % (PHASE_NAMES[phase], count, seconds / count, queries)
+		print "Step\t\t\tCalls\tSeconds"
+		for name in STEPS:
+			if name in timings:
+				seconds, calls = timings[name]
+				print "%-23s\t%s\t%.3f" % (name, calls, seconds / calls)
+		print "Maximum memory: %s KB" % get_memory()
@@ -0,0 +1,34 @@
+import random
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from machiavelli import models
+from machiavelli.utils import bulk_insert
+
+class Command(NoArgsCommand):
+	"""
+This script fills the data of the games that were created before the schedules
+and the seeds of the dice existed (see doc/upgrading.rst). Each game gets a
+Schedule and a random seed, and the deadlines of the active games are
+calculated. It can be run more than once.
+	"""
+	help = 'This command fills the schedules, deadlines and dice seeds of the old games.'
+
+	def handle_noargs(self, **options):
+		scheduled = models.Schedule.objects.values_list('game', flat=True)
+		missing = models.Game.objects.exclude(id__in=list(scheduled)).values_list('id', flat=True)
+		rows = [(id, None, None) for id in missing]
+		bulk_insert(models.Schedule, ('game', 'locked', 'next_deadline'), rows)
+		print "%s schedules created" % len(rows)
+		unseeded = models.Game.objects.filter(dice_seed=0).values_list('id', flat=True)
+		count = 0
+		for id in unseeded:
+			count += models.Game.objects.filter(id=id, dice_seed=0).update(
+									dice_seed=random.randint(1, 2147483647))
+		print "%s games seeded" % count
+		active = models.Game.objects.exclude(phase=models.PHINACTIVE)
+		count = 0
+		for game in active.iterator():
+			game.update_deadline()
+			count += 1
+		print "%s deadlines calculated" % count
@@ -64,6 +64,61 @@ function toggle_subparams() {
 	}
 }
 
+var all_options = {};
+
+function saveOptions() {
+	var fields = ["destination", "type", "subunit", "subdestination"];
+	for (var i = 0; i < fields.length; i++) {
+		all_options[fields[i]] = $("#id_" + fields[i] + " option").clone();
+	}
+}
+
+function filterOptions(field, allowed) {
+	var select = $("#id_" + field);
+	var selected = select.val();
+	select.empty();
+	all_options[field].each(function() {
+		var value = $(this).val();
+		if (value == '' || allowed === null || $.inArray(value, allowed) >= 0) {
+			select.append($(this).clone());
+		}
+	});
+	select.val(selected);
+}
+
+function toStrings(list) {
+	var strings = [];
+	for (var i = 0; i < list.length; i++) {
+		strings.push(String(list[i]));
+	}
+	return strings;
+}
+
+function filter_choices() {
+	var legal = legal_orders[$("#id_unit").val()];
+	if (!legal) {
+		return;
+	}
+	var code = $("#id_code").val();
+	filterOptions("destination", toStrings(legal['-']));
+	filterOptions("type", legal['=']);
+	if (code == 'S') {
+		// a unit supported to advance may be far from the supporting unit
+		var subcode = $("#id_subcode").val();
+		if (subcode == '-') {
+			filterOptions("subunit", null);
+		} else if (subcode == '=') {
+			filterOptions("subunit", toStrings(legal['S-=']));
+		} else {
+			filterOptions("subunit", toStrings(legal['S-H']));
+		}
+		filterOptions("subdestination", toStrings(legal['SA']));
+	} else {
+		filterOptions("subunit", null);
+		filterOptions("subdestination", null);
+	}
+}
+
 function hideOptional() {
 	$("#id_destination").parent().hide();
 	$("#id_type").parent().hide();
@@ -76,6 +131,9 @@ function hideOptional() {
 function addChangeHandlers() {
 	$("#id_code").change( toggle_params );
 	$("#id_subcode").change (toggle_subparams );
+	$("#id_unit").change( filter_choices );
+	$("#id_code").change( filter_choices );
+	$("#id_subcode").change( filter_choices );
 }
 
 function deleteOrder(pk) {
@@ -149,6 +207,8 @@ function addClickHandlers() {
 }
 
 $(document).ready(function() {
+	saveOptions();
+	filter_choices();
 	hideOptional();
 	prepareForm();
 	addClickHandlers();
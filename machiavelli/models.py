@@ -24,6 +24,7 @@ Defines the core classes of the machiavelli game.
 ## stdlib
 import random
 import thread
+import threading
 from datetime import datetime, timedelta
 
 ## django
@@ -34,6 +35,7 @@ from django.core.cache import cache
 from django.contrib.auth.models import User
 import django.forms as forms
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language
 from django.conf import settings
 from django.template.defaultfilters import capfirst, truncatewords, timesince, force_escape
 
@@ -55,11 +57,19 @@ else:
 ## machiavelli
 from machiavelli.fields import AutoTranslateField
 from machiavelli.graphics import make_map
+import machiavelli.graphics as graphics
 from machiavelli.logging import save_snapshot
 import machiavelli.dice as dice
 import machiavelli.disasters as disasters
 import machiavelli.finances as finances
 import machiavelli.exceptions as exceptions
+import machiavelli.adjudicator as adjudicator
+from machiavelli.utils import bulk_insert, atomic
+import machiavelli.scenarios as scenarios
+import machiavelli.graph as graph
+import machiavelli.incomes as incomes
+import machiavelli.profiling as profiling
+import machiavelli.orders as orders
 
 ## condottieri_profiles
 from condottieri_profiles.models import CondottieriProfile
@@ -79,6 +89,20 @@ else:
 	twitter_api = twitter.Api(username=settings.TWITTER_USER,
 							  password=settings.TWITTER_PASSWORD)
 
+## if LEGACY_ADJUDICATION is True, the orders are processed by the methods of
+## Game, querying the database in each step, instead of the adjudicator
+LEGACY_ADJUDICATION = getattr(settings, 'LEGACY_ADJUDICATION', False)
+
+## if ASYNC_MAPS is True, the maps are drawn by the render_maps command, which
+## must be kept running (see doc/gettingstarted.rst). If not, they are drawn
+## when the phase changes
+ASYNC_MAPS = getattr(settings, 'ASYNC_MAPS', False)
+## seconds after which a map that is still being drawn can be taken by other
+## worker
+RENDER_TIMEOUT = 10*60
+## seconds after which the lock of a game is considered stale
+LOCK_TIMEOUT = 30*60
+
 UNIT_TYPES = (('A', _('Army')),
               ('F', _('Fleet')),
               ('G', _('Garrison'))
@@ -234,26 +258,11 @@ actually played in GameArea objects.
 	def is_adjacent(self, area, fleet=False):
 		""" Two areas can be adjacent through land, but not through a coast. 
 		
-		The list ``only_armies`` shows the areas that are adjacent but their
-		coasts are not, so a Fleet can move between them.
+		The list ``graph.ONLY_ARMIES`` shows the areas that are adjacent but
+		their coasts are not, so a Fleet cannot move between them.
 		"""
 
-		only_armies = [
-			('AVI', 'PRO'),
-			('PISA', 'SIE'),
-			('CAP', 'AQU'),
-			('NAP', 'AQU'),
-			('SAL', 'AQU'),
-			('SAL', 'BARI'),
-			('HER', 'ALB'),
-			('BOL', 'MOD'),
-			('BOL', 'LUC'),
-			('CAR', 'CRO'),
-		]
-		if fleet:
-			if (self.code, area.code) in only_armies or (area.code, self.code) in only_armies:
-				return False
-		return area in self.borders.all()
+		return graph.get_graph().is_adjacent(self.id, area.id, fleet)
 
 	def accepts_type(self, type):
 		""" Returns True if an given type of Unit can be in the Area. """
@@ -276,6 +285,10 @@ actually played in GameArea objects.
 	class Meta:
 		ordering = ('code',)
 
+models.signals.post_save.connect(graph.invalidate_graph, sender=Area)
+models.signals.post_delete.connect(graph.invalidate_graph, sender=Area)
+models.signals.m2m_changed.connect(graph.invalidate_graph, sender=Area.borders.through)
+
 class DisabledArea(models.Model):
 	""" A DisabledArea is an Area that is not used in a given Scenario. """
 	scenario = models.ForeignKey(Scenario)
@@ -389,10 +402,14 @@ class Game(models.Model):
 				help_text=_("only invited users can join the game"))
 	comment = models.TextField(max_length=255, blank=True, null=True,
 				help_text=_("optional comment for joining users"))
+	## the dice of each phase are seeded with this number and the phase
+	dice_seed = models.PositiveIntegerField(default=0, editable=False)
 
 	def save(self, *args, **kwargs):
 		if not self.pk:
 			self.fast = self.time_limit in FAST_LIMITS
+		if not self.dice_seed:
+			self.dice_seed = random.randint(1, 2147483647)
 		super(Game, self).save(*args, **kwargs)
 
 	##------------------------
@@ -408,31 +425,61 @@ class Game(models.Model):
 		return ('show-game', None, {'slug': self.slug})
 	get_absolute_url = models.permalink(get_absolute_url)
 
+	def get_cache_version(self):
+		""" Returns the version of the cached data of the game. """
+		key = "game-%s_version" % self.pk
+		version = cache.get(key)
+		if version is None:
+			version = 1
+			cache.add(key, version)
+		return version
+
+	def get_cache_key(self, name):
+		""" Returns the cache key of some data of the game, in the namespace
+		of the current version. """
+		return "game-%s_v%s_%s" % (self.pk, self.get_cache_version(), name)
+
+	def bump_cache_version(self):
+		""" Invalidates all the cached data of the game, by changing the
+		version of its namespace. """
+		key = "game-%s_version" % self.pk
+		try:
+			cache.incr(key)
+		except ValueError:
+			cache.set(key, 2)
+
+	def delete_in_batch(self, queryset):
+		""" Deletes the objects in the queryset, and invalidates the cached
+		data of the game only once, instead of once for each deleted unit or
+		expense. """
+		_cache_batch.active = True
+		try:
+			queryset.delete()
+		finally:
+			_cache_batch.active = False
+		self.bump_cache_version()
+
 	def reset_players_cache(self):
 		""" Deletes the player list from the cache """
-		key = "game-%s_player-list" % self.pk
-		cache.delete(key)
+		self.bump_cache_version()
 	
 	def player_list_ordered_by_cities(self):
-		key = "game-%s_player-list" % self.pk
+		""" Returns a list of the players with a country, with a temporary
+		``cities`` attribute, sorted by the number of cities that they control.
+		"""
+		key = self.get_cache_key("player-list")
 		result_list = cache.get(key)
 		if result_list is None:
-			from django.db import connection
-			cursor = connection.cursor()
-			cursor.execute("SELECT machiavelli_player.*, COUNT(machiavelli_gamearea.id) \
-			AS cities \
-			FROM machiavelli_player \
-			LEFT JOIN (machiavelli_gamearea \
+			cities = "SELECT COUNT(*) \
+			FROM machiavelli_gamearea \
 			INNER JOIN machiavelli_area \
-			ON machiavelli_gamearea.board_area_id=machiavelli_area.id) \
-			ON machiavelli_gamearea.player_id=machiavelli_player.id \
-			WHERE (machiavelli_player.game_id=%s AND machiavelli_player.country_id \
-			AND (machiavelli_area.has_city=1 OR machiavelli_gamearea.id IS NULL)) \
-			GROUP BY machiavelli_player.id \
-			ORDER BY cities DESC, machiavelli_player.id;" % self.id)
-			result_list = []
-			for row in cursor.fetchall():
-				result_list.append(Player.objects.get(id=row[0]))
+			ON machiavelli_gamearea.board_area_id=machiavelli_area.id \
+			WHERE machiavelli_gamearea.player_id=machiavelli_player.id \
+			AND machiavelli_area.has_city=%s"
+			players = Player.objects.filter(game=self, country__isnull=False)
+			players = players.select_related('user', 'country')
+			players = players.extra(select={'cities': cities}, select_params=(True,))
+			result_list = list(players.order_by('-cities', 'id'))
 			cache.set(key, result_list)
 		return result_list
 
@@ -457,20 +504,25 @@ class Game(models.Model):
 		return result['average_karma']
 
 	def get_all_units(self):
-		""" Returns a queryset with all the units in the board. """
-		key = "game-%s_all-units" % self.pk
+		""" Returns a list of (id, description) pairs of all the units in the
+		board, to be used as choices in the order forms. """
+		key = self.get_cache_key("all-units_%s" % get_language())
 		all_units = cache.get(key)
 		if all_units is None:
-			all_units = Unit.objects.select_related().filter(player__game=self).order_by('area__board_area__name')
+			units = Unit.objects.select_related('area__board_area').filter(player__game=self)
+			units = units.order_by('area__board_area__name')
+			all_units = [(u.id, unicode(u)) for u in units]
 			cache.set(key, all_units)
 		return all_units
 
 	def get_all_gameareas(self):
-		""" Returns a queryset with all the game areas in the board. """
-		key = "game-%s_all-areas" % self.pk
+		""" Returns a list of (id, description) pairs of all the game areas in
+		the board, to be used as choices in the order forms. """
+		key = self.get_cache_key("all-areas_%s" % get_language())
 		all_areas = cache.get(key)
 		if all_areas is None:
-			all_areas = self.gamearea_set.select_related().order_by('board_area__code')
+			areas = self.gamearea_set.select_related('board_area').order_by('board_area__code')
+			all_areas = [(a.id, unicode(a)) for a in areas]
 			cache.set(key, all_areas)
 		return all_areas
 
@@ -478,9 +530,14 @@ class Game(models.Model):
 	## map methods
 	##------------------------
 	
+	@profiling.profile_step
 	def make_map(self):
-		make_map(self)
-		#thread.start_new_thread(make_map, (self,))
+		""" Asks the ``render_maps`` command to draw the map. If
+		settings.ASYNC_MAPS is False, the map is drawn now. """
+		if ASYNC_MAPS:
+			RenderJob.objects.enqueue(self)
+		else:
+			make_map(self)
 		return True
 
 	def map_changed(self):
@@ -509,58 +566,60 @@ class Game(models.Model):
 			self.year = self.scenario.start_year
 			self.season = 1
 			self.phase = PHORDERS
-			self.create_game_board()
 			self.shuffle_countries()
 			self.copy_country_data()
-			self.home_control_markers()
+			self.create_game_board()
 			self.place_initial_units()
-			if self.configuration.finances:
-				self.assign_initial_income()
 			if self.configuration.assassinations:
 				self.create_assassins()
+			self.bump_cache_version()
 			#self.map_outdated = True
 			self.make_map()
 			self.started = datetime.now()
 			self.last_phase_change = datetime.now()
 			self.notify_players("game_started", {"game": self})
 		self.save()
+		if self.slots == 0:
+			self.update_deadline()
 		#if self.map_outdated == True:
 		#	self.make_map()
 	
-	def shuffle_countries(self):
-		""" Assign a Country of the Scenario to each Player, randomly. """
+	def shuffle_countries(self, rng=None):
+		""" Assign a Country of the Scenario to each Player, randomly. If no
+		``Dice`` is given, the countries are shuffled with the seed of the
+		game. """
 
-		countries_dict = self.scenario.setup_set.values('country').distinct()
+		template = scenarios.get_template(self.scenario_id)
 		countries = []
-		for c in countries_dict:
-			for v in c.values():
-				if v:
-					countries.append(v)
+		for country, area, unit_type in template.setups:
+			if country and not country in countries:
+				countries.append(country)
+		## the players are sorted, so that the same seed gives the same countries
+		players = list(self.player_set.filter(user__isnull=False).order_by('id'))
 		## the number of players and countries should be the same
-		assert len(countries) == len(self.player_set.filter(user__isnull=False)), "Number of players should be the same as number of countries"
-		## a list of tuples will be returned
-		assignment = []
+		assert len(countries) == len(players), "Number of players should be the same as number of countries"
 		## shuffle the list of countries
-		random.shuffle(countries)
-		for player in self.player_set.filter(user__isnull=False):
-			assignment.append((player, countries.pop()))
-		for t in assignment:
-			t[0].country = Country.objects.get(id=t[1])
-			t[0].save()
+		if rng is None:
+			rng = dice.Dice("%s-countries" % self.dice_seed)
+		rng.random.shuffle(countries)
+		for player in players:
+			player.country_id = countries.pop()
+			player.save()
 
 	def copy_country_data(self):
 		""" Copies to the player objects some properties that will never change during the game.
-		This way, I hope to save some hits to the database """
+		This way, I hope to save some hits to the database. If finances are
+		enabled, it also gives each player its initial ducats. """
 		excom = self.configuration.excommunication
 		finances = self.configuration.finances
+		template = scenarios.get_template(self.scenario_id)
 
-		for p in self.player_set.filter(user__isnull=False):
+		for p in self.player_set.filter(user__isnull=False).select_related('country'):
 			p.static_name = p.country.static_name
 			if excom:
 				p.may_excommunicate = p.country.can_excommunicate
 			if finances:
-				t = Treasury.objects.get(scenario=self.scenario, country=p.country)
-				p.double_income = t.double
+				p.ducats, p.double_income = template.treasuries[p.country_id]
 			p.save()
 
 	def get_disabled_areas(self):
@@ -568,73 +627,58 @@ class Game(models.Model):
 		return Area.objects.filter(disabledarea__scenario=self.scenario)
 
 	def create_game_board(self):
-		""" Creates the GameAreas for the Game.	"""
-		disabled_ids = Area.objects.filter(disabledarea__scenario=self.scenario).values_list('id', flat=True)
-		for a in Area.objects.all():
-			if not a.id in disabled_ids:
-				ga = GameArea(game=self, board_area=a)
-				ga.save()
-
-	def get_autonomous_setups(self):
-		return Setup.objects.filter(scenario=self.scenario,
-				country__isnull=True).select_related()
-	
-	def place_initial_garrisons(self):
-		""" Creates the Autonomous Player, and places the autonomous garrisons at the
-		start of the game.
+		""" Creates the GameAreas for the Game, with a single insert. Each home
+		area is controlled by the player of its country. """
+		template = scenarios.get_template(self.scenario_id)
+		owners = {}
+		for id, country in self.player_set.filter(user__isnull=False).values_list('id', 'country'):
+			for area in template.homes.get(country, []):
+				owners[area] = id
+		rows = [(self.id, a, owners.get(a), False, False, False) for a in template.area_ids]
+		bulk_insert(GameArea, ('game', 'board_area', 'player', 'standoff',
+										'famine', 'storm'), rows)
+
+	def place_initial_units(self):
+		""" Creates the Autonomous Player, and places the initial units of the
+		players and the autonomous garrisons, with a single insert.
 		"""
 
 		## create the autonomous player
 		autonomous = Player(game=self, done=True)
 		autonomous.save()
-		for s in self.get_autonomous_setups():
-			try:
-				a = GameArea.objects.get(game=self, board_area=s.area)
-			except:
-				print "Error 1: Area not found!"
-			else:	
-				if s.unit_type:
-					new_unit = Unit(type='G', area=a, player=autonomous)
-					new_unit.save()
-
-	def home_control_markers(self):
-		for p in self.player_set.filter(user__isnull=False):
-			p.home_control_markers()
-
-	def place_initial_units(self):
-		for p in self.player_set.filter(user__isnull=False):
-			p.place_initial_units()
-		self.place_initial_garrisons()
-
-	def assign_initial_income(self):
-		for p in self.player_set.filter(user__isnull=False):
-			t = Treasury.objects.get(scenario=self.scenario, country=p.country)
-			p.ducats = t.ducats
-			p.save()
+		players = dict(self.player_set.filter(user__isnull=False).values_list('country', 'id'))
+		gameareas = dict(self.gamearea_set.values_list('board_area', 'id'))
+		rows = []
+		for country, area, unit_type in scenarios.get_template(self.scenario_id).setups:
+			if not unit_type:
+				continue
+			if not area in gameareas:
+				print "Error 2: Area not found!"
+				continue
+			if country:
+				rows.append((unit_type, gameareas[area], players[country], False))
+			else:
+				rows.append(('G', gameareas[area], autonomous.id, True))
+		rows = [r + (False, '', True, 3, 1, 1) for r in rows]
+		bulk_insert(Unit, ('type', 'area', 'player', 'paid', 'besieging',
+								'must_retreat', 'placed', 'cost', 'power', 'loyalty'), rows)
 
 	def create_assassins(self):
 		""" Assign each player an assassination counter for each of the other players """
-		for p in self.player_set.filter(user__isnull=False):
-			for q in self.player_set.filter(user__isnull=False):
-				if q == p:
-					continue
-				assassin = Assassin()
-				assassin.owner = p
-				assassin.target = q.country
-				assassin.save()
+		players = list(self.player_set.filter(user__isnull=False).values_list('id', 'country'))
+		rows = []
+		for p, country in players:
+			for q, target in players:
+				if q != p:
+					rows.append((p, target))
+		bulk_insert(Assassin, ('owner', 'target'), rows)
 
 	##--------------------------
 	## time controlling methods
 	##--------------------------
 
 	def clear_phase_cache(self):
-		cache_keys = [
-			"game-%s_player_list" % self.pk,
-			"game-%s_all-units" % self.pk,
-			"game-%s_all-areas" % self.pk,
-		]
-		for k in cache_keys:
-			cache.delete(k)
+		self.bump_cache_version()
 
 	def get_highest_karma(self):
 		""" Returns the karma of the non-finished player with the highest value.
@@ -673,6 +717,18 @@ class Game(models.Model):
 		return self.last_phase_change + duration
 	
 
+	def update_deadline(self):
+		""" Stores in ``next_deadline`` when the game must be checked again:
+		now, if all the players are done, or the time of the next compulsory
+		phase change. """
+		if self.phase == PHINACTIVE:
+			deadline = None
+		elif self.player_set.filter(done=False).count() == 0:
+			deadline = datetime.now()
+		else:
+			deadline = self.next_phase_change()
+		Schedule.objects.filter(game=self.id).update(next_deadline=deadline)
+
 	def force_phase_change(self):
 		""" When the time limit is reached and one or more of the players are not
 		done, a phase change is forced.
@@ -706,7 +762,7 @@ class Game(models.Model):
 					pass
 				elif self.phase == PHRETREATS:
 					## disband the units that should retreat
-					Unit.objects.filter(player=p).exclude(must_retreat__exact='').delete()
+					self.delete_in_batch(Unit.objects.filter(player=p).exclude(must_retreat__exact=''))
 				p.end_phase(forced=True)
 		
 	def time_to_limit(self):
@@ -723,6 +779,27 @@ class Game(models.Model):
 		"""
 		return self.time_to_limit() <= timedelta(0, 0)
 
+	def lock(self, timeout=LOCK_TIMEOUT):
+		""" Takes the lock of the game, so that no other process can change
+		its phase. Returns False if the lock is held by other process and it
+		has not been held for more than ``timeout`` seconds. """
+		now = datetime.now()
+		limit = now - timedelta(0, timeout)
+		free = Schedule.objects.filter(Q(locked__isnull=True) | Q(locked__lt=limit),
+									game=self.id)
+		if free.update(locked=now) == 1:
+			## only the process that took the lock can release it
+			self._locked = now
+			return True
+		return False
+
+	def unlock(self):
+		""" Releases the lock taken by ``lock``. """
+		locked = getattr(self, '_locked', None)
+		if locked:
+			Schedule.objects.filter(game=self.id, locked=locked).update(locked=None)
+			self._locked = None
+
 	def check_finished_phase(self):
 		""" This method is to be called by a management script, called by cron.
 		It checks if all the players are done, then process the phase.
@@ -736,11 +813,31 @@ class Game(models.Model):
 		for p in players:
 			if not p.done:
 				msg += u"At least a player is not done.\n"
+				## karma may have changed since the deadline was calculated
+				self.update_deadline()
 				return False
 		msg += u"All players done.\n"
 		if logging:
 			logging.info(msg)
-		self.all_players_done()
+		## take snapshots of the game before and after processing the phase
+		turn = (self.year, self.season, self.phase)
+		save_snapshot(self)
+		rng = self.get_dice()
+		profiling.start(self)
+		if signals:
+			signals.phase_started.send(sender=self)
+		processed = False
+		try:
+			self.process_phase(rng)
+			processed = True
+		finally:
+			timings = profiling.stop(self)
+			## the events of a failed phase are discarded
+			if signals and not processed:
+				signals.phase_finished.send(sender=self, processed=False)
+		profiling.save(self, turn, timings)
+		save_snapshot(self, turn, after=True)
+		self.log_dice(rng, turn)
 		self.clear_phase_cache()
 		## If I don't reload players, p.new_phase overwrite the changes made by
 		## self.assign_incomes()
@@ -748,8 +845,20 @@ class Game(models.Model):
 		players = self.player_set.all()
 		for p in players:
 			p.new_phase()
+		self.update_deadline()
+		## the orders that the units can be given in the new phase
+		if self.phase == PHORDERS:
+			orders.update_legal_orders(self)
 
 	
+	@atomic
+	def process_phase(self, rng):
+		""" Processes the phase and saves its events in a single transaction,
+		so that nothing is saved if the processing fails. """
+		self.all_players_done(rng)
+		if signals:
+			signals.phase_finished.send(sender=self, processed=True)
+
 	def check_bonus_time(self):
 		""" Returns true if, when the function is called, the first BONUS_TIME% of the
 		duration has not been reached.
@@ -769,9 +878,6 @@ class Game(models.Model):
 		return self.last_phase_change + duration
 	
 	def _next_season(self):
-		## take a snapshot of the units layout
-		#thread.start_new_thread(save_snapshot, (self,))
-		save_snapshot(self)
 		if self.season == 3:
 			self.season = 1
 			self.year += 1
@@ -781,26 +887,49 @@ class Game(models.Model):
 		Unit.objects.filter(player__game=self).update(must_retreat='')
 		GameArea.objects.filter(game=self).update(standoff=False)
 
-	def all_players_done(self):
+	def get_dice(self):
+		""" Returns the ``Dice`` for the current phase, which records its
+		rolls. """
+		if not self.dice_seed:
+			## the game was created before the dice were seeded
+			seed = random.randint(1, 2147483647)
+			if Game.objects.filter(id=self.id, dice_seed=0).update(dice_seed=seed) == 0:
+				seed = Game.objects.filter(id=self.id).values_list('dice_seed', flat=True)[0]
+			self.dice_seed = seed
+		seed = "%s-%s-%s-%s" % (self.dice_seed, self.year, self.season, self.phase)
+		return dice.Dice(seed, record=True)
+
+	def log_dice(self, rng, turn):
+		""" Saves the rolls of the dice in a phase in a TurnLog. """
+		if len(rng.rolls) == 0:
+			return
+		log = u"Dice rolls (seed %s):\n%s" % (rng.seed, rng.format_rolls())
+		turn_log = TurnLog(game=self, year=turn[0], season=turn[1],
+							phase=turn[2], log=log)
+		turn_log.save()
+
+	def all_players_done(self, rng=None):
 		end_season = False
 		if self.phase == PHINACTIVE:
 			return
-		elif self.phase == PHREINFORCE:
+		if rng is None:
+			rng = self.get_dice()
+		if self.phase == PHREINFORCE:
 			self.adjust_units()
 			next_phase = PHORDERS
 		elif self.phase == PHORDERS:
 			if self.configuration.lenders:
 				self.check_loans()
 			if self.configuration.finances:
-				self.process_expenses()
+				self.process_expenses(rng)
 			if self.configuration.assassinations:
-				self.process_assassinations()
+				self.process_assassinations(rng)
 			if self.configuration.assassinations or self.configuration.lenders:
 				## if a player is assassinated, all his orders become 'H'
 				for p in self.player_set.filter(assassinated=True):
 					p.cancel_orders()
 					for area in p.gamearea_set.exclude(board_area__is_sea=True):
-						area.check_assassination_rebellion()
+						area.check_assassination_rebellion(rng)
 			self.process_orders()
 			Order.objects.filter(unit__player__game=self).delete()
 			retreats_count = Unit.objects.filter(player__game=self).exclude(must_retreat__exact='').count()
@@ -821,10 +950,10 @@ class Game(models.Model):
 					## reset famine markers
 					self.gamearea_set.all().update(famine=False)
 					## check plagues
-					self.kill_plague_units()
+					self.kill_plague_units(rng)
 			elif self.season == 2:
 				## if storms are enabled, place storm markers
-				self.mark_storm_areas()
+				self.mark_storm_areas(rng)
 			elif self.season == 3:
 				## if storms are enabled, delete fleets in storm areas
 				if self.configuration.storms:
@@ -849,11 +978,11 @@ class Game(models.Model):
 					return
 				## if famine enabled, place famine markers
 				if self.configuration.famine:
-					self.mark_famine_areas()
+					self.mark_famine_areas(rng)
 				## if finances are enabled, assign incomes
 				if self.configuration.finances:
 					try:
-						self.assign_incomes()
+						self.assign_incomes(rng)
 					except Exception, e:
 						print "Error assigning incomes in game %s:\n" % self.id
 						print e
@@ -881,6 +1010,7 @@ class Game(models.Model):
 		self.make_map()
 		self.notify_players("new_phase", {"game": self})
     
+	@profiling.profile_step
 	def adjust_units(self):
 		""" Places new units and disbands the ones that are not paid """
 		to_disband = Unit.objects.filter(player__game=self, paid=False)
@@ -912,71 +1042,75 @@ class Game(models.Model):
 		if not self.configuration.conquering:
 			return
 		## a player can only be conquered if he is eliminated
+		template = scenarios.get_template(self.scenario_id)
 		for p in self.player_set.filter(eliminated=True):
+			home_ids = template.get_home_country(p.country_id)
 			## try fo find a home province that is not controlled by any player
 			neutral = GameArea.objects.filter(game=self,
-									board_area__home__country=p.country,
-									board_area__home__scenario=self.scenario,
-									board_area__home__is_home=True,
+									board_area__id__in=home_ids,
 									player__isnull=True).count()
 			if neutral > 0:
 				continue
 			## get the players that control part of this player's home country
-			controllers = self.player_set.filter(gamearea__board_area__home__country=p.country,
-									gamearea__board_area__home__scenario=self.scenario,
-									gamearea__board_area__home__is_home=True).distinct()
+			controllers = self.player_set.filter(gamearea__board_area__id__in=home_ids).distinct()
 			if len(controllers) == 1:
 				## all the areas in home country belong to the same player
 				if p != controllers[0] and p.conqueror != controllers[0]:
 					## controllers[0] conquers p
 					p.set_conqueror(controllers[0])
 
-	def mark_famine_areas(self):
+	def mark_famine_areas(self, rng=None):
 		if not self.configuration.famine:
 			return
-		codes = disasters.get_famine()
+		if rng is None:
+			rng = self.get_dice()
+		codes = disasters.get_famine(rng)
 		famine_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
 		for f in famine_areas:
 			f.famine=True
 			f.save()
 			signals.famine_marker_placed.send(sender=f)
 	
-	def mark_storm_areas(self):
+	def mark_storm_areas(self, rng=None):
 		if not self.configuration.storms:
 			return
-		codes = disasters.get_storms()
+		if rng is None:
+			rng = self.get_dice()
+		codes = disasters.get_storms(rng)
 		storm_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
 		for f in storm_areas:
 			f.storm=True
 			f.save()
 			signals.storm_marker_placed.send(sender=f)
 	
-	def kill_plague_units(self):
+	def kill_plague_units(self, rng=None):
 		if not self.configuration.plague:
 			return
-		codes = disasters.get_plague()
+		if rng is None:
+			rng = self.get_dice()
+		codes = disasters.get_plague(rng)
 		plague_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
 		for p in plague_areas:
 			signals.plague_placed.send(sender=p)
 			for u in p.unit_set.all():
 				u.delete()
 
-	def assign_incomes(self):
+	@profiling.profile_step
+	def assign_incomes(self, rng=None):
 		""" Gets each player's income and add it to the player's treasury """
+		if rng is None:
+			rng = self.get_dice()
 		## get the column for variable income
-		die = dice.roll_1d6()
+		die = rng.roll_1d6("Variable income")
 		if logging:
 			msg = "Varible income: Got a %s in game %s" % (die, self)
 			logging.info(msg)
-		## get a list of the ids of the major cities that generate income
-		majors = CityIncome.objects.filter(scenario=self.scenario)
-		majors_ids = majors.values_list('city', flat=True)
-		##
-		players = self.player_set.filter(user__isnull=False, eliminated=False)
-		for p in players:
-			i = p.get_income(die, majors_ids)
-			if i > 0:
-				p.add_ducats(i)
+		player_incomes = incomes.get_incomes(self, die)
+		incomes.add_incomes(player_incomes)
+		if logging:
+			for i in player_incomes:
+				msg = "Player %s raised %s ducats (%s)." % (i.player.pk, i.total(), unicode(i))
+				logging.info(msg)
 
 	def check_loans(self):
 		""" Check if any loans have exceeded their terms. If so, apply the
@@ -993,64 +1127,110 @@ class Game(models.Model):
 				loan.player.assassinate()
 				loan.delete()
 	
-	def process_expenses(self):
+	@profiling.profile_step
+	def process_expenses(self, rng=None):
+		""" Resolves all the expenses in the game. When two bribes on the same
+		unit have the same value, the successful one is chosen with ``rng``,
+		or with the dice of the current phase if it is not given. """
 		## undo unconfirmed expenses
 		invalid_expenses = Expense.objects.filter(player__game=self, confirmed=False)
 		for e in invalid_expenses:
 			e.undo()
+		expenses = Expense.objects.filter(player__game=self, confirmed=True)
+		expenses = list(expenses.select_related('player__country', 'area__board_area',
+										'unit__area__board_area'))
 		## log expenses
 		if signals:
-			for e in Expense.objects.filter(player__game=self, confirmed=True):
+			for e in expenses:
 				signals.expense_paid.send(sender=e)
 		## then, process famine reliefs
-		for e in Expense.objects.filter(player__game=self, type=0):
-			e.area.famine = False
-			e.area.save()
+		reliefs = [e.area_id for e in expenses if e.type == 0]
+		if len(reliefs) > 0:
+			GameArea.objects.filter(id__in=reliefs).update(famine=False)
 		## then, delete the rebellions
-		for e in Expense.objects.filter(player__game=self, type=1):
-			Rebellion.objects.filter(area=e.area).delete()
+		pacified = [e.area_id for e in expenses if e.type == 1]
+		if len(pacified) > 0:
+			Rebellion.objects.filter(area__id__in=pacified).delete()
 		## then, place new rebellions
-		for e in Expense.objects.filter(player__game=self, type__in=(2,3)):
-			try:
-				rebellion = Rebellion(area=e.area)
-				rebellion.save()
-			except:
-				continue
-		## then, delete bribes that are countered
-		expenses = Expense.objects.filter(player__game=self)
+		for e in expenses:
+			if e.type in (2, 3):
+				try:
+					rebellion = Rebellion(area=e.area)
+					rebellion.save()
+				except:
+					continue
+		## then, discard bribes that are countered
+		counter_bribes = {}
+		for e in expenses:
+			if e.type == 4:
+				counter_bribes[e.unit_id] = counter_bribes.get(e.unit_id, 0) + e.ducats
+		bribes = {}
 		for e in expenses:
 			if e.is_bribe():
-				## get the sum of counter-bribes
-				cb = Expense.objects.filter(player__game=self, type=4, unit=e.unit).aggregate(Sum('ducats'))
-				if not cb['ducats__sum']:
-					cb['ducats__sum'] = 0
-				total_cost = get_expense_cost(e.type, e.unit) + cb['ducats__sum']
-				if total_cost > e.ducats:
-					e.delete()
+				total_cost = get_expense_cost(e.type, e.unit) + counter_bribes.get(e.unit_id, 0)
+				if total_cost <= e.ducats:
+					bribes.setdefault(e.unit_id, []).append(e)
 		## then, resolve the bribes for each bribed unit
-		bribed_ids = Expense.objects.filter(unit__player__game=self, type__in=(5,6,7,8,9)).values_list('unit', flat=True).distinct()
+		if rng is None:
+			rng = self.get_dice()
 		chosen = []
-		## TODO: if two bribes have the same value, decide randomly between them
-		for i in bribed_ids:
-			bribes = Expense.objects.filter(type__in=(5,6,7,8,9), unit__id=i).order_by('-ducats')
-			chosen.append(bribes[0])
+		for unit_id in sorted(bribes.keys()):
+			highest = max([e.ducats for e in bribes[unit_id]])
+			tied = [e for e in bribes[unit_id] if e.ducats == highest]
+			tied.sort(key=lambda e: e.id)
+			if len(tied) > 1:
+				chosen.append(rng.choice(tied, "Bribes on unit %s" % unit_id))
+			else:
+				chosen.append(tied[0])
 		## all bribes in 'chosen' are successful, and executed
+		disbanded = []
+		bought = {}
+		autonomous = []
 		for c in chosen:
 			if c.type in (5, 8): #disband unit
-				c.unit.delete()
+				disbanded.append(c.unit)
 			elif c.type in (6, 9): #buy unit
-				c.unit.change_player(c.player)
+				c.unit.player = c.player
+				bought.setdefault(c.player.id, []).append(c.unit)
 			elif c.type == 7: #to autonomous
-				c.unit.to_autonomous()
+				autonomous.append(c.unit)
+		if len(disbanded) > 0:
+			if signals:
+				for u in disbanded:
+					signals.unit_disbanded.send(sender=u)
+			self.delete_in_batch(Unit.objects.filter(id__in=[u.id for u in disbanded]))
+		for player_id, units in bought.items():
+			Unit.objects.filter(id__in=[u.id for u in units]).update(player=player_id)
+			## put down the rebellions against other players
+			areas = [u.area_id for u in units]
+			Rebellion.objects.filter(area__id__in=areas).exclude(player__id=player_id).delete()
+			if signals:
+				for u in units:
+					signals.unit_changed_country.send(sender=u)
+		if len(autonomous) > 0:
+			try:
+				aplayer = Player.objects.get(game=self, user__isnull=True)
+			except ObjectDoesNotExist:
+				pass
+			else:
+				Unit.objects.filter(id__in=[u.id for u in autonomous]).update(player=aplayer, paid=True)
+				for u in autonomous:
+					u.player = aplayer
+					u.paid = True
+					if signals:
+						signals.unit_to_autonomous.send(sender=u)
 		## finally, delete all the expenses
-		Expense.objects.filter(player__game=self).delete()
+		self.delete_in_batch(Expense.objects.filter(player__game=self))
 
 	def get_rebellions(self):
 		""" Returns a queryset with all the rebellions in this game """
 		return Rebellion.objects.filter(area__game=self)
 
-	def process_assassinations(self):
+	@profiling.profile_step
+	def process_assassinations(self, rng=None):
 		""" Resolves all the assassination attempts """
+		if rng is None:
+			rng = self.get_dice()
 		attempts = Assassination.objects.filter(killer__game=self)
 		victims = []
 		msg = u"Processing assassinations in game %s:\n" % self
@@ -1064,7 +1244,7 @@ class Game(models.Model):
 				msg += u"%s are not enough" % a.ducats
 				continue
 			msg += u"%s dice will be rolled\n" % dice_rolled
-			if dice.check_one_six(dice_rolled):
+			if rng.check_one_six(dice_rolled, "Assassination of %s" % a.target.static_name):
 				msg += u"Attempt is successful\n"
 				## attempt is successful
 				a.target.assassinate()
@@ -1138,6 +1318,9 @@ class Game(models.Model):
 		"""
 
 		info = u"Step 3: Cancel convoys by fleets that will be dislodged.\n"
+		## convoy orders do not change the supports, so the table is valid
+		## for the whole step
+		table = Unit.objects.get_support_table(self)
 		## find units attacking fleets
 		sea_attackers = Unit.objects.filter(Q(player__game=self),
 											(Q(order__code__exact='-') &
@@ -1164,8 +1347,8 @@ class Game(models.Model):
 				continue
 			else:
 				info += u"Convoying %s is being attacked by %s.\n" % (defender, s)
-				a_strength = Unit.objects.get_with_strength(self, id=s.id).strength
-				d_strength = Unit.objects.get_with_strength(self, id=defender.id).strength
+				a_strength = Unit.objects.get_with_strength(self, table, id=s.id).strength
+				d_strength = Unit.objects.get_with_strength(self, table, id=defender.id).strength
 				if a_strength > d_strength:
 					d_order = defender.get_order()
 					if d_order:
@@ -1189,9 +1372,13 @@ class Game(models.Model):
 					info += u"Impossible attack: %s.\n" % o
 					o.delete()
 				else:
-					if not o.find_convoy_line():
+					path = o.find_convoy_line()
+					if not path:
 						info += u"Impossible attack: %s.\n" % o
 						o.delete()
+					else:
+						info += u"%s is convoyed through %s.\n" % (o.unit,
+							u", ".join([a.board_area.code for a in path[1:-1]]))
 		return info
 	
 	def resolve_auto_garrisons(self):
@@ -1227,6 +1414,8 @@ class Game(models.Model):
 		## strength = 1 means unit without supports
 		info = u"Step 5: Process conflicts.\n"
 		units = Unit.objects.list_with_strength(self)
+		## the table is updated when a support order is deleted
+		table = Unit.objects.get_support_table(self)
 		conditioned_invasions = []
 		conditioned_origins = []
 		finances = self.configuration.finances
@@ -1266,7 +1455,7 @@ class Game(models.Model):
 			## standoff.
 			## if not, check for defenders
 			for r in rivals:
-				strength = Unit.objects.get_with_strength(self, id=r.id).strength
+				strength = Unit.objects.get_with_strength(self, table, id=r.id).strength
 				info += u"Rival %s has strength %s.\n" % (r, strength)
 				if strength >= s: #in fact, strength cannot be greater
 					info += u"Rival wins.\n"
@@ -1295,7 +1484,7 @@ class Game(models.Model):
 						strength = s
 						info += u"Defender is a friend.\n"
 					else:
-						strength = Unit.objects.get_with_strength(self,
+						strength = Unit.objects.get_with_strength(self, table,
 														id=defender.id).strength
 					info += u"Defender %s has strength %s.\n" % (defender, strength)
 					## if attacker is not as strong as defender
@@ -1328,7 +1517,7 @@ class Game(models.Model):
 						elif u_order.code == '=':
 							info += u"Converting into %s.\n" % u_order.type
 							u.convert(u_order.type)
-						defender.delete_order()
+						defender.delete_order(table)
 				## no defender means either that the area is empty *OR*
 				## that there is a unit trying to leave the area
 				else:
@@ -1519,6 +1708,7 @@ class Game(models.Model):
 				self.log_event(UnitEvent, type=u.type, area=u.area.board_area, message=1)
 		return info
 
+	@profiling.profile_step
 	def preprocess_orders(self):
 		"""
 		Deletes unconfirmed orders and logs confirmed ones.
@@ -1547,28 +1737,38 @@ class Game(models.Model):
 		"""
 
 		self.preprocess_orders()
+		if LEGACY_ADJUDICATION:
+			board = None
+			steps = self
+		else:
+			## load the game once and resolve the turn in memory
+			board = adjudicator.Board.load(self)
+			steps = adjudicator.Adjudicator(board)
 		info = u"Processing orders in game %s\n" % self.slug
 		info += u"------------------------------\n\n"
 		## resolve =G that are not opposed
-		info += self.resolve_auto_garrisons()
+		info += profiling.run_step(self, 'resolve_auto_garrisons', steps.resolve_auto_garrisons)
 		info += u"\n"
 		## delete supports from units in conflict areas
-		info += self.filter_supports()
+		info += profiling.run_step(self, 'filter_supports', steps.filter_supports)
 		info += u"\n"
 		## delete convoys that will be invaded
-		info += self.filter_convoys()
+		info += profiling.run_step(self, 'filter_convoys', steps.filter_convoys)
 		info += u"\n"
 		## delete attacks to areas that are not reachable
-		info += self.filter_unreachable_attacks()
+		info += profiling.run_step(self, 'filter_unreachable_attacks', steps.filter_unreachable_attacks)
 		info += u"\n"
 		## process conflicts
-		info += self.resolve_conflicts()
+		info += profiling.run_step(self, 'resolve_conflicts', steps.resolve_conflicts)
 		info += u"\n"
 		## resolve sieges
-		info += self.resolve_sieges()
+		info += profiling.run_step(self, 'resolve_sieges', steps.resolve_sieges)
 		info += u"\n"
-		info += self.announce_retreats()
+		info += profiling.run_step(self, 'announce_retreats', steps.announce_retreats)
 		info += u"--- END ---\n"
+		if board:
+			## write all the changes in a single transaction
+			profiling.run_step(self, 'save_board', board.save)
 		if logging:
 			logging.info(info)
 		turn_log = TurnLog(game=self, year=self.year,
@@ -1577,6 +1777,7 @@ class Game(models.Model):
 							log=info)
 		turn_log.save()
 
+	@profiling.profile_step
 	def process_retreats(self):
 		""" From the saved RetreaOrders, process the retreats. """
 
@@ -1596,29 +1797,50 @@ class Game(models.Model):
 				unit.retreat(order.area)
 				order.delete()
 	
+	@profiling.profile_step
 	def update_controls(self):
 		""" Checks which GameAreas have been controlled by a Player and update them.
+		The players in each area are read with a single query, and the areas
+		that change are updated with a query per new controller.
 		"""
 
-		for area in GameArea.objects.filter(Q(game=self) &
-								Q(unit__isnull=False) &
-								(Q(board_area__is_sea=False) |
-								Q(board_area__code__exact='VEN'))).distinct():
-			players = self.player_set.filter(unit__area=area).distinct()
-			if len(players) > 2:
-				err_msg = "%s units in %s (game %s)" % (len(players),area, self)
-				raise exceptions.WrongUnitCount(err_msg)
-			elif len(players) == 1 and players[0].user:
-				if area.player != players[0]:
-					area.player = players[0]
-					area.save()
-					if signals:
-						signals.area_controlled.send(sender=area)
-					else:
-						self.log_event(ControlEvent, country=area.player.country, area=area.board_area)
-			else:
-					area.player = None
-					area.save()
+		## area id -> set of (player id, user id) with units in the area
+		occupants = {}
+		for area, player, user in Unit.objects.filter(Q(player__game=self) &
+								(Q(area__board_area__is_sea=False) |
+								Q(area__board_area__code__exact='VEN'))).values_list('area',
+								'player', 'player__user').distinct():
+			occupants.setdefault(area, set()).add((player, user))
+		wrong = [a for a, players in occupants.items() if len(players) > 2]
+		if len(wrong) > 0:
+			err_msg = "Units of more than two players in areas %s (game %s)" % (wrong, self)
+			raise exceptions.WrongUnitCount(err_msg)
+		controls = dict(self.gamearea_set.filter(id__in=occupants.keys()).values_list('id',
+								'player'))
+		## player id -> ids of the areas that the player gets
+		gained = {}
+		lost = []
+		for area, players in occupants.items():
+			if len(players) == 1:
+				player, user = list(players)[0]
+				if not user is None:
+					if controls[area] != player:
+						gained.setdefault(player, []).append(area)
+					continue
+			if not controls[area] is None:
+				lost.append(area)
+		for player, areas in gained.items():
+			GameArea.objects.filter(id__in=areas).update(player=player)
+		if len(lost) > 0:
+			GameArea.objects.filter(id__in=lost).update(player=None)
+		if signals and len(gained) > 0:
+			ids = []
+			for areas in gained.values():
+				ids.extend(areas)
+			areas = list(GameArea.objects.filter(id__in=ids).select_related('player__country',
+								'board_area'))
+			signals.areas_controlled.send(sender=self, areas=areas)
+		self.bump_cache_version()
 
 	##---------------------
 	## logging methods
@@ -1702,6 +1924,7 @@ class Game(models.Model):
 	## notification methods
 	##------------------------
 
+	@profiling.profile_step
 	def notify_players(self, label, extra_context={}, on_site=True):
 		if notification:
 			users = User.objects.filter(player__game=self,
@@ -1787,11 +2010,11 @@ class GameArea(models.Model):
 
 	def get_adjacent_areas(self, include_self=False):
 		""" Returns a queryset with all the adjacent GameAreas """
+		borders = list(graph.get_graph().get_borders(self.board_area_id))
+		cond = Q(board_area__id__in=borders, game=self.game)
 		if include_self:
-			cond = Q(board_area__borders=self.board_area, game=self.game) | Q(id=self.id)
-		else:
-			cond = Q(board_area__borders=self.board_area, game=self.game)
-		adj = GameArea.objects.filter(cond).distinct()
+			cond = cond | Q(id=self.id)
+		adj = GameArea.objects.filter(cond)
 		return adj
 	
 	def has_rebellion(self, player, same=True):
@@ -1806,18 +2029,20 @@ class GameArea(models.Model):
 			return False
 		return reb
 
-	def check_assassination_rebellion(self):
+	def check_assassination_rebellion(self, rng=None):
 		""" When a player is assassinated this function checks if a new
 		rebellion appears in the game area. """
 		if self.board_area.is_sea:
 			return False
+		if rng is None:
+			rng = self.game.get_dice()
 		## if there are units of other players in the area, there is no rebellion
 		## this is not too clear in the rules
 		if Unit.objects.filter(area=self).exclude(player=self.player).count() > 0:
 			return False
 		if not self.has_rebellion(self.player):
 			result = False
-			die = dice.roll_1d6()
+			die = rng.roll_1d6("Rebellion in %s" % self.board_area.code)
 			try:
 				Unit.objects.get(area=self, player=self.player)
 			except ObjectDoesNotExist:
@@ -1970,10 +2195,9 @@ class Player(models.Model):
 	def home_country(self):
 		""" Returns a queryset with Game Areas in home country. """
 
+		template = scenarios.get_template(self.game.scenario_id)
 		return GameArea.objects.filter(game=self.game,
-									board_area__home__scenario=self.game.scenario,
-									board_area__home__country=self.country,
-									board_area__home__is_home=True)
+						board_area__id__in=template.get_home_country(self.country_id))
 
 	def controlled_home_country(self):
 		""" Returns a queryset with GameAreas in home country controlled by player.
@@ -1990,16 +2214,13 @@ class Player(models.Model):
 		""" Returns a queryset with the GameAreas that accept new units. """
 
 		if self.game.configuration.conquering:
-			conq_countries = []
-			for c in self.conquered.all():
-				conq_countries.append(c.country)
-			areas = GameArea.objects.filter(Q(player=self) &
-										Q(board_area__has_city=True) &
-										Q(board_area__home__scenario=self.game.scenario) &
-										Q(board_area__home__is_home=True) &
-										Q(famine=False) &
-										(Q(board_area__home__country=self.country) |
-										Q(board_area__home__country__in=conq_countries)))
+			conq_countries = self.conquered.values_list('country', flat=True)
+			template = scenarios.get_template(self.game.scenario_id)
+			home_ids = template.get_home_country(self.country_id, *conq_countries)
+			areas = GameArea.objects.filter(player=self,
+										board_area__has_city=True,
+										board_area__id__in=home_ids,
+										famine=False)
 		else:
 			areas = self.controlled_home_cities().exclude(famine=True)
 		excludes = []
@@ -2088,27 +2309,30 @@ class Player(models.Model):
 			#		self.ducats = 0
 			self.save()
 
-	def can_excommunicate(self):
+	def can_excommunicate(self, excommunication=None, pope_excommunicated=None):
 		""" Returns true if player.may_excommunicate and the Player has not excommunicated or
-		forgiven anyone this turn and there is no other player explicitly excommunicated """
+		forgiven anyone this turn and there is no other player explicitly excommunicated.
 
-		if self.eliminated:
+		If they are already known, whether the excommunication rule is enabled
+		and whether a player has been excommunicated by the pope can be given,
+		so that they are not read again. """
+
+		if not self.can_forgive(excommunication):
 			return False
-		if self.game.configuration.excommunication:
-			if self.may_excommunicate and not self.has_sentenced:
-				try:
-					Player.objects.get(game=self.game, pope_excommunicated=True)
-				except ObjectDoesNotExist:
-					return True
-		return False
+		if pope_excommunicated is None:
+			pope_excommunicated = Player.objects.filter(game=self.game_id,
+											pope_excommunicated=True).exists()
+		return not pope_excommunicated
 
-	def can_forgive(self):
+	def can_forgive(self, excommunication=None):
 		""" Returns true if player.may_excommunicate and the Player has not excommunicated or
 		forgiven anyone this turn. """
 		
 		if self.eliminated:
 			return False
-		if self.game.configuration.excommunication:
+		if excommunication is None:
+			excommunication = self.game.configuration.excommunication
+		if excommunication:
 			if self.may_excommunicate and not self.has_sentenced:
 				return True
 		return False
@@ -2159,6 +2383,8 @@ class Player(models.Model):
 			## delete possible revolutions
 			Revolution.objects.filter(government=self).delete()
 			msg = "Player %s ended phase" % self.pk
+			## the highest karma may change, or all the players may be done
+			self.game.update_deadline()
 		else:
 			self.force_phase_change()
 			msg = "Player %s forced to end phase" % self.pk
@@ -2190,15 +2416,18 @@ class Player(models.Model):
 				self.done = False
 			self.save()
 
-	def next_phase_change(self):
+	def next_phase_change(self, karma=None):
 		""" Returns the time that the next forced phase change would happen,
-		if this were the only player (i.e. only his own karma is considered)
+		if this were the only player (i.e. only his own karma is considered).
+		The karma of the user can be given, so that it is not read again.
 		"""
 		
 		if self.game.fast:
 			karma = 100.
-		else:
+		elif karma is None:
 			karma = float(self.user.get_profile().karma)
+		else:
+			karma = float(karma)
 		if karma > 100:
 			if self.game.phase == PHORDERS:
 				k = 1 + (karma - 100) / 200
@@ -2212,24 +2441,24 @@ class Player(models.Model):
 
 		return self.game.last_phase_change + duration
 	
-	def time_to_limit(self):
+	def time_to_limit(self, karma=None):
 		"""
 		Calculates the time to the next phase change and returns it as a
 		timedelta.
 		"""
-		return self.next_phase_change() - datetime.now()
+		return self.next_phase_change(karma) - datetime.now()
 	
-	def in_last_seconds(self):
+	def in_last_seconds(self, karma=None):
 		"""
 		Returns True if the next phase change would happen in a few minutes.
 		"""
-		return self.time_to_limit() <= timedelta(seconds=settings.LAST_SECONDS)
+		return self.time_to_limit(karma) <= timedelta(seconds=settings.LAST_SECONDS)
 	
-	def time_exceeded(self):
+	def time_exceeded(self, karma=None):
 		""" Returns true if the player has exceeded his own time, and he is playing because
 		other players have not yet finished. """
 
-		return self.next_phase_change() < datetime.now()
+		return self.next_phase_change(karma) < datetime.now()
 
 	def get_time_status(self):
 		""" Returns a string describing the status of the player depending on the time limits.
@@ -2409,29 +2638,30 @@ def notify_overthrow_attempt(sender, instance, created, **kw):
 models.signals.post_save.connect(notify_overthrow_attempt, sender=Revolution)
 
 class UnitManager(models.Manager):
-	def get_with_strength(self, game, **kwargs):
+	def get_support_table(self, game):
+		""" Returns an ``adjudicator.SupportTable`` with the power of all the
+		support orders in the game, using a single query. """
+		table = adjudicator.SupportTable()
+		supports = Order.objects.filter(unit__player__game=game,
+									code__exact='S').values_list('subunit',
+									'subcode', 'subdestination', 'subtype',
+									'unit__power')
+		for subunit, subcode, subdestination, subtype, power in supports:
+			table.add(subunit, subcode, subdestination, subtype, power)
+		return table
+
+	def get_with_strength(self, game, table=None, **kwargs):
+		""" Returns a unit with a temporary strength attribute. If ``table``
+		is not given, a new support table is built. """
 		u = self.get_query_set().get(**kwargs)
-		query = Q(unit__player__game=game,
-				  code__exact='S',
-				  subunit=u)
+		if table is None:
+			table = self.get_support_table(game)
 		u_order = u.get_order()
 		if not u_order:
-			query &= Q(subcode__exact='H')
-		else:
-			if u_order.code in ('', 'H', 'S', 'C', 'B'): #unit is holding
-				query &= Q(subcode__exact='H')
-			elif u_order.code == '=':
-				query &= Q(subcode__exact='=',
-						   subtype=u_order.type)
-			elif u_order.code == '-':
-				query &= Q(subcode__exact='-',
-						   subdestination=u_order.destination)
-		#support = Order.objects.filter(query).count()
-		support_sum = Order.objects.filter(query).aggregate(Sum('unit__power'))
-		if support_sum['unit__power__sum'] is None:
-			support = 0
+			support = table.get_support(u.id)
 		else:
-			support = int(support_sum['unit__power__sum'])
+			support = table.get_support(u.id, u_order.code,
+										u_order.destination_id, u_order.type)
 		if game.configuration.finances:
 			if not u_order or u_order.code in ('', 'H', 'S', 'C', 'B'):
 				if u.area.has_rebellion(u.player, same=True):
@@ -2440,6 +2670,8 @@ class UnitManager(models.Manager):
 		return u
 
 	def list_with_strength(self, game):
+		""" Returns a list with all the units in the game, with a temporary
+		strength attribute, sorted by strength. """
 		from django.db import connection
 		cursor = connection.cursor()
 		cursor.execute("SELECT u.id, \
@@ -2459,33 +2691,21 @@ class UnitManager(models.Manager):
 		FROM (machiavelli_player p INNER JOIN machiavelli_unit u on p.id=u.player_id) \
 		LEFT JOIN machiavelli_order o ON u.id=o.unit_id \
 		WHERE p.game_id=%s" % game.id)
+		table = self.get_support_table(game)
+		finances = game.configuration.finances
+		if finances:
+			## (area, player) of every rebellion in the game
+			rebellions = set(Rebellion.objects.filter(area__game=game).values_list('area', 'player'))
 		result_list = []
 		for row in cursor.fetchall():
-			holding = False
-			support_query = Q(unit__player__game=game,
-							  code__exact='S',
-							  subunit__pk=row[0])
-			if row[11] in (None, '', 'H', 'S', 'C', 'B'): #unit is holding
-				support_query &= Q(subcode__exact='H')
-				holding = True
-			elif row[11] == '=':
-				support_query &= Q(subcode__exact='=',
-						   		subtype__exact=row[13])
-			elif row[11] == '-':
-				support_query &= Q(subcode__exact='-',
-								subdestination__pk__exact=row[12])
-			#support = Order.objects.filter(support_query).count()
-			support_sum = Order.objects.filter(support_query).aggregate(Sum('unit__power'))
-			if support_sum['unit__power__sum'] is None:
-				support = 0
-			else:
-				support = int(support_sum['unit__power__sum'])
+			holding = row[11] in (None, '', 'H', 'S', 'C', 'B')
+			support = table.get_support(row[0], row[11], row[12], row[13])
 			unit = self.model(id=row[0], type=row[1], area_id=row[2],
 							player_id=row[3], besieging=row[4],
 							must_retreat=row[5], placed=row[6], paid=row[7],
 							cost=row[8], power=row[9], loyalty=row[10])
-			if game.configuration.finances:
-				if holding and unit.area.has_rebellion(unit.player, same=True):
+			if finances:
+				if holding and (row[2], row[3]) in rebellions:
 					support -= 1
 			unit.strength = unit.power + support
 			result_list.append(unit)
@@ -2579,7 +2799,9 @@ class Unit(models.Model):
 		## same area where the unit is located (convert to garrison)
 		cond = Q(game=self.player.game)
 		cond = cond & Q(standoff=False)
-		cond = cond & Q(board_area__borders=self.area.board_area)
+		adjacency = graph.get_graph()
+		borders = adjacency.get_borders(self.area.board_area_id)
+		cond = cond & Q(board_area__id__in=list(borders))
 		## exclude the area where the attack came from
 		cond = cond & ~Q(board_area__code__exact=self.must_retreat)
 		## exclude areas with 'A' or 'F'
@@ -2590,11 +2812,8 @@ class Unit(models.Model):
 			cond = cond & ~Q(board_area__code__exact='VEN')
 		## for fleets, exclude areas that are adjacent but their coasts are not
 		elif self.type == 'F':
-			exclude = []
-			for area in self.area.board_area.borders.all():
-				if not area.is_adjacent(self.area.board_area, fleet=True):
-					exclude.append(area.id)
-			cond = cond & ~Q(board_area__id__in=exclude)
+			exclude = borders - adjacency.get_borders(self.area.board_area_id, fleet=True)
+			cond = cond & ~Q(board_area__id__in=list(exclude))
 			## for fleets, exclude areas that are not seas or coasts
 			cond = cond & ~Q(board_area__is_sea=False, board_area__is_coast=False)
 		## add the own area if there is no garrison
@@ -2664,9 +2883,14 @@ class Unit(models.Model):
 		if reb:
 			reb.delete()
 
-	def delete_order(self):
+	def delete_order(self, table=None):
+		""" Deletes the order of the unit. If a support table is given and
+		the order is a support, its power is removed from the table. """
 		order = self.get_order()
 		if order:
+			if table and order.code == 'S':
+				table.remove(order.subunit_id, order.subcode,
+							order.subdestination_id, order.subtype, self.power)
 			order.delete()
 		return True
 
@@ -2822,41 +3046,25 @@ class Order(models.Model):
 		return f
 
 	def find_convoy_line(self):
-		""" Returns True if there is a continuous line of convoy orders from 
-		the origin to the destination of the order.
+		""" Returns the list of GameAreas in a continuous line of convoy orders
+		from the origin to the destination of the order, or an empty list.
 		"""
 
-		origins = [self.unit.area,]
-		destination = self.destination
-		## get all areas convoying this order AND the destination
-		convoy_areas = GameArea.objects.filter(
-						## in this game
-						(Q(game=self.unit.player.game) &
-						## being sea areas
-						Q(board_area__is_sea=True) &
-						## with convoy orders
-						Q(unit__order__code__exact='C') &
-						## convoying this unit
-						Q(unit__order__subunit=self.unit) &
-						## convoying to this destination
-						Q(unit__order__subdestination=self.destination)) |
-						## OR being the destination
-						Q(id=self.destination.id))
-		if len(convoy_areas) <= 1:
-			return False
-		while 1:
-			new_origins = []
-			for o in origins:
-				borders = GameArea.objects.filter(game=self.unit.player.game,
-												board_area__borders=o.board_area)
-				for b in borders:
-					if b == destination:
-						return True
-					if b in convoy_areas:
-						new_origins.append(b)
-			if len(new_origins) == 0:
-				return False
-			origins = new_origins	
+		## get all sea areas convoying this order
+		convoy_areas = GameArea.objects.filter(game=self.unit.player.game,
+						board_area__is_sea=True,
+						unit__order__code__exact='C',
+						unit__order__subunit=self.unit,
+						unit__order__subdestination=self.destination)
+		areas = dict([(a.board_area_id, a) for a in convoy_areas])
+		if len(areas) == 0:
+			return []
+		areas[self.unit.area.board_area_id] = self.unit.area
+		areas[self.destination.board_area_id] = self.destination
+		path = graph.get_graph().find_convoy_path(self.unit.area.board_area_id,
+												self.destination.board_area_id,
+												areas)
+		return [areas[b] for b in path]
 	
 	def get_enemies(self):
 		""" Returns a Queryset with all the units trying to oppose an advance or
@@ -3092,6 +3300,35 @@ class AFToken(models.Model):
 	def __unicode__(self):
 		return "%s, %s" % (self.x, self.y)
 
+models.signals.post_save.connect(graphics.clear_cache, sender=ControlToken)
+models.signals.post_delete.connect(graphics.clear_cache, sender=ControlToken)
+models.signals.post_save.connect(graphics.clear_cache, sender=GToken)
+models.signals.post_delete.connect(graphics.clear_cache, sender=GToken)
+models.signals.post_save.connect(graphics.clear_cache, sender=AFToken)
+models.signals.post_delete.connect(graphics.clear_cache, sender=AFToken)
+models.signals.post_save.connect(graphics.clear_cache, sender=DisabledArea)
+models.signals.post_delete.connect(graphics.clear_cache, sender=DisabledArea)
+models.signals.post_save.connect(graphics.clear_cache, sender=CityIncome)
+models.signals.post_delete.connect(graphics.clear_cache, sender=CityIncome)
+models.signals.post_save.connect(graphics.clear_cache, sender=Home)
+models.signals.post_delete.connect(graphics.clear_cache, sender=Home)
+
+
+models.signals.post_save.connect(scenarios.clear_cache, sender=Area)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=Area)
+models.signals.post_save.connect(scenarios.clear_cache, sender=Country)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=Country)
+models.signals.post_save.connect(scenarios.clear_cache, sender=DisabledArea)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=DisabledArea)
+models.signals.post_save.connect(scenarios.clear_cache, sender=Home)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=Home)
+models.signals.post_save.connect(scenarios.clear_cache, sender=Setup)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=Setup)
+models.signals.post_save.connect(scenarios.clear_cache, sender=Treasury)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=Treasury)
+models.signals.post_save.connect(scenarios.clear_cache, sender=CityIncome)
+models.signals.post_delete.connect(scenarios.clear_cache, sender=CityIncome)
+
 class TurnLog(models.Model):
 	""" A TurnLog is text describing the processing of the method
 	``Game.process_orders()``.
@@ -3110,6 +3347,123 @@ class TurnLog(models.Model):
 	def __unicode__(self):
 		return self.log
 
+class StepTiming(models.Model):
+	""" The cost of a step in the processing of a phase, as measured by
+	``machiavelli.profiling``. ``rows`` is the number of rows returned or
+	changed by the queries. """
+
+	game = models.ForeignKey(Game)
+	year = models.PositiveIntegerField()
+	season = models.PositiveIntegerField(choices=SEASONS)
+	phase = models.PositiveIntegerField(choices=GAME_PHASES)
+	step = models.CharField(max_length=30)
+	seconds = models.FloatField()
+	queries = models.PositiveIntegerField()
+	rows = models.PositiveIntegerField()
+	timestamp = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		ordering = ['-timestamp',]
+
+	def __unicode__(self):
+		return u"%s: %.3f seconds, %s queries" % (self.step, self.seconds, self.queries)
+
+class Schedule(models.Model):
+	""" The lock of a game and the time when it must be checked again. They
+	are only changed with single updates by ``Game.lock``, ``Game.unlock`` and
+	``Game.update_deadline``, so that saving a Game that was read before
+	cannot overwrite them. """
+
+	game = models.OneToOneField(Game, primary_key=True)
+	## when a process took the lock to change the phase of the game
+	locked = models.DateTimeField(blank=True, null=True)
+	## when the game must be checked again by the scheduler
+	next_deadline = models.DateTimeField(blank=True, null=True, db_index=True)
+
+	def __unicode__(self):
+		return "Schedule of game %s" % self.game_id
+
+def create_schedule(sender, instance, created, **kwargs):
+	if created:
+		Schedule.objects.create(game=instance)
+
+models.signals.post_save.connect(create_schedule, sender=Game)
+
+def update_deadlines(sender, instance, **kwargs):
+	""" The deadlines of the games depend on the karma of the players that
+	are not done, so they are calculated again when a karma changes. """
+	games = Game.objects.filter(player__user=instance.user_id,
+								player__done=False).exclude(phase=PHINACTIVE)
+	for game in games.distinct():
+		game.update_deadline()
+
+models.signals.post_save.connect(update_deadlines, sender=CondottieriProfile)
+
+class RenderJobManager(models.Manager):
+	def enqueue(self, game):
+		""" Asks for the map of the game to be drawn. If there is already a
+		job for the game, it is marked as requested again. """
+		job, created = self.get_or_create(game=game)
+		if not created:
+			self.filter(id=job.id).update(requested=datetime.now())
+		Game.objects.filter(id=game.id).update(map_outdated=True)
+		game.map_outdated = True
+		return job
+
+	def enqueue_outdated(self):
+		""" Creates the jobs for the games whose maps are outdated, but have
+		no job (for example, if the job was lost). Returns the number of new
+		jobs. """
+		games = Game.objects.filter(map_outdated=True, renderjob__isnull=True)
+		count = 0
+		for game in games:
+			self.enqueue(game)
+			count += 1
+		return count
+
+	def claim(self, worker, timeout=RENDER_TIMEOUT):
+		""" Takes the oldest job that is not being drawn by other worker, or
+		whose worker has not finished it in ``timeout`` seconds. Returns the
+		job, or None if there are no jobs. """
+		limit = datetime.now() - timedelta(0, timeout)
+		waiting = self.filter(Q(started__isnull=True) | Q(started__lt=limit))
+		for job in waiting.order_by('requested')[:10]:
+			now = datetime.now()
+			## only one worker can update the job
+			if job.started is None:
+				jobs = self.filter(id=job.id, started__isnull=True)
+			else:
+				jobs = self.filter(id=job.id, started=job.started)
+			if jobs.update(worker=worker, started=now) == 1:
+				job.worker = worker
+				job.started = now
+				return job
+		return None
+
+	def finish(self, job):
+		""" Deletes a job after the map has been drawn. If the game has changed
+		while the map was being drawn, the job is left to be drawn again. """
+		self.filter(id=job.id, worker=job.worker, requested__lte=job.started).delete()
+		## the job was requested again while the map was being drawn
+		self.filter(id=job.id, worker=job.worker).update(worker='', started=None)
+		## the map is current only if the game has no job
+		Game.objects.filter(id=job.game_id, renderjob__isnull=True).update(map_outdated=False)
+
+class RenderJob(models.Model):
+	""" A RenderJob asks for the map of a game to be drawn by the
+	``render_maps`` command. There is only one job for each game. """
+
+	game = models.OneToOneField(Game)
+	requested = models.DateTimeField(default=datetime.now)
+	## name of the worker that is drawing the map
+	worker = models.CharField(max_length=64, blank=True, default='')
+	started = models.DateTimeField(blank=True, null=True)
+
+	objects = RenderJobManager()
+
+	def __unicode__(self):
+		return "Map of game %s" % self.game_id
+
 class Configuration(models.Model):
 	""" Defines the configuration options for each game. 
 	
@@ -3277,6 +3631,49 @@ class Expense(models.Model):
 			logging.info(msg)
 		self.delete()
 
+## the objects deleted by Game.delete_in_batch do not invalidate the cache
+## one by one
+_cache_batch = threading.local()
+
+## player id -> game id, as the players never change their game
+_player_games = {}
+
+def get_player_game(instance):
+	""" Returns the id of the game of the player of a unit or an expense,
+	reading it at most once for each player, or None if the player does not
+	exist. """
+	player = getattr(instance, '_player_cache', None)
+	if player is not None:
+		return player.game_id
+	game_id = _player_games.get(instance.player_id)
+	if game_id is None:
+		games = Player.objects.filter(id=instance.player_id).values_list('game', flat=True)
+		if len(games) == 0:
+			return None
+		game_id = _player_games[instance.player_id] = games[0]
+	return game_id
+
+def bump_game_cache(sender, instance, **kwargs):
+	""" Invalidates the cached data of the game when a unit, a game area, an
+	expense or the configuration is saved or deleted. """
+	if getattr(_cache_batch, 'active', False):
+		return
+	if isinstance(instance, (GameArea, Configuration)):
+		game_id = instance.game_id
+	else:
+		game_id = get_player_game(instance)
+		if game_id is None:
+			## the player is being deleted, with its game
+			return
+	Game(id=game_id).bump_cache_version()
+
+models.signals.post_save.connect(bump_game_cache, sender=Unit)
+models.signals.post_delete.connect(bump_game_cache, sender=Unit)
+models.signals.post_save.connect(bump_game_cache, sender=GameArea)
+models.signals.post_save.connect(bump_game_cache, sender=Expense)
+models.signals.post_delete.connect(bump_game_cache, sender=Expense)
+models.signals.post_save.connect(bump_game_cache, sender=Configuration)
+
 class Rebellion(models.Model):
 	"""
 	A Rebellion may be placed in a GameArea if finances rules are applied.
@@ -0,0 +1,121 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module computes the orders that each unit of a game can be given.
+
+The index is built with the rules in ``Order.is_possible``, trying every
+order for every unit. The index is kept in the cache under the version of the
+game, so it is discarded whenever the units or the areas change, and it is
+built by ``Game.check_finished_phase`` when an orders phase starts. It is used
+by the order form, to validate the orders, and by ``order_form.js``, to show
+only the possible choices.
+
+For each unit id, the index has:
+
+* ``-``: ids of the game areas where the unit can advance.
+* ``=``: unit types into which the unit can convert.
+* ``B``: True if the unit can besiege its city.
+* ``C``: True if the unit can convoy armies.
+* ``S-H``: ids of the units that the unit can support to hold.
+* ``S-=``: ids of the units that the unit can support to convert.
+* ``SA``: ids of the game areas into which the unit can support an advance.
+"""
+
+from django.core.cache import cache
+from django.utils import simplejson
+
+def build_legal_orders(game):
+	""" Returns the index of the orders that the units of the game can be
+	given. """
+	from machiavelli.models import Unit, Order
+
+	units = list(Unit.objects.filter(player__game=game).select_related('area__board_area',
+														'player'))
+	areas = list(game.gamearea_set.select_related('board_area'))
+	## any unit that is not a garrison, to check where supports can go
+	advancing = Unit(type='A')
+	index = {}
+	for unit in units:
+		legal = {'-': [], '=': [], 'S-H': [], 'S-=': [], 'SA': []}
+		legal['B'] = Order(unit=unit, code='B').is_possible()
+		legal['C'] = Order(unit=unit, code='C', subunit=advancing).is_possible()
+		for t in ('A', 'F', 'G'):
+			if t != unit.type and Order(unit=unit, code='=', type=t).is_possible():
+				legal['='].append(t)
+		for area in areas:
+			if area.id == unit.area_id:
+				continue
+			if Order(unit=unit, code='-', destination=area).is_possible():
+				legal['-'].append(area.id)
+		for area in areas:
+			if Order(unit=unit, code='S', subunit=advancing, subcode='-',
+					subdestination=area).is_possible():
+				legal['SA'].append(area.id)
+		for other in units:
+			if other.id == unit.id:
+				continue
+			for subcode in ('H', '='):
+				if Order(unit=unit, code='S', subunit=other, subcode=subcode).is_possible():
+					legal['S-%s' % subcode].append(other.id)
+		index[unit.id] = legal
+	return index
+
+def get_cache_key(game):
+	return game.get_cache_key("legal-orders")
+
+def update_legal_orders(game):
+	""" Builds the index of the orders of the game and keeps it in the cache,
+	as JSON, until the phase is over. Returns the JSON. """
+	legal_json = simplejson.dumps(build_legal_orders(game), separators=(',', ':'))
+	## karma can make the phase longer than the time limit
+	cache.set(get_cache_key(game), legal_json, 2 * game.time_limit)
+	return legal_json
+
+def get_legal_orders(game):
+	""" Returns the index of the orders of the game, as JSON. It is only built
+	here if it is not in the cache. """
+	legal_json = cache.get(get_cache_key(game))
+	if legal_json is None:
+		legal_json = update_legal_orders(game)
+	return legal_json
+
+def check_order(legal, unit, code, destination=None, type=None, subunit=None,
+				subcode=None, subdestination=None):
+	""" Returns True if the order is in the index, given as returned by
+	``get_legal_orders`` and decoded. """
+	orders = legal.get(str(unit.id))
+	if orders is None:
+		return False
+	if code == 'H':
+		return True
+	elif code == '-':
+		return destination.id in orders['-']
+	elif code == '=':
+		return type in orders['=']
+	elif code == 'B':
+		return orders['B']
+	elif code == 'C':
+		return orders['C'] and subunit.type == 'A'
+	elif code == 'S':
+		if subcode == '-':
+			return subunit.type != 'G' and subdestination.id in orders['SA']
+		elif subcode == '=':
+			return subunit.id in orders['S-=']
+		## a siege is supported like a hold
+		return subunit.id in orders['S-H']
+	return False
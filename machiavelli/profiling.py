@@ -0,0 +1,128 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module measures the cost of each step of the processing of a phase.
+
+While a game is being profiled, between ``start`` and ``stop``, the methods
+decorated with ``profile_step``, and the functions run with ``run_step``, are
+timed, and the queries that they execute and the rows that these queries
+return or change are counted. When the phase is processed, the measures are
+saved as ``StepTiming`` objects, one per step.
+
+The rows are counted from the ``rowcount`` of the cursors, so the backends
+that do not give it for SELECT statements (like SQLite) only count the
+changed rows. Steps called inside other steps are counted in both.
+
+The steps are only measured if ``settings.PROFILE_STEPS`` is True. The
+``clean_timings`` command deletes the old measures.
+"""
+
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+
+## if PROFILE_STEPS is False, the steps are not measured
+PROFILE_STEPS = getattr(settings, 'PROFILE_STEPS', False)
+
+## game id -> list of (step, seconds, queries, rows)
+_timings = {}
+## queries and rows counted since the cursors were wrapped
+_counter = [0, 0]
+
+class CountingCursor(object):
+	""" A cursor that counts the queries that it executes and their rows. """
+
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	def _count(self):
+		_counter[0] += 1
+		_counter[1] += max(self.cursor.rowcount, 0)
+
+	def execute(self, sql, params=()):
+		try:
+			return self.cursor.execute(sql, params)
+		finally:
+			self._count()
+
+	def executemany(self, sql, param_list):
+		try:
+			return self.cursor.executemany(sql, param_list)
+		finally:
+			self._count()
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+def _counting_cursor():
+	return CountingCursor(connection.__class__.cursor(connection))
+
+def start(game):
+	""" Starts measuring the steps of the game. """
+	if not PROFILE_STEPS:
+		return
+	if len(_timings) == 0:
+		connection.cursor = _counting_cursor
+	_timings[game.id] = []
+
+def stop(game):
+	""" Stops measuring the steps of the game, and returns the measures. """
+	timings = _timings.pop(game.id, [])
+	if len(_timings) == 0 and 'cursor' in connection.__dict__:
+		del connection.cursor
+	return timings
+
+def save(game, turn, timings):
+	""" Saves the measures returned by ``stop`` as ``StepTiming`` objects of
+	the turn, given as (year, season, phase). """
+	from machiavelli.models import StepTiming
+	from machiavelli.utils import bulk_insert
+
+	if len(timings) == 0:
+		return
+	now = datetime.now()
+	rows = [(game.id,) + tuple(turn) + t + (now,) for t in timings]
+	bulk_insert(StepTiming, ('game', 'year', 'season', 'phase', 'step',
+						'seconds', 'queries', 'rows', 'timestamp'), rows)
+
+def run_step(game, name, func, *args, **kwargs):
+	""" Calls the function and, if the game is being profiled, measures it as
+	the step ``name``. """
+	timings = _timings.get(game.id)
+	if timings is None:
+		return func(*args, **kwargs)
+	queries, rows = _counter
+	started = time.time()
+	try:
+		return func(*args, **kwargs)
+	finally:
+		timings.append((name, time.time() - started, _counter[0] - queries,
+						_counter[1] - rows))
+
+def profile_step(method):
+	""" Decorator for the methods of Game that are steps of a phase. """
+	def wrapper(game, *args, **kwargs):
+		return run_step(game, method.__name__, method, game, *args, **kwargs)
+	wrapper.__name__ = method.__name__
+	wrapper.__doc__ = method.__doc__
+	return wrapper
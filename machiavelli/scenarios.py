@@ -0,0 +1,97 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps in memory the data of the scenarios.
+
+The setups, homes, treasuries, city incomes and disabled areas of a scenario
+never change during a game, so they are read from the database only once per
+process, in a ``ScenarioTemplate``. The templates are discarded when any of
+these objects is saved or deleted. As in ``machiavelli.graph``, a version is
+stored in the cache, so that the other processes discard them too.
+"""
+
+from django.core.cache import cache
+
+VERSION_KEY = "scenario-templates-version"
+
+class ScenarioTemplate(object):
+	""" The data of a scenario, with the areas and countries referenced by
+	their ids. It must not be modified. """
+
+	def __init__(self, scenario_id, version=None):
+		from machiavelli.models import Area, Country, Home, Setup, Treasury, \
+			CityIncome, DisabledArea
+
+		self.version = version
+		self.disabled_ids = frozenset(DisabledArea.objects.filter(scenario__id=scenario_id).values_list('area', flat=True))
+		## ids of the areas in the board
+		self.area_ids = tuple([a for a in Area.objects.values_list('id', flat=True)
+							if not a in self.disabled_ids])
+		## country id -> ids of the areas that it controls at the start, and
+		## ids of the areas in its home country
+		homes = {}
+		home_country = {}
+		for country, area, is_home in Home.objects.filter(scenario__id=scenario_id).values_list('country',
+							'area', 'is_home'):
+			homes.setdefault(country, set()).add(area)
+			if is_home:
+				home_country.setdefault(country, set()).add(area)
+		self.homes = dict([(c, frozenset(a)) for c, a in homes.items()])
+		self.home_country = dict([(c, frozenset(a)) for c, a in home_country.items()])
+		## country id -> static name of the countries in the scenario
+		self.countries = dict(Country.objects.filter(id__in=self.homes.keys()).values_list('id',
+							'static_name'))
+		## (country id, area id, unit type) of the initial units
+		self.setups = tuple(Setup.objects.filter(scenario__id=scenario_id).values_list('country',
+							'area', 'unit_type'))
+		## country id -> (ducats, double)
+		self.treasuries = {}
+		for country, ducats, double in Treasury.objects.filter(scenario__id=scenario_id).values_list('country',
+							'ducats', 'double'):
+			self.treasuries[country] = (ducats, double)
+		## ids of the major cities that generate variable income
+		self.majors = frozenset(CityIncome.objects.filter(scenario__id=scenario_id).values_list('city', flat=True))
+
+	def get_home_country(self, *countries):
+		""" Returns the set of ids of the areas in the home country of the
+		given countries. """
+		areas = set()
+		for c in countries:
+			areas.update(self.home_country.get(c, ()))
+		return areas
+
+_templates = {}
+
+def get_template(scenario_id):
+	""" Returns the ``ScenarioTemplate`` of a scenario, reading it if it is
+	not in memory or if it has been invalidated in other process. """
+	version = cache.get(VERSION_KEY)
+	template = _templates.get(scenario_id)
+	if template is None or template.version != version:
+		template = ScenarioTemplate(scenario_id, version)
+		_templates[scenario_id] = template
+	return template
+
+def clear_cache(sender=None, **kwargs):
+	""" Discards the templates of all the scenarios. It is connected to the
+	signals sent when the areas or the scenarios change. """
+	_templates.clear()
+	try:
+		cache.incr(VERSION_KEY)
+	except ValueError:
+		cache.set(VERSION_KEY, 1)
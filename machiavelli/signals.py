@@ -35,7 +35,9 @@ order_placed = Signal(providing_args=["destination", "subtype",
 									"subconversion"])
 standoff_happened = Signal(providing_args=[])
 unit_converted = Signal(providing_args=["before", "after"])
-area_controlled = Signal(providing_args=[])
+## areas_controlled is sent by Game once per turn, with the GameAreas that
+## have changed their controller
+areas_controlled = Signal(providing_args=["areas"])
 unit_moved = Signal(providing_args=["destination"])
 unit_retreated = Signal(providing_args=["destination"])
 support_broken = Signal(providing_args=[])
@@ -53,7 +55,19 @@ plague_placed = Signal(providing_args=[])
 rebellion_started = Signal(providing_args=[])
 country_excommunicated = Signal(providing_args=[])
 country_forgiven = Signal(providing_args=[])
-income_raised = Signal(providing_args=["ducats"])
+## the parts of the income are only given when they are known
+income_raised = Signal(providing_args=["ducats", "control", "occupation",
+									"garrisons", "variable"])
 expense_paid = Signal(providing_args=[])
 player_assassinated = Signal(providing_args=[])
 game_finished = Signal(providing_args=[])
+## phase_started and phase_finished are sent by Game before and after
+## processing a phase. processed is False if the processing failed. If it is
+## True, the signal is sent in the transaction of the phase
+phase_started = Signal(providing_args=[])
+phase_finished = Signal(providing_args=["processed"])
+## snapshot_made is sent by machiavelli.logging when it makes a snapshot of a
+## game, so that other data can be added to it, and game_restored when a game
+## is restored from a snapshot to play the phase again
+snapshot_made = Signal(providing_args=["snapshot"])
+game_restored = Signal(providing_args=["snapshot"])
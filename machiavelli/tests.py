@@ -0,0 +1,1343 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" Tests of the machiavelli application. The games are started with the
+scenario 'struggle-i' of the fixtures, as in the benchmark commands. """
+
+from datetime import datetime, timedelta
+import unittest
+
+from django.conf import settings
+from django.test import TestCase
+from django.http import HttpRequest
+from django.core.cache import cache
+from django.utils import simplejson
+from django.core.management import call_command
+from django.db import connection
+
+import machiavelli.models as models
+import machiavelli.dice as dice
+import machiavelli.exceptions as exceptions
+import machiavelli.graph as graph
+import machiavelli.graphics as graphics
+import machiavelli.logging as logging
+import machiavelli.orders as orders
+import machiavelli.incomes as incomes
+import machiavelli.profiling as profiling
+import machiavelli.scenarios as scenarios
+import machiavelli.signals as signals
+import machiavelli.utils as utils
+import machiavelli.management.commands.replay_turns as replay_turns
+from machiavelli.context import get_game_context, QUERY_BUDGET
+from machiavelli.management.commands.benchmark_start import start_game
+
+if "condottieri_events" in settings.INSTALLED_APPS:
+	import condottieri_events.models as events
+	import condottieri_events.paginator as paginator
+else:
+	events = None
+
+FIXTURES = ['areas', 'countries', 'scenarios', 'tokens']
+
+class GameTestCase(TestCase):
+	""" Starts a game of 'struggle-i' before each test. """
+	fixtures = FIXTURES
+
+	def setUp(self):
+		self.async_maps = models.ASYNC_MAPS
+		models.ASYNC_MAPS = True
+		start_game(models.Scenario.objects.get(name='struggle-i'), 'test', 1)
+		self.game = self.get_game()
+
+	def tearDown(self):
+		models.ASYNC_MAPS = self.async_maps
+
+	def get_game(self):
+		return models.Game.objects.get(slug='benchmark-test')
+
+	def count_queries(self, func, *args, **kwargs):
+		""" Calls the function and returns the number of queries that it ran. """
+		profile_steps = profiling.PROFILE_STEPS
+		profiling.PROFILE_STEPS = True
+		profiling.start(self.game)
+		try:
+			profiling.run_step(self.game, 'test', func, *args, **kwargs)
+		finally:
+			timings = profiling.stop(self.game)
+			profiling.PROFILE_STEPS = profile_steps
+		return timings[0][2]
+
+	def get_players(self):
+		""" Returns the players of the game that have a user. """
+		return list(self.game.player_set.filter(user__isnull=False).order_by('id'))
+
+	def get_area(self, code):
+		return self.game.gamearea_set.get(board_area__code=code)
+
+	def clear_board(self):
+		""" Deletes all the units of the game. """
+		self.game.delete_in_batch(models.Unit.objects.filter(player__game=self.game))
+
+	def place(self, player, type, code, **kwargs):
+		""" Creates a unit of the player in the area with the given code. """
+		return models.Unit.objects.create(player=player, type=type,
+										area=self.get_area(code), **kwargs)
+
+	def give_order(self, unit, code, destination=None, subunit=None, subcode=None,
+				subdestination=None, **kwargs):
+		""" Creates a confirmed order, given by the owner of the unit unless
+		other ``player`` is given. The areas are given by their codes. """
+		if destination:
+			destination = self.get_area(destination)
+		if subdestination:
+			subdestination = self.get_area(subdestination)
+		kwargs.setdefault('player', unit.player)
+		return models.Order.objects.create(unit=unit, code=code, destination=destination,
+										subunit=subunit, subcode=subcode,
+										subdestination=subdestination, confirmed=True,
+										**kwargs)
+
+class GameContextTest(GameTestCase):
+	""" Counts the queries run by ``get_game_context``. """
+
+	def setUp(self):
+		super(GameContextTest, self).setUp()
+		self.profile_steps = profiling.PROFILE_STEPS
+		profiling.PROFILE_STEPS = True
+
+	def tearDown(self):
+		profiling.PROFILE_STEPS = self.profile_steps
+		super(GameContextTest, self).tearDown()
+
+	def get_context(self):
+		""" Reads the game and the player again, as the views do, and returns
+		the context and the number of queries that it needed. """
+		game = self.get_game()
+		player = models.Player.objects.filter(game=game, user__isnull=False).order_by('id')[0]
+		request = HttpRequest()
+		request.user = player.user
+		profiling.start(game)
+		context = profiling.run_step(game, 'context', get_game_context, request, game, player)
+		timings = profiling.stop(game)
+		return context, timings[0][2]
+
+	def test_query_budget(self):
+		player = models.Player.objects.filter(game=self.game, user__isnull=False).order_by('id')[0]
+		player.done = True
+		player.save()
+		self.game.bump_cache_version()
+		context, queries = self.get_context()
+		self.failUnless(queries <= QUERY_BUDGET,
+			"%s queries with a cold cache" % queries)
+		## only the karma of the user is read again
+		context, queries = self.get_context()
+		self.failUnlessEqual(queries, 1)
+
+	def test_player_flags(self):
+		player = models.Player.objects.filter(game=self.game, user__isnull=False).order_by('id')[0]
+		player.done = True
+		player.save()
+		context, queries = self.get_context()
+		player = models.Player.objects.get(id=player.id)
+		self.failUnlessEqual(context['can_excommunicate'], player.can_excommunicate())
+		self.failUnlessEqual(context['can_forgive'], player.can_forgive())
+		self.failUnlessEqual(context.get('undoable', False), not player.in_last_seconds())
+
+class AdjudicatorTestCase(GameTestCase):
+	""" Processes the orders phase of a game with the methods of ``Game``
+	(``LEGACY_ADJUDICATION``), restores the snapshot of the game, processes
+	it again with the in-memory ``Board`` and ``Adjudicator``, and compares
+	the results. """
+
+	def setUp(self):
+		super(AdjudicatorTestCase, self).setUp()
+		self.legacy = models.LEGACY_ADJUDICATION
+
+	def tearDown(self):
+		models.LEGACY_ADJUDICATION = self.legacy
+		super(AdjudicatorTestCase, self).tearDown()
+
+	def get_last_event(self, game):
+		from condottieri_events.models import BaseEvent
+
+		ids = BaseEvent.objects.filter(game=game).order_by('-id').values_list('id', flat=True)[:1]
+		return len(ids) > 0 and ids[0] or 0
+
+	def get_state(self, game, last_event):
+		""" Returns the units, areas, rebellions, players and turn of the game,
+		and the events logged after ``last_event``. """
+		from condottieri_events.models import BaseEvent
+
+		game = models.Game.objects.get(id=game.id)
+		events = BaseEvent.objects.filter(game=game, id__gt=last_event)
+		return {
+			'units': list(models.Unit.objects.filter(player__game=game).order_by('id').values_list('id',
+						'type', 'area__board_area__code', 'player', 'besieging',
+						'must_retreat', 'paid')),
+			'areas': list(game.gamearea_set.order_by('id').values_list('id', 'player',
+						'standoff', 'famine', 'storm')),
+			## the ids of the new rebellions depend on the backend
+			'rebellions': list(models.Rebellion.objects.filter(area__game=game).order_by('area').values_list('area',
+						'player', 'garrisoned')),
+			'players': list(game.player_set.order_by('id').values_list('id', 'ducats',
+						'eliminated', 'assassinated')),
+			'turn': (game.year, game.season, game.phase),
+			'events': sorted(events.values_list('classname', 'payload')),
+		}
+
+	def process(self, game, legacy):
+		""" Processes the phase of the game and returns its new state. """
+		models.LEGACY_ADJUDICATION = legacy
+		game = models.Game.objects.get(id=game.id)
+		last_event = self.get_last_event(game)
+		game.all_players_done(game.get_dice())
+		return self.get_state(game, last_event)
+
+	def compare(self, game):
+		""" Processes the phase with both adjudicators, checks that the results
+		are the same and returns them. The game is left as processed by the
+		in-memory adjudicator. """
+		from condottieri_events.models import BaseEvent
+		from machiavelli.logging import make_snapshot, restore_snapshot
+
+		snapshot = make_snapshot(game)
+		last_event = self.get_last_event(game)
+		legacy = self.process(game, True)
+		restore_snapshot(models.Game.objects.get(id=game.id), snapshot)
+		BaseEvent.objects.filter(game=game, id__gt=last_event).delete()
+		board = self.process(game, False)
+		for key in legacy.keys():
+			self.failUnlessEqual(legacy[key], board[key], "%s differ in %s %s %s" % (key,
+							snapshot['year'], snapshot['season'], snapshot['phase']))
+		return legacy
+
+class AdjudicatorTest(AdjudicatorTestCase):
+	""" Compares the adjudicators in a position with the cases of the rules. """
+
+	## (country, type, area, besieging, order), with the order given as
+	## (code, destination, subunit area, subcode, subdestination)
+	UNITS = (
+		## supported attack, with the support of the defender cut
+		(0, 'A', 'MIL', False, ('-', 'PAV', None, None, None)),
+		(0, 'A', 'TUR', False, ('S', None, 'MIL', '-', 'PAV')),
+		(0, 'A', 'GEN', False, ('-', 'MON', None, None, None)),
+		(1, 'A', 'PAV', False, ('H', None, None, None, None)),
+		(1, 'A', 'MON', False, ('S', None, 'PAV', 'H', None)),
+		## standoff in an empty area
+		(0, 'A', 'CRE', False, ('-', 'PAR', None, None, None)),
+		(1, 'A', 'MAN', False, ('-', 'PAR', None, None, None)),
+		## convoy
+		(0, 'F', 'TS', False, ('C', None, 'ROME', '-', 'COR')),
+		(0, 'A', 'ROME', False, ('-', 'COR', None, None, None)),
+		## convoy of a fleet that is dislodged
+		(0, 'F', 'GON', False, ('C', None, 'NAP', '-', 'PAL')),
+		(0, 'A', 'NAP', False, ('-', 'PAL', None, None, None)),
+		(1, 'F', 'IS', False, ('-', 'GON', None, None, None)),
+		(1, 'F', 'MES', False, ('S', None, 'IS', '-', 'GON')),
+		## sieges, for the second and the first time
+		(0, 'A', 'FLO', True, ('B', None, None, None, None)),
+		(1, 'G', 'FLO', False, ('H', None, None, None, None)),
+		(0, 'A', 'SIE', False, ('B', None, None, None, None)),
+		(1, 'G', 'SIE', False, ('H', None, None, None, None)),
+		## garrison that is not opposed
+		(0, 'A', 'ARE', False, ('=', None, None, None, None)),
+		## siege of a garrisoned rebellion, and a rebellion put down by a
+		## unit that holds
+		(0, 'A', 'ANC', True, ('B', None, None, None, None)),
+		(0, 'A', 'URB', False, ('H', None, None, None, None)),
+		## special unit, stronger than its rival
+		(1, 'A', 'SPO', False, ('-', 'AQU', None, None, None)),
+		(0, 'A', 'CAP', False, ('-', 'AQU', None, None, None)),
+		## unit that is bought by other player, who also orders it
+		(1, 'A', 'OTR', False, ('H', None, None, None, None)),
+	)
+	## power of the special units
+	POWERS = {('SPO', 'A'): 2}
+
+	def setUp(self):
+		super(AdjudicatorTest, self).setUp()
+		game = self.game
+		config = game.configuration
+		config.finances = True
+		config.save()
+		players = list(game.player_set.filter(user__isnull=False).order_by('id')[:2])
+		areas = dict([(a.board_area.code, a) for a in game.gamearea_set.select_related('board_area')])
+		game.delete_in_batch(models.Unit.objects.filter(player__game=game))
+		## (area, type) -> unit
+		self.units = {}
+		for country, type, area, besieging, order in self.UNITS:
+			self.units[(area, type)] = models.Unit.objects.create(type=type, area=areas[area],
+									player=players[country], besieging=besieging,
+									power=self.POWERS.get((area, type), 1))
+		for country, type, area, besieging, order in self.UNITS:
+			unit = self.units[(area, type)]
+			code, destination, subarea, subcode, subdestination = order
+			subunit = None
+			if subarea:
+				subunit = [u for (a, t), u in self.units.items() if a == subarea and t != 'G'][0]
+			models.Order.objects.create(unit=unit, code=code, destination=areas.get(destination),
+									type=(code == '=' and 'G' or None), subunit=subunit,
+									subcode=subcode, subdestination=areas.get(subdestination),
+									confirmed=True, player=unit.player)
+		for code in ('ANC', 'URB'):
+			areas[code].player = players[0]
+			areas[code].save()
+			models.Rebellion(area=areas[code]).save()
+		bribed = self.units[('OTR', 'A')]
+		models.Order.objects.create(unit=bribed, code='-', destination=areas['SAL'],
+									confirmed=True, player=players[0])
+		cost = models.get_expense_cost(9, bribed)
+		players[0].ducats = cost
+		players[0].save()
+		models.Expense.objects.create(player=players[0], ducats=cost, type=9,
+									unit=bribed, confirmed=True)
+		self.players = players
+
+	def test_same_results(self):
+		legacy = self.compare(self.game)
+		## the cases of the position happened
+		units = dict([(u[0], u) for u in legacy['units']])
+		def get_unit(area, type):
+			return units.get(self.units[(area, type)].id)
+		self.failUnlessEqual(get_unit('MIL', 'A')[2], 'PAV')
+		self.failIfEqual(get_unit('PAV', 'A')[5], '')
+		self.failUnlessEqual(get_unit('ROME', 'A')[2], 'COR')
+		self.failIfEqual(get_unit('GON', 'F')[5], '')
+		self.failUnlessEqual(get_unit('NAP', 'A')[2], 'NAP')
+		self.failUnlessEqual(get_unit('FLO', 'G'), None)
+		self.failUnless(get_unit('SIE', 'A')[4])
+		self.failUnlessEqual(get_unit('ARE', 'A')[1], 'G')
+		self.failUnlessEqual(get_unit('SPO', 'A')[2], 'AQU')
+		self.failUnlessEqual(get_unit('OTR', 'A')[2:4], ('SAL', self.players[0].id))
+		self.failUnlessEqual(legacy['rebellions'], [])
+		self.failUnlessEqual(legacy['turn'][2], models.PHRETREATS)
+		standoffs = self.game.gamearea_set.filter(standoff=True)
+		self.failUnlessEqual(list(standoffs.values_list('board_area__code', flat=True)), ['PAR'])
+
+class SimulatedAdjudicatorTest(AdjudicatorTestCase):
+	""" Compares the adjudicators in the orders phases of games played by the
+	bots of ``simulate_games``, with fixed seeds. """
+
+	SEEDS = (1, 2, 3)
+	## phases played in each game
+	PHASES = 9
+
+	def test_same_results(self):
+		from machiavelli.management.commands.simulate_games import BOTS
+
+		scenario = models.Scenario.objects.get(name='struggle-i')
+		compared = 0
+		for seed in self.SEEDS:
+			start_game(scenario, "sim-%s" % seed, seed)
+			game = models.Game.objects.get(slug="benchmark-sim-%s" % seed)
+			rng = dice.Dice(seed)
+			for i in range(self.PHASES):
+				if game.phase == models.PHINACTIVE:
+					break
+				BOTS[game.phase](game, rng)
+				if game.phase == models.PHORDERS:
+					self.compare(game)
+					compared += 1
+				else:
+					game.all_players_done(game.get_dice())
+				game.clear_phase_cache()
+				for p in game.player_set.all():
+					p.new_phase()
+				game = models.Game.objects.get(id=game.id)
+		self.failUnless(compared >= len(self.SEEDS))
+
+class StrengthTest(GameTestCase):
+	""" Compares the strengths of ``UnitManager.list_with_strength``, read with
+	one support table, with the ones of ``get_with_strength``. """
+
+	def setUp(self):
+		super(StrengthTest, self).setUp()
+		config = self.game.configuration
+		config.finances = True
+		config.save()
+		self.clear_board()
+		a, b = self.get_players()[:2]
+		self.attacker = self.place(a, 'A', 'MIL')
+		self.give_order(self.attacker, '-', 'PAV')
+		for code in ('TUR', 'COMO'):
+			self.give_order(self.place(a, 'A', code), 'S', subunit=self.attacker,
+						subcode='-', subdestination='PAV')
+		self.defender = self.place(b, 'A', 'PAV', power=2)
+		self.give_order(self.defender, 'H')
+		self.give_order(self.place(b, 'A', 'MON'), 'S', subunit=self.defender, subcode='H')
+		## a support for an order that the unit was not given does not count
+		self.give_order(self.place(b, 'A', 'FOR'), 'S', subunit=self.defender,
+						subcode='-', subdestination='PAR')
+		## a unit that holds in an area with a rebellion against its player
+		area = self.get_area('URB')
+		area.player = a
+		area.save()
+		models.Rebellion(area=area).save()
+		self.rebel = self.place(a, 'A', 'URB', power=2)
+
+	def test_strengths(self):
+		game = self.game
+		strengths = dict([(u.id, u.strength) for u in models.Unit.objects.list_with_strength(game)])
+		self.failUnlessEqual(strengths[self.attacker.id], 3)
+		self.failUnlessEqual(strengths[self.defender.id], 3)
+		self.failUnlessEqual(strengths[self.rebel.id], 1)
+		table = models.Unit.objects.get_support_table(game)
+		for id, strength in strengths.items():
+			unit = models.Unit.objects.get_with_strength(game, table, id=id)
+			self.failUnlessEqual(unit.strength, strength)
+
+	def test_sorted(self):
+		strengths = [u.strength for u in models.Unit.objects.list_with_strength(self.game)]
+		self.failUnlessEqual(strengths, sorted(strengths, reverse=True))
+
+
+class AdjacencyGraphTest(TestCase):
+	""" Checks the in-memory borders against the ones in the database. """
+	fixtures = FIXTURES
+
+	def setUp(self):
+		graph.invalidate_graph()
+
+	def test_borders(self):
+		adjacency = graph.get_graph()
+		for area in models.Area.objects.all():
+			borders = set(area.borders.values_list('id', flat=True))
+			self.failUnlessEqual(adjacency.get_borders(area.id), borders)
+			self.failUnless(adjacency.get_borders(area.id, fleet=True) <= borders)
+
+	def test_only_armies(self):
+		for a, b in graph.ONLY_ARMIES:
+			a = models.Area.objects.get(code=a)
+			b = models.Area.objects.get(code=b)
+			self.failUnless(a.is_adjacent(b))
+			self.failUnless(b.is_adjacent(a))
+			self.failIf(a.is_adjacent(b, fleet=True))
+			self.failIf(b.is_adjacent(a, fleet=True))
+
+	def test_invalidate(self):
+		mil = models.Area.objects.get(code='MIL')
+		pav = models.Area.objects.get(code='PAV')
+		self.failUnless(mil.is_adjacent(pav))
+		mil.borders.remove(pav)
+		self.failIf(mil.is_adjacent(pav))
+		self.failIf(pav.is_adjacent(mil))
+
+class ConvoyLineTest(GameTestCase):
+	""" Checks the line of convoys found for an army moving by sea. """
+
+	def setUp(self):
+		super(ConvoyLineTest, self).setUp()
+		self.clear_board()
+		self.player = self.get_players()[0]
+		self.army = self.place(self.player, 'A', 'GEN')
+		self.order = self.give_order(self.army, '-', 'NAP')
+
+	def convoy(self, code):
+		fleet = self.place(self.player, 'F', code)
+		self.give_order(fleet, 'C', subunit=self.army, subcode='-', subdestination='NAP')
+
+	def get_line(self):
+		return [a.board_area.code for a in self.order.find_convoy_line()]
+
+	def test_shortest_line(self):
+		for code in ('GOL', 'LS', 'TS', 'WM'):
+			self.convoy(code)
+		self.failUnlessEqual(self.get_line(), ['GEN', 'LS', 'TS', 'NAP'])
+
+	def test_broken_line(self):
+		for code in ('LS', 'GOL'):
+			self.convoy(code)
+		self.failUnlessEqual(self.get_line(), [])
+
+	def test_no_convoys(self):
+		self.failUnlessEqual(self.get_line(), [])
+
+class MapCacheTest(TestCase):
+	""" Checks that the caches of the maps follow the changes in the tokens,
+	made in this process or in other one. """
+	fixtures = FIXTURES
+
+	def setUp(self):
+		graphics.clear_cache()
+
+	def test_coordinates(self):
+		coords = graphics.get_coordinates()
+		for token in models.AFToken.objects.all():
+			self.failUnlessEqual(coords[token.area_id]['af'], (token.x, token.y))
+		for token in models.GToken.objects.all():
+			self.failUnlessEqual(coords[token.area_id]['g'], (token.x, token.y))
+
+	def test_token_saved(self):
+		graphics.get_coordinates()
+		token = models.AFToken.objects.all()[0]
+		token.x += 1
+		token.save()
+		self.failUnlessEqual(graphics.get_coordinates()[token.area_id]['af'],
+							(token.x, token.y))
+
+	def test_other_process(self):
+		graphics.check_version()
+		graphics.get_coordinates()
+		## other process changes the version in the cache
+		cache.incr(graphics.VERSION_KEY)
+		graphics.check_version()
+		self.failUnlessEqual(len(graphics._coordinates), 0)
+
+class RenderJobTest(GameTestCase):
+	""" Checks that only one worker draws the map of a game, and that the
+	map stays outdated if the game changes while it is being drawn. The game
+	has a job since it was started. """
+
+	def get_job(self):
+		return models.RenderJob.objects.get(game=self.game)
+
+	def is_outdated(self):
+		return self.get_game().map_outdated
+
+	def test_claim(self):
+		job = models.RenderJob.objects.claim('first')
+		self.failUnlessEqual(job.game_id, self.game.id)
+		self.failUnlessEqual(models.RenderJob.objects.claim('second'), None)
+		models.RenderJob.objects.finish(job)
+		self.failUnlessEqual(models.RenderJob.objects.count(), 0)
+		self.failIf(self.is_outdated())
+
+	def test_timed_out(self):
+		first = models.RenderJob.objects.claim('first')
+		## the first worker takes too long
+		second = models.RenderJob.objects.claim('second', timeout=-1)
+		self.failUnlessEqual(second.id, first.id)
+		self.failUnlessEqual(self.get_job().worker, 'second')
+		## the first worker cannot finish a job that it does not own
+		models.RenderJob.objects.finish(first)
+		self.failUnlessEqual(self.get_job().worker, 'second')
+		self.failUnless(self.is_outdated())
+		models.RenderJob.objects.finish(second)
+		self.failUnlessEqual(models.RenderJob.objects.count(), 0)
+		self.failIf(self.is_outdated())
+
+	def test_requested_again(self):
+		job = models.RenderJob.objects.claim('first')
+		models.RenderJob.objects.enqueue(self.game)
+		models.RenderJob.objects.filter(id=job.id).update(requested=job.started + timedelta(0, 1))
+		models.RenderJob.objects.finish(job)
+		job = self.get_job()
+		self.failUnlessEqual(job.worker, '')
+		self.failUnlessEqual(job.started, None)
+		self.failUnless(self.is_outdated())
+		self.failIfEqual(models.RenderJob.objects.claim('second'), None)
+
+	def test_lost_job(self):
+		models.RenderJob.objects.all().delete()
+		self.failUnlessEqual(models.RenderJob.objects.enqueue_outdated(), 1)
+		self.failUnlessEqual(models.RenderJob.objects.enqueue_outdated(), 0)
+		self.failUnlessEqual(self.get_job().game_id, self.game.id)
+
+class GameLockTest(GameTestCase):
+	""" Checks that only one process at a time can hold the lock of a game. """
+
+	def test_lock(self):
+		other = self.get_game()
+		self.failUnless(self.game.lock())
+		self.failIf(other.lock())
+		self.game.unlock()
+		self.failUnless(other.lock())
+		other.unlock()
+
+	def test_timed_out(self):
+		other = self.get_game()
+		self.failUnless(self.game.lock())
+		self.failUnless(other.lock(timeout=-1))
+		## the first process cannot release the lock of the second one
+		self.game.unlock()
+		self.failIf(self.get_game().lock())
+		other.unlock()
+		self.failUnless(self.get_game().lock())
+
+	def test_unlock_without_lock(self):
+		self.failUnless(self.game.lock())
+		self.get_game().unlock()
+		self.failIf(self.get_game().lock())
+
+class ScheduleTest(GameTestCase):
+	""" Checks the deadline of the game, that is kept out of ``Game.save``. """
+
+	def get_schedule(self):
+		return models.Schedule.objects.get(game=self.game)
+
+	def test_deadline(self):
+		self.failUnlessEqual(self.get_schedule().next_deadline,
+							self.game.next_phase_change())
+
+	def test_karma_changed(self):
+		before = self.get_schedule().next_deadline
+		profile = self.get_players()[0].user.get_profile()
+		profile.karma = 150
+		profile.save()
+		after = self.get_schedule().next_deadline
+		self.failUnless(after > before)
+		self.failUnlessEqual(after, self.get_game().next_phase_change())
+
+	def test_players_done(self):
+		self.game.player_set.update(done=True)
+		self.game.update_deadline()
+		self.failUnless(self.get_schedule().next_deadline <= datetime.now())
+
+	def test_stale_save(self):
+		stale = self.get_game()
+		self.failUnless(self.game.lock())
+		self.game.update_deadline()
+		deadline = self.get_schedule().next_deadline
+		stale.save()
+		schedule = self.get_schedule()
+		self.failIfEqual(schedule.locked, None)
+		self.failUnlessEqual(schedule.next_deadline, deadline)
+		self.failIf(self.get_game().lock())
+		self.game.unlock()
+
+class PlayerRankingTest(GameTestCase):
+	""" Checks the cities counted by ``player_list_ordered_by_cities``. """
+
+	def check_ranking(self):
+		ranking = self.game.player_list_ordered_by_cities()
+		self.failUnlessEqual(len(ranking), self.game.player_set.filter(country__isnull=False).count())
+		for player in ranking:
+			self.failUnlessEqual(player.cities, player.number_of_cities())
+		cities = [p.cities for p in ranking]
+		self.failUnlessEqual(cities, sorted(cities, reverse=True))
+		return ranking
+
+	def test_ranking(self):
+		self.check_ranking()
+
+	def test_city_conquered(self):
+		first, last = self.check_ranking()[0], self.check_ranking()[-1]
+		for area in self.game.gamearea_set.filter(player=last, board_area__has_city=True):
+			area.player = first
+			area.save()
+		ranking = self.check_ranking()
+		self.failUnlessEqual(ranking[0].id, first.id)
+		self.failUnlessEqual(ranking[-1].cities, 0)
+
+class GameCacheTest(GameTestCase):
+	""" Checks when the cached data of the game is invalidated. """
+
+	def get_units(self):
+		## the units are read again, without their players
+		return list(models.Unit.objects.filter(player__game=self.game))
+
+	def save_all(self, units):
+		for unit in units:
+			unit.save()
+
+	def test_unit_saved(self):
+		version = self.game.get_cache_version()
+		self.get_units()[0].save()
+		self.failUnless(self.game.get_cache_version() > version)
+
+	def test_player_game_read_once(self):
+		units = self.get_units()
+		models._player_games.clear()
+		cold = self.count_queries(self.save_all, units)
+		warm = self.count_queries(self.save_all, self.get_units())
+		self.failUnlessEqual(cold - warm, len(set([u.player_id for u in units])))
+
+	def test_delete_in_batch(self):
+		version = self.game.get_cache_version()
+		self.game.delete_in_batch(models.Unit.objects.filter(player__game=self.game))
+		self.failUnlessEqual(self.game.get_cache_version(), version + 1)
+		self.failUnlessEqual(len(self.get_units()), 0)
+
+	def test_missing_player(self):
+		unit = self.get_units()[0]
+		unit.player_id = models.Player.objects.order_by('-id')[0].id + 1
+		self.failUnlessEqual(models.get_player_game(unit), None)
+
+
+class IncomeTest(GameTestCase):
+	""" Compares each part of the incomes of ``incomes.get_incomes`` with the
+	legacy methods of ``Player``. """
+
+	def setUp(self):
+		super(IncomeTest, self).setUp()
+		config = self.game.configuration
+		config.finances = True
+		config.conquering = True
+		config.save()
+		a, b, c = self.get_players()[:3]
+		c.conqueror = a
+		c.double_income = True
+		c.save()
+		areas = self.game.gamearea_set.filter(player=a, board_area__is_sea=False)
+		famine, rebel = areas[0], areas[1]
+		famine.famine = True
+		famine.save()
+		models.Rebellion(area=rebel).save()
+		## armies and garrisons of a in cities of other players
+		enemy = self.game.gamearea_set.filter(board_area__is_fortified=True)
+		enemy = enemy.exclude(player=a).exclude(unit__type='G')
+		self.failUnless(len(enemy) >= 2)
+		self.place(a, 'A', enemy[0].board_area.code)
+		self.place(a, 'G', enemy[0].board_area.code)
+		self.place(a, 'G', enemy[1].board_area.code)
+		## the second garrison is under siege
+		self.place(b, 'A', enemy[1].board_area.code, besieging=True)
+
+	def test_incomes(self):
+		majors = list(models.CityIncome.objects.filter(scenario=self.game.scenario).values_list('city', flat=True))
+		for die in range(1, 7):
+			player_incomes = incomes.get_incomes(self.game, die)
+			self.failUnlessEqual(len(player_incomes), len(self.get_players()))
+			for income in player_incomes:
+				player = models.Player.objects.get(id=income.player.id)
+				rebellions = models.Rebellion.objects.filter(player=player).values_list('area', flat=True)
+				self.failUnlessEqual(income.control,
+									player.get_control_income(die, majors, rebellions))
+				self.failUnlessEqual(income.occupation, player.get_occupation_income())
+				self.failUnlessEqual(income.garrisons,
+									player.get_garrisons_income(die, majors, rebellions))
+				self.failUnlessEqual(income.variable, player.get_variable_income(die))
+				self.failUnlessEqual(income.total(), player.get_income(die, majors))
+
+class BribeTest(GameTestCase):
+	""" Checks that tied bribes are resolved only by the dice. """
+
+	def setUp(self):
+		super(BribeTest, self).setUp()
+		config = self.game.configuration
+		config.finances = True
+		config.save()
+		self.players = self.get_players()
+
+	def bribe(self, player, unit, ducats):
+		return models.Expense.objects.create(player=player, type=9, unit=unit,
+											ducats=ducats, confirmed=True)
+
+	def test_tie_break(self):
+		a, b, c, d = self.players[:4]
+		winners = set()
+		for seed in range(1, 11):
+			unit = self.place(c, 'A', 'MIL')
+			cost = models.get_expense_cost(9, unit)
+			tied = [self.bribe(a, unit, cost + 3), self.bribe(b, unit, cost + 3)]
+			self.bribe(d, unit, cost)
+			expected = dice.Dice(seed).choice(tied).player_id
+			self.game.process_expenses(dice.Dice(seed))
+			self.failUnlessEqual(models.Unit.objects.get(id=unit.id).player_id, expected)
+			self.failUnlessEqual(models.Expense.objects.filter(player__game=self.game).count(), 0)
+			winners.add(expected)
+		self.failUnlessEqual(winners, set([a.id, b.id]))
+
+	def test_highest_bribe(self):
+		a, b, c = self.players[:3]
+		unit = self.place(c, 'A', 'MIL')
+		cost = models.get_expense_cost(9, unit)
+		self.bribe(a, unit, cost)
+		self.bribe(b, unit, cost + 1)
+		self.game.process_expenses(dice.Dice(1))
+		self.failUnlessEqual(models.Unit.objects.get(id=unit.id).player_id, b.id)
+
+	def test_counter_bribe(self):
+		a, c = self.players[0], self.players[2]
+		unit = self.place(c, 'A', 'MIL')
+		cost = models.get_expense_cost(9, unit)
+		self.bribe(a, unit, cost + 2)
+		models.Expense.objects.create(player=c, type=4, unit=unit, ducats=3,
+									confirmed=True)
+		self.game.process_expenses(dice.Dice(1))
+		self.failUnlessEqual(models.Unit.objects.get(id=unit.id).player_id, c.id)
+
+class BoardTest(GameTestCase):
+	""" Checks the board created with bulk inserts when the game started. """
+
+	def test_game_areas(self):
+		disabled = models.DisabledArea.objects.filter(scenario=self.game.scenario)
+		expected = set(models.Area.objects.exclude(id__in=disabled.values_list('area', flat=True)).values_list('id', flat=True))
+		areas = self.game.gamearea_set.all()
+		self.failUnlessEqual(len(areas), len(expected))
+		self.failUnlessEqual(set([a.board_area_id for a in areas]), expected)
+		players = dict(self.game.player_set.filter(user__isnull=False).values_list('country', 'id'))
+		for home in models.Home.objects.filter(scenario=self.game.scenario):
+			area = self.game.gamearea_set.get(board_area=home.area)
+			self.failUnlessEqual(area.player_id, players[home.country_id])
+
+	def test_initial_units(self):
+		expected = []
+		for s in models.Setup.objects.filter(scenario=self.game.scenario).exclude(unit_type=''):
+			if s.country_id:
+				expected.append((s.country_id, s.area_id, s.unit_type))
+			else:
+				expected.append((None, s.area_id, 'G'))
+		units = models.Unit.objects.filter(player__game=self.game).values_list('player__country',
+										'area__board_area', 'type')
+		self.failUnlessEqual(sorted(units), sorted(expected))
+
+	def test_bulk_insert(self):
+		max_params = utils.MAX_PARAMS
+		## three rows in each INSERT
+		utils.MAX_PARAMS = 20
+		try:
+			now = datetime.now()
+			rows = [(self.game.id, 1500 + i, 1, 1, now, "log %s" % i) for i in range(10)]
+			utils.bulk_insert(models.TurnLog, ('game', 'year', 'season', 'phase',
+										'timestamp', 'log'), rows)
+		finally:
+			utils.MAX_PARAMS = max_params
+		logs = models.TurnLog.objects.filter(game=self.game, year__gte=1500)
+		self.failUnlessEqual(sorted(logs.values_list('year', 'log')),
+							[(1500 + i, "log %s" % i) for i in range(10)])
+
+class ScenarioTemplateTest(GameTestCase):
+	""" Checks the scenario templates kept in memory against the database. """
+
+	def setUp(self):
+		super(ScenarioTemplateTest, self).setUp()
+		self.scenario = self.game.scenario
+
+	def test_template(self):
+		template = scenarios.get_template(self.scenario.id)
+		homes = {}
+		for home in models.Home.objects.filter(scenario=self.scenario):
+			homes.setdefault(home.country_id, set()).add(home.area_id)
+			if home.is_home:
+				self.failUnless(home.area_id in template.get_home_country(home.country_id))
+		self.failUnlessEqual(dict([(c, set(a)) for c, a in template.homes.items()]), homes)
+		setups = [(s.country_id, s.area_id, s.unit_type) for s in self.scenario.setup_set.all()]
+		self.failUnlessEqual(sorted(template.setups), sorted(setups))
+		for t in models.Treasury.objects.filter(scenario=self.scenario):
+			self.failUnlessEqual(template.treasuries[t.country_id], (t.ducats, t.double))
+		majors = [c.city_id for c in models.CityIncome.objects.filter(scenario=self.scenario)]
+		self.failUnlessEqual(template.majors, frozenset(majors))
+
+	def test_in_memory(self):
+		template = scenarios.get_template(self.scenario.id)
+		self.failUnlessEqual(self.count_queries(scenarios.get_template, self.scenario.id), 0)
+		self.failUnless(scenarios.get_template(self.scenario.id) is template)
+
+	def test_invalidated(self):
+		template = scenarios.get_template(self.scenario.id)
+		home = models.Home.objects.filter(scenario=self.scenario)[0]
+		home.delete()
+		template = scenarios.get_template(self.scenario.id)
+		self.failIf(home.area_id in template.homes.get(home.country_id, ()))
+
+class SnapshotTest(GameTestCase):
+	""" Checks that a game restored from a snapshot is the same game. """
+
+	def change_game(self):
+		a, b = self.get_players()[:2]
+		units = list(models.Unit.objects.filter(player=a))
+		self.game.delete_in_batch(models.Unit.objects.filter(id=units[0].id))
+		self.give_order(units[1], 'H')
+		area = self.game.gamearea_set.filter(player=a, board_area__is_sea=False)[0]
+		models.Rebellion(area=area).save()
+		area = self.game.gamearea_set.filter(player=a)[1]
+		area.player = b
+		area.famine = True
+		area.save()
+		models.Player.objects.filter(id=b.id).update(ducats=99, done=True)
+		models.TurnLog.objects.create(game=self.game, year=self.game.year,
+									season=self.game.season, phase=self.game.phase,
+									log="processed")
+		self.game.phase = models.PHRETREATS
+		self.game.save()
+
+	def restore(self, snapshot, replay=False):
+		## as if it was read from the file
+		snapshot = simplejson.loads(simplejson.dumps(snapshot))
+		logging.restore_snapshot(self.get_game(), snapshot, replay=replay)
+
+	def test_round_trip(self):
+		snapshot = logging.make_snapshot(self.game)
+		self.change_game()
+		self.failIfEqual(logging.make_snapshot(self.get_game()), snapshot)
+		self.restore(snapshot)
+		self.failUnlessEqual(logging.make_snapshot(self.get_game()), snapshot)
+
+	def test_replay(self):
+		self.give_order(models.Unit.objects.filter(player__game=self.game)[0], 'H')
+		snapshot = logging.make_snapshot(self.game)
+		self.change_game()
+		self.restore(snapshot, replay=True)
+		game = self.get_game()
+		self.failUnlessEqual(game.phase, models.PHORDERS)
+		self.failUnlessEqual(models.Order.objects.filter(unit__player__game=game,
+													confirmed=True).count(), 0)
+		self.failUnlessEqual(models.TurnLog.objects.filter(game=game).count(), 0)
+		for player in game.player_set.filter(user__isnull=False):
+			self.failUnlessEqual(player.done, player.unit_set.count() == 0)
+
+class ReplayTest(GameTestCase):
+	""" Checks that a phase processed again from its snapshot gives the same
+	results, as ``replay_turns`` expects. """
+
+	def process(self):
+		game = self.get_game()
+		game.all_players_done(game.get_dice())
+		return logging.make_snapshot(self.get_game())
+
+	def get_turn(self, snapshot):
+		return (snapshot['year'], snapshot['season'], snapshot['phase'])
+
+	def test_replay(self):
+		before = logging.make_snapshot(self.game)
+		after = self.process()
+		self.failIfEqual(self.get_turn(after), self.get_turn(before))
+		logging.restore_snapshot(self.get_game(), before)
+		self.failUnlessEqual(replay_turns.compare_snapshots(self.process(), after), [])
+
+	def test_differences(self):
+		before = logging.make_snapshot(self.game)
+		after = self.process()
+		self.failIfEqual(replay_turns.compare_snapshots(before, after), [])
+		self.failUnlessEqual(replay_turns.compare_snapshots(after, after), [])
+		## a unit is missing
+		result = dict(after, units=after['units'][1:])
+		diffs = replay_turns.compare_snapshots(result, after)
+		self.failUnlessEqual(len(diffs), 1)
+		self.failUnless(diffs[0].startswith("missing Unit"))
+
+class DiceTest(GameTestCase):
+	""" Checks that the dice of a game only depend on its seed and phase. """
+
+	def get_famine(self, rng=None):
+		game = self.get_game()
+		game.gamearea_set.update(famine=False)
+		game.mark_famine_areas(rng)
+		return set(game.gamearea_set.filter(famine=True).values_list('id', flat=True))
+
+	def test_same_phase(self):
+		first = self.game.get_dice()
+		second = self.get_game().get_dice()
+		self.failUnlessEqual(first.seed, second.seed)
+		self.failUnlessEqual([first.roll_1d6() for i in range(20)],
+							[second.roll_1d6() for i in range(20)])
+
+	def test_other_phase(self):
+		rng = self.game.get_dice()
+		game = self.get_game()
+		game.season += 1
+		self.failIfEqual(game.get_dice().seed, rng.seed)
+
+	def test_zero_seed(self):
+		models.Game.objects.filter(id=self.game.id).update(dice_seed=0)
+		game = self.get_game()
+		stale = self.get_game()
+		rng = game.get_dice()
+		self.failIfEqual(game.dice_seed, 0)
+		self.failUnlessEqual(self.get_game().dice_seed, game.dice_seed)
+		## other process that read the game before it was seeded
+		self.failUnlessEqual(stale.get_dice().seed, rng.seed)
+
+	def test_default_dice(self):
+		config = self.game.configuration
+		config.famine = True
+		config.save()
+		self.failUnlessEqual(self.get_famine(), self.get_famine(self.game.get_dice()))
+		self.failUnless(len(self.get_famine()) > 0)
+
+class ShuffleCountriesTest(GameTestCase):
+	""" Checks that the countries are given with the seed of the game. """
+
+	def get_countries(self):
+		return list(self.game.player_set.filter(user__isnull=False).order_by('id').values_list('country', flat=True))
+
+	def test_same_seed(self):
+		countries = self.get_countries()
+		self.game.shuffle_countries()
+		self.failUnlessEqual(self.get_countries(), countries)
+
+	def test_given_dice(self):
+		countries = self.get_countries()
+		shuffled = set()
+		for seed in range(1, 6):
+			self.game.shuffle_countries(dice.Dice(seed))
+			shuffled.add(tuple(self.get_countries()))
+			self.failUnlessEqual(sorted(self.get_countries()), sorted(countries))
+		self.failUnless(len(shuffled) > 1)
+
+class ProfilingTest(GameTestCase):
+	""" Checks the measures of the steps of a phase. """
+
+	def setUp(self):
+		super(ProfilingTest, self).setUp()
+		self.profile_steps = profiling.PROFILE_STEPS
+
+	def tearDown(self):
+		profiling.PROFILE_STEPS = self.profile_steps
+		super(ProfilingTest, self).tearDown()
+
+	def read_units(self):
+		return list(models.Unit.objects.filter(player__game=self.game))
+
+	def test_disabled(self):
+		profiling.PROFILE_STEPS = False
+		profiling.start(self.game)
+		units = profiling.run_step(self.game, 'units', self.read_units)
+		self.failUnlessEqual(len(units), len(self.read_units()))
+		self.failUnlessEqual(profiling.stop(self.game), [])
+
+	def test_steps(self):
+		profiling.PROFILE_STEPS = True
+		profiling.start(self.game)
+		profiling.run_step(self.game, 'units', self.read_units)
+		self.game.make_map()
+		timings = profiling.stop(self.game)
+		self.failIf('cursor' in connection.__dict__)
+		self.failUnlessEqual([t[0] for t in timings], ['units', 'make_map'])
+		self.failUnlessEqual(timings[0][2], 1)
+		self.failUnless(timings[1][2] > 0)
+		turn = (self.game.year, self.game.season, self.game.phase)
+		profiling.save(self.game, turn, timings)
+		saved = models.StepTiming.objects.filter(game=self.game, year=turn[0],
+												season=turn[1], phase=turn[2])
+		self.failUnlessEqual(sorted(saved.values_list('step', 'queries')),
+							sorted([(t[0], t[2]) for t in timings]))
+
+	def test_clean_timings(self):
+		turn = (self.game.year, self.game.season, self.game.phase)
+		profiling.save(self.game, turn, [('old', 0.1, 1, 1), ('new', 0.1, 1, 1)])
+		old = models.StepTiming.objects.filter(step='old')
+		old.update(timestamp=datetime.now() - timedelta(60))
+		call_command('clean_timings')
+		self.failUnlessEqual(list(models.StepTiming.objects.values_list('step', flat=True)), ['new'])
+
+class UpdateControlsTest(GameTestCase):
+	""" Checks the controllers of the areas after ``update_controls``. """
+
+	def setUp(self):
+		super(UpdateControlsTest, self).setUp()
+		self.clear_board()
+		self.a, self.b, self.c = self.get_players()[:3]
+		self.autonomous = self.game.player_set.get(user__isnull=True)
+		self.controlled = []
+		signals.areas_controlled.connect(self.areas_controlled)
+
+	def tearDown(self):
+		signals.areas_controlled.disconnect(self.areas_controlled)
+		super(UpdateControlsTest, self).tearDown()
+
+	def areas_controlled(self, sender, areas, **kwargs):
+		self.controlled.append(sorted([a.board_area.code for a in areas]))
+
+	def set_player(self, code, player):
+		area = self.get_area(code)
+		area.player = player
+		area.save()
+
+	def get_player(self, code):
+		return self.get_area(code).player_id
+
+	def test_controls(self):
+		## conquered by a single player
+		self.set_player('MIL', self.a)
+		self.place(self.b, 'A', 'MIL')
+		## kept by its player
+		self.set_player('PAV', self.a)
+		self.place(self.a, 'A', 'PAV')
+		## besieged
+		self.set_player('TUR', self.a)
+		self.place(self.a, 'G', 'TUR')
+		self.place(self.b, 'A', 'TUR', besieging=True)
+		## an autonomous garrison
+		self.set_player('COMO', self.a)
+		self.place(self.autonomous, 'G', 'COMO')
+		## the seas and Venice
+		self.place(self.b, 'F', 'LS')
+		self.place(self.b, 'F', 'VEN')
+		self.game.update_controls()
+		self.failUnlessEqual(self.get_player('MIL'), self.b.id)
+		self.failUnlessEqual(self.get_player('PAV'), self.a.id)
+		self.failUnlessEqual(self.get_player('TUR'), None)
+		self.failUnlessEqual(self.get_player('COMO'), None)
+		self.failUnlessEqual(self.get_player('LS'), None)
+		self.failUnlessEqual(self.get_player('VEN'), self.b.id)
+		## the signals are only sent if condottieri_events is installed
+		if models.signals:
+			self.failUnlessEqual(self.controlled, [['MIL', 'VEN']])
+
+	def test_nothing_changed(self):
+		self.set_player('PAV', self.a)
+		self.place(self.a, 'A', 'PAV')
+		self.game.update_controls()
+		self.failUnlessEqual(self.get_player('PAV'), self.a.id)
+		self.failUnlessEqual(self.controlled, [])
+
+	def test_wrong_unit_count(self):
+		for player in (self.a, self.b, self.c):
+			self.place(player, 'A', 'MIL')
+		self.failUnlessRaises(exceptions.WrongUnitCount, self.game.update_controls)
+
+class EventTestCase(GameTestCase):
+	def make_event(self, event_class, **kwargs):
+		""" Returns a new event of the current phase, with its payload. """
+		game = self.game
+		event = event_class(game=game, year=game.year, season=game.season,
+						phase=game.phase, classname=event_class.__name__, **kwargs)
+		event.payload = event.make_payload()
+		return event
+
+	def get_events(self):
+		return list(events.BaseEvent.objects.filter(game=self.game).order_by('id'))
+
+@unittest.skipIf(events is None, "condottieri_events is not installed")
+class SaveEventsTest(EventTestCase):
+	""" Checks that the events saved together keep their child events, even
+	if some of them are identical. """
+
+	def make_events(self):
+		country = models.Country.objects.all()[0]
+		mil = models.Area.objects.get(code='MIL')
+		pav = models.Area.objects.get(code='PAV')
+		return [self.make_event(events.ControlEvent, country=country, area=mil),
+			self.make_event(events.StandoffEvent, area=pav),
+			self.make_event(events.ControlEvent, country=country, area=mil),
+			self.make_event(events.ControlEvent, country=country, area=pav),
+			self.make_event(events.StandoffEvent, area=pav)]
+
+	def check_saved(self, before, expected):
+		saved = [e for e in self.get_events() if not e.id in before]
+		self.failUnlessEqual(len(saved), len(expected))
+		for base, event in zip(saved, expected):
+			self.failUnlessEqual(base.classname, event.classname)
+			self.failUnlessEqual(base.payload, event.payload)
+			## the child is read from its own table
+			child = event.__class__.objects.get(id=base.id)
+			self.failUnlessEqual(child.area_id, event.area_id)
+		turn = {'game': self.game, 'year': self.game.year, 'season': self.game.season,
+				'phase': self.game.phase}
+		self.failUnlessEqual(events.EventSeason.objects.get(**turn).events,
+							events.BaseEvent.objects.filter(**turn).count())
+
+	def test_save_events(self):
+		before = set([e.id for e in self.get_events()])
+		expected = self.make_events()
+		events.save_events(self.game, expected)
+		self.check_saved(before, expected)
+
+	def test_buffer(self):
+		before = set([e.id for e in self.get_events()])
+		expected = self.make_events()
+		signals.phase_started.send(sender=self.game)
+		for e in expected:
+			kwargs = dict([(f.attname, getattr(e, f.attname)) for f in e.__class__._meta.local_fields
+						if not f.primary_key])
+			events.log_event(e.__class__, self.game, classname=e.classname, **kwargs)
+		self.failUnlessEqual(len(self.get_events()), len(before))
+		signals.phase_finished.send(sender=self.game, processed=True)
+		self.check_saved(before, expected)
+
+	def test_failed_phase(self):
+		before = self.get_events()
+		signals.phase_started.send(sender=self.game)
+		events.log_event(events.StandoffEvent, self.game, classname="StandoffEvent",
+						area=models.Area.objects.get(code='MIL'))
+		signals.phase_finished.send(sender=self.game, processed=False)
+		self.failUnlessEqual(self.get_events(), before)
+
+@unittest.skipIf(events is None, "condottieri_events is not installed")
+class EventPayloadTest(EventTestCase):
+	""" Checks that the events rendered from their payloads are the same as
+	the ones rendered from their child events. """
+
+	def setUp(self):
+		super(EventPayloadTest, self).setUp()
+		events.BaseEvent.objects.filter(game=self.game).delete()
+		country = models.Country.objects.all()[0]
+		mil = models.Area.objects.get(code='MIL')
+		pav = models.Area.objects.get(code='PAV')
+		events.save_events(self.game, [
+			self.make_event(events.ControlEvent, country=country, area=mil),
+			self.make_event(events.StandoffEvent, area=pav),
+			self.make_event(events.MovementEvent, country=country, type='A',
+							origin=mil, destination=pav),
+			self.make_event(events.MovementEvent, country=None, type='F',
+							origin=models.Area.objects.get(code='LS'),
+							destination=models.Area.objects.get(code='GOL'))])
+
+	def render(self):
+		return [e.color_output() for e in events.BaseEvent.objects.filter(game=self.game)]
+
+	def render_children(self):
+		children = []
+		for e in events.BaseEvent.objects.filter(game=self.game):
+			child = getattr(events, e.classname).objects.get(id=e.id)
+			child.payload = ''
+			children.append(child.color_output())
+		return children
+
+	def test_render(self):
+		self.failUnlessEqual(self.render(), self.render_children())
+
+	def test_one_query(self):
+		self.render()
+		self.failUnlessEqual(self.count_queries(self.render), 1)
+
+	def test_fill_payloads(self):
+		payloads = [e.payload for e in self.get_events()]
+		rendered = self.render()
+		events.BaseEvent.objects.filter(game=self.game).update(payload='')
+		self.failUnlessEqual(self.render(), rendered)
+		call_command('fill_payloads')
+		self.failUnlessEqual([e.payload for e in self.get_events()], payloads)
+
+@unittest.skipIf(events is None, "condottieri_events is not installed")
+class EventSeasonTest(EventTestCase):
+	""" Checks the season index of the events and the pages of the log. """
+
+	## (year, season, phase) -> number of events
+	TURNS = {
+		(1497, 3, 2): 1,
+		(1498, 1, 2): 2,
+		(1498, 1, 3): 1,
+		(1498, 2, 2): 1,
+		(1499, 1, 2): 2,
+	}
+
+	def setUp(self):
+		super(EventSeasonTest, self).setUp()
+		events.BaseEvent.objects.filter(game=self.game).delete()
+		events.EventSeason.objects.filter(game=self.game).delete()
+		self.current = (self.game.year, self.game.season, self.game.phase)
+		self.failUnlessEqual(self.current, (1499, 1, 2))
+		area = models.Area.objects.get(code='MIL')
+		log = []
+		for (year, season, phase), count in self.TURNS.items():
+			for i in range(count):
+				event = self.make_event(events.StandoffEvent, area=area)
+				event.year, event.season, event.phase = year, season, phase
+				log.append(event)
+		events.save_events(self.game, log)
+
+	def get_index(self):
+		return sorted(events.EventSeason.objects.filter(game=self.game).values_list('year',
+								'season', 'phase', 'events'))
+
+	def test_index(self):
+		expected = sorted([turn + (count,) for turn, count in self.TURNS.items()])
+		self.failUnlessEqual(self.get_index(), expected)
+		call_command('index_event_seasons')
+		self.failUnlessEqual(self.get_index(), expected)
+
+	def test_seasons(self):
+		self.failUnlessEqual(events.get_event_seasons(self.game),
+							[(1499, 1), (1498, 2), (1498, 1), (1497, 3)])
+		self.failUnlessEqual(events.get_event_seasons(self.game, exclude=self.current),
+							[(1498, 2), (1498, 1), (1497, 3)])
+
+	def get_paginator(self, seasons=None):
+		log = self.game.baseevent_set.exclude(year=self.current[0], season=self.current[1],
+											phase=self.current[2])
+		return paginator.SeasonPaginator(log, seasons)
+
+	def test_paginator(self):
+		seasons = events.get_event_seasons(self.game, exclude=self.current)
+		self.failUnlessEqual(self.get_paginator(seasons).seasons, self.get_paginator().seasons)
+		pages = self.get_paginator(seasons)
+		page = pages.page()
+		self.failUnlessEqual((page.year, page.season), (1498, 2))
+		self.failIf(page.has_previous())
+		self.failUnlessEqual(page.next_date(), "year=1498&season=1")
+		page = pages.page(1498, 1)
+		self.failUnlessEqual(page.object_list.count(), 3)
+		self.failUnless(page.has_previous() and page.has_next())
+		page = pages.page("1497", "3")
+		self.failIf(page.has_next())
+		self.failUnlessEqual(page.previous_date(), "year=1498&season=1")
+
+	def test_invalid_pages(self):
+		pages = self.get_paginator(events.get_event_seasons(self.game, exclude=self.current))
+		self.failUnlessRaises(paginator.EmptyPage, pages.page, 1497, 1)
+		self.failUnlessRaises(paginator.EmptyPage, pages.page, 1499, 1)
+		self.failUnlessRaises(paginator.EmptyPage, pages.page, 1496, 3)
+		self.failUnlessRaises(paginator.SeasonOutOfRange, pages.page, 1498, 4)
+		self.failUnlessRaises(paginator.SeasonNotAnInteger, pages.page, 1498, "spring")
+		self.failUnlessRaises(paginator.YearNotAnInteger, pages.page, "last", 1)
+		self.failUnlessRaises(paginator.EmptyPage, paginator.SeasonPaginator(
+							events.BaseEvent.objects.none(), []).page)
+
+class LegalOrdersTest(GameTestCase):
+	""" Checks the index of the legal orders against ``Order.is_possible``. """
+
+	def setUp(self):
+		super(LegalOrdersTest, self).setUp()
+		self.clear_board()
+		a, b = self.get_players()[:2]
+		self.army = self.place(a, 'A', 'PAV')
+		self.besieger = self.place(a, 'A', 'MIL', besieging=True)
+		self.garrison = self.place(b, 'G', 'MIL')
+		self.place(a, 'F', 'LS')
+		self.place(b, 'F', 'GEN')
+		self.place(b, 'A', 'TUR')
+
+	def get_legal(self):
+		return simplejson.loads(orders.get_legal_orders(self.get_game()))
+
+	def get_units(self):
+		return list(models.Unit.objects.filter(player__game=self.game).select_related('area__board_area',
+																		'player'))
+
+	def check(self, legal, unit, code, **kwargs):
+		order = models.Order(unit=unit, code=code, **kwargs)
+		self.failUnlessEqual(orders.check_order(legal, unit, code, **kwargs),
+							order.is_possible(), "%s %s %s" % (unit, code, kwargs))
+
+	def test_all_orders(self):
+		legal = self.get_legal()
+		units = self.get_units()
+		areas = list(self.game.gamearea_set.select_related('board_area'))
+		for unit in units:
+			self.check(legal, unit, 'H')
+			self.check(legal, unit, 'B')
+			for t in ('A', 'F', 'G'):
+				self.check(legal, unit, '=', type=t)
+			for area in areas:
+				## an advance into its own area is not an order
+				if area.id != unit.area_id:
+					self.check(legal, unit, '-', destination=area)
+			for other in units:
+				if other.id == unit.id:
+					continue
+				self.check(legal, unit, 'C', subunit=other)
+				for subcode in ('H', 'B', '='):
+					self.check(legal, unit, 'S', subunit=other, subcode=subcode)
+				for area in areas:
+					self.check(legal, unit, 'S', subunit=other, subcode='-',
+								subdestination=area)
+
+	def test_supports(self):
+		legal = self.get_legal()
+		## a garrison can be supported to convert, but not to hold
+		self.failUnless(orders.check_order(legal, self.army, 'S', subunit=self.garrison,
+										subcode='='))
+		self.failIf(orders.check_order(legal, self.army, 'S', subunit=self.garrison,
+										subcode='H'))
+		## an army can be supported to hold, but a garrison cannot support
+		## its conversion
+		self.failUnless(orders.check_order(legal, self.garrison, 'S', subunit=self.besieger,
+										subcode='H'))
+		self.failIf(orders.check_order(legal, self.garrison, 'S', subunit=self.besieger,
+										subcode='='))
+
+	def test_units_changed(self):
+		mod = self.get_area('MOD')
+		self.failIf(mod.id in self.get_legal()[str(self.besieger.id)]['-'])
+		self.besieger.area = self.get_area('PAR')
+		self.besieger.save()
+		self.failUnless(mod.id in self.get_legal()[str(self.besieger.id)]['-'])
+
@@ -0,0 +1,72 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module contains miscellaneous functions used by the applications
+of the project. """
+
+from django.db import connection, transaction
+
+## maximum number of values in a statement, the lowest limit of the backends
+## (SQLite)
+MAX_PARAMS = 999
+
+def _multirow_values():
+	""" Returns True if the database accepts several rows in the VALUES of an
+	INSERT. Old versions of SQLite do not, but they run in the same process,
+	so executemany does not make a round trip for each row. """
+	if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+		import sqlite3
+		return sqlite3.sqlite_version_info >= (3, 7, 11)
+	return True
+
+def bulk_insert(model, fields, rows):
+	""" Inserts the rows in the table of the model with one INSERT statement
+	for each chunk of rows, as many as fit in ``MAX_PARAMS`` values. Each row
+	is a tuple with the values of the given fields, and foreign keys are given
+	by id. No signals are sent. """
+	if len(rows) == 0:
+		return
+	qn = connection.ops.quote_name
+	columns = [qn(model._meta.get_field(f).column) for f in fields]
+	sql = "INSERT INTO %s (%s) VALUES " % (qn(model._meta.db_table), ", ".join(columns))
+	placeholder = "(%s)" % ", ".join(["%s"] * len(columns))
+	cursor = connection.cursor()
+	if _multirow_values():
+		size = max(1, MAX_PARAMS / len(columns))
+		for i in range(0, len(rows), size):
+			chunk = rows[i:i + size]
+			params = []
+			for row in chunk:
+				params.extend(row)
+			cursor.execute(sql + ", ".join([placeholder] * len(chunk)), params)
+	else:
+		cursor.executemany(sql + placeholder, rows)
+	transaction.commit_unless_managed()
+
+def atomic(func):
+	""" Decorator that works like ``transaction.commit_on_success``, but if
+	the transaction is already managed, for example by an outer
+	``commit_on_success``, the function runs in it. The changes are then
+	committed or rolled back with the rest of the outer transaction. """
+	def wrapper(*args, **kwargs):
+		if transaction.is_managed():
+			return func(*args, **kwargs)
+		return transaction.commit_on_success(func)(*args, **kwargs)
+	wrapper.__name__ = func.__name__
+	wrapper.__doc__ = func.__doc__
+	return wrapper
@@ -42,6 +42,7 @@ from django.contrib import messages
 ## machiavelli
 from machiavelli.models import *
 import machiavelli.forms as forms
+from machiavelli.context import get_game_context
 
 ## condottieri_common
 from condottieri_common.models import Server
@@ -51,6 +52,7 @@ from condottieri_profiles.models import CondottieriProfile
 
 ## condottieri_events
 import condottieri_events.paginator as events_paginator
+import condottieri_events.models as events_models
 
 ## clones detection
 if 'clones' in settings.INSTALLED_APPS:
@@ -249,53 +251,6 @@ def pending_games(request):
 							context,
 							context_instance=RequestContext(request))	
 
-def base_context(request, game, player):
-	context = {
-		'user': request.user,
-		'game': game,
-		'map' : game.get_map_url(),
-		'player': player,
-		'player_list': game.player_list_ordered_by_cities(),
-		'show_users': game.visible,
-		}
-	if game.slots > 0:
-		context['player_list'] = game.player_set.filter(user__isnull=False)
-	log = game.baseevent_set.all()
-	if player:
-		context['done'] = player.done
-		if game.configuration.finances:
-			context['ducats'] = player.ducats
-		context['can_excommunicate'] = player.can_excommunicate()
-		context['can_forgive'] = player.can_forgive()
-		if game.slots == 0:
-			context['time_exceeded'] = player.time_exceeded()
-		if game.phase == PHORDERS:
-			if player.done and not player.in_last_seconds():
-				context.update({'undoable': True,})
-	log = log.exclude(season__exact=game.season,
-							phase__exact=game.phase)
-	if len(log) > 0:
-		last_year = log[0].year
-		last_season = log[0].season
-		last_phase = log[0].phase
-		context['log'] = log.filter(year__exact=last_year,
-								season__exact=last_season,
-								phase__exact=last_phase)
-	else:
-		context['log'] = log # this will always be an empty queryset
-	#context['log'] = log[:10]
-	rules = game.configuration.get_enabled_rules()
-	if len(rules) > 0:
-		context['rules'] = rules
-	
-	if game.configuration.gossip:
-		whispers = game.whisper_set.all()[:10]
-		context.update({'whispers': whispers, })
-		if player:
-			context.update({'whisper_form': forms.WhisperForm(request.user, game),})
-		
-	return context
-
 #@never_cache
 #def js_play_game(request, slug=''):
 #	game = get_object_or_404(Game, slug=slug)
@@ -331,6 +286,7 @@ def undo_actions(request, slug=''):
 				if game.check_bonus_time():
 					profile.adjust_karma( -1 )
 				player.save()
+				game.update_deadline()
 				messages.success(request, _("Your actions are now unconfirmed. You'll have to confirm then again."))
 
 	return redirect('show-game', slug=slug)
@@ -361,7 +317,7 @@ def play_game(request, slug='', **kwargs):
 		#if game.slots == 0:
 		#	game.check_time_limit()
 		if game.phase == PHINACTIVE:
-			context = base_context(request, game, player)
+			context = get_game_context(request, game, player)
 			return render_to_response('machiavelli/inactive_actions.html',
 							context,
 							context_instance=RequestContext(request))
@@ -381,13 +337,13 @@ def play_game(request, slug='', **kwargs):
 			raise Http404
 	## no player
 	else:
-		context = base_context(request, game, player)
+		context = get_game_context(request, game, player)
 		return render_to_response('machiavelli/inactive_actions.html',
 							context,
 							context_instance=RequestContext(request))
 
 def play_reinforcements(request, game, player):
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	if player.done:
 		context['to_place'] = player.unit_set.filter(placed=False)
 		context['to_disband'] = player.unit_set.filter(placed=True, paid=False)
@@ -454,7 +410,7 @@ def play_reinforcements(request, game, player):
 							context_instance=RequestContext(request))
 
 def play_finance_reinforcements(request, game, player):
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	if player.done:
 		context['to_place'] = player.unit_set.filter(placed=False)
 		context['to_disband'] = player.unit_set.filter(placed=True, paid=False)
@@ -544,7 +500,7 @@ def play_finance_reinforcements(request, game, player):
 
 
 def play_orders(request, game, player):
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	#sent_orders = Order.objects.filter(unit__in=player.unit_set.all())
 	sent_orders = player.order_set.all()
 	context.update({'sent_orders': sent_orders})
@@ -642,7 +598,7 @@ def confirm_orders(request, slug=''):
 	return redirect(game)		
 	
 def play_retreats(request, game, player):
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	if not player.done:
 		units = Unit.objects.filter(player=player).exclude(must_retreat__exact='')
 		retreat_forms = []
@@ -680,7 +636,7 @@ def play_retreats(request, game, player):
 							context_instance=RequestContext(request))
 
 def play_expenses(request, game, player):
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	context['current_expenses'] = player.expense_set.all()
 	ExpenseForm = forms.make_expense_form(player)
 	if request.method == 'POST':
@@ -740,11 +696,13 @@ def logs_by_game(request, slug=''):
 		player = Player.objects.get(game=game, user=request.user)
 	except:
 		player = Player.objects.none()
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	log_list = game.baseevent_set.exclude(year__exact=game.year,
 										season__exact=game.season,
 										phase__exact=game.phase)
-	paginator = events_paginator.SeasonPaginator(log_list)
+	seasons = events_models.get_event_seasons(game,
+										exclude=(game.year, game.season, game.phase))
+	paginator = events_paginator.SeasonPaginator(log_list, seasons)
 	try:
 		year = int(request.GET.get('year'))
 	except TypeError:
@@ -1121,7 +1079,7 @@ def give_money(request, slug, player_id):
 		return redirect(game)
 	borrower = get_object_or_404(Player, id=player_id, game=game)
 	lender = get_object_or_404(Player, user=request.user, game=game)
-	context = base_context(request, game, lender)
+	context = get_game_context(request, game, lender)
 
 	if request.method == 'POST':
 		form = forms.LendForm(request.POST)
@@ -1162,7 +1120,7 @@ def borrow_money(request, slug):
 	if game.phase != PHORDERS or not game.configuration.lenders or player.done:
 		messages.error(request, _("You cannot borrow money in this moment."))
 		return redirect(game)
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	credit = player.get_credit()
 	try:
 		loan = player.loan
@@ -1220,7 +1178,7 @@ def assassination(request, slug):
 	if game.phase != PHORDERS or not game.configuration.assassinations or player.done:
 		messages.error(request, _("You cannot buy an assassination in this moment."))
 		return redirect(game)
-	context = base_context(request, game, player)
+	context = get_game_context(request, game, player)
 	AssassinationForm = forms.make_assassination_form(player)
 	if request.method == 'POST':
 		form = AssassinationForm(request.POST)